@@ -0,0 +1,5 @@
+"""kbx
+
+Runtime components of KookBotX itself, used by `main.py`. Bot features belong in
+`modules/`.
+"""
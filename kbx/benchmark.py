@@ -0,0 +1,102 @@
+"""Per-message logging overhead of `message_logger` with loguru's file sink and with
+`BatchingSink`:
+
+```bash
+python -m kbx.benchmark --messages 50000
+```
+
+Only the file sink is attached (the console sink is removed), and every message goes
+through `log_message` of `modules/message_logger` with a stand-in for `khl.Message`. The
+time reported is what the event loop would spend per message, on average and at the tail
+(the tail is where a synchronous sink waits for the disk); for `BatchingSink`, the time
+to write out the buffer after the burst is reported separately, as it is spent on the
+writer thread.
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from loguru import logger
+
+from kbx.log_pipeline import TEXT_FORMAT, BatchingSink
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "modules"))
+from message_logger import log_message  # noqa: E402
+
+
+def fake_message(i: int):
+    author = SimpleNamespace(
+        id=str(1000 + i % 50),
+        nickname=f"user{i % 50}",
+        username=f"user{i % 50}",
+        bot=False,
+        online=True,
+    )
+    return SimpleNamespace(
+        id=f"msg-{i}",
+        author=author,
+        channel=SimpleNamespace(id="2000", name="general"),
+        guild=SimpleNamespace(id="3000"),
+        content=f"Hello from message {i}, this is a fairly ordinary chat line.",
+    )
+
+
+def run(name: str, add_sink, messages: list):
+    logger.remove()
+    sink = add_sink()
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for m in messages:
+        t = clock()
+        log_message(m)
+        latencies.append(clock() - t)
+    elapsed = clock() - start
+    p99 = statistics.quantiles(latencies, n=100)[-1]
+    start = time.perf_counter()
+    logger.remove()  # stops (and drains) the sink
+    drain = time.perf_counter() - start
+    dropped = sink.total_dropped if isinstance(sink, BatchingSink) else 0
+    print(
+        f"{name:>16} {elapsed / len(messages) * 1e6:>8.1f}us {p99 * 1e6:>8.1f}us {max(latencies) * 1e6:>9.1f}us"
+        f" {len(messages) / elapsed:>10.0f}/s {drain * 1000:>8.1f}ms {dropped:>8}"
+    )
+
+
+def main(args):
+    messages = [fake_message(i) for i in range(args.messages)]
+    print(f"messages={args.messages} capacity={args.capacity}")
+    print(
+        f"{'sink':>16} {'mean':>10} {'p99':>10} {'max':>11} {'throughput':>12} {'drain':>10} {'dropped':>8}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+
+        def loguru_file():
+            logger.add(directory / "loguru.log", format=TEXT_FORMAT, level="INFO")
+
+        def batching(fmt):
+            def add():
+                sink = BatchingSink(directory / fmt, fmt=fmt, capacity=args.capacity)
+                logger.add(sink, format=sink.format, level="INFO")
+                return sink
+
+            return add
+
+        run("loguru file", loguru_file, messages)
+        run("batching text", batching("text"), messages)
+        run("batching jsonl", batching("jsonl"), messages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per-message logging overhead")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument(
+        "--capacity", type=int, default=65536, help="ring buffer size of BatchingSink"
+    )
+    main(parser.parse_args())
@@ -0,0 +1,151 @@
+"""Command dispatch through a trie of command triggers, with every handler timed.
+
+khl.py's `CommandManager` starts every registered command on every message, and each one
+lexes the content to find out it was not meant for it. `TrieCommandManager` indexes the
+`prefix + name` (and aliases) of every command using the default lexer in a trie, so
+that only the commands the content starts with are started. Commands with a regex or
+custom lexer cannot be indexed and are still started on every message.
+
+`instrument_bot` installs it on a bot and wraps every command, `on_message` and
+`on_event` handler registered afterwards with `Metrics.track`.
+"""
+
+import asyncio
+import functools
+from typing import Callable, List, Optional
+
+from khl import Bot
+from khl.command import Command, CommandManager
+from khl.command.lexer import DefaultLexer
+
+from kbx.metrics import Metrics
+
+
+class _Node:
+    __slots__ = ("children", "commands")
+
+    def __init__(self):
+        self.children = {}
+        self.commands: List[Command] = []
+
+
+class CommandTrie:
+    """Command triggers (`prefix + name`), looked up by the start of a message."""
+
+    def __init__(self):
+        self.root = _Node()
+        # Triggers of case insensitive commands are stored lowercased
+        self.root_insensitive = _Node()
+
+    def add(self, trigger: str, command: Command, case_sensitive: bool = True):
+        node = self.root if case_sensitive else self.root_insensitive
+        for char in trigger if case_sensitive else trigger.lower():
+            node = node.children.setdefault(char, _Node())
+        if command not in node.commands:
+            node.commands.append(command)
+
+    def match(self, content: str) -> List[Command]:
+        """Commands whose trigger is followed by whitespace or the end of `content`."""
+        matched = []
+        for node, fold in ((self.root, False), (self.root_insensitive, True)):
+            if not node.children:
+                continue
+            for i, char in enumerate(content):
+                node = node.children.get(char.lower() if fold else char)
+                if node is None:
+                    break
+                if node.commands and (
+                    i + 1 == len(content) or content[i + 1].isspace()
+                ):
+                    matched.extend(c for c in node.commands if c not in matched)
+        return matched
+
+
+class TrieCommandManager(CommandManager):
+    """`CommandManager` that only starts the commands a message can trigger, timing each
+    one in `metrics`."""
+
+    def __init__(self, metrics: Optional[Metrics] = None):
+        super().__init__()
+        self.metrics = metrics
+        self.trie = CommandTrie()
+        self.unindexed: List[Command] = []
+
+    def __setitem__(self, name: str, cmd: Command):
+        super().__setitem__(name, cmd)
+        if self.metrics is not None:
+            cmd.handler = timed(self.metrics, f"command:{cmd.name}", cmd.handler)
+        self._index(cmd)
+
+    def pop(self, name: str) -> Optional[Command]:
+        cmd = super().pop(name)
+        self._rebuild()
+        return cmd
+
+    def update_prefixes(self, *prefixes: str) -> List[Command]:
+        updated = super().update_prefixes(*prefixes)
+        self._rebuild()
+        return updated
+
+    def _index(self, cmd: Command):
+        # A subclass of DefaultLexer may match differently
+        if type(cmd.lexer) is not DefaultLexer:
+            self.unindexed.append(cmd)
+            return
+        for prefix in cmd.lexer.prefixes:
+            for trigger in cmd.lexer.triggers:
+                self.trie.add(prefix + trigger, cmd, cmd.lexer.case_sensitive)
+
+    def _rebuild(self):
+        self.trie = CommandTrie()
+        self.unindexed = []
+        for _, cmd in self.items():
+            self._index(cmd)
+
+    def candidates(self, content: str) -> List[Command]:
+        return self.trie.match(content or "") + self.unindexed
+
+    async def handle(self, loop, client, msg, filter_args: dict):
+        for cmd in self.candidates(msg.content):
+            asyncio.ensure_future(cmd.handle(msg, client, filter_args), loop=loop)
+
+
+def timed(metrics: Metrics, name: str, handler: Callable) -> Callable:
+    """`handler` (a coroutine function) timed as `name`. The signature is kept, khl.py
+    parses arguments by it."""
+
+    @functools.wraps(handler)
+    async def timed_handler(*args, **kwargs):
+        with metrics.track(name):
+            return await handler(*args, **kwargs)
+
+    return timed_handler
+
+
+def _handler_name(handler: Callable) -> str:
+    # Handlers are usually defined inside the init() of their module
+    return f"{handler.__module__}.{handler.__qualname__.replace('.<locals>', '')}"
+
+
+def instrument_bot(bot: Bot, metrics: Metrics):
+    """Dispatch the commands of `bot` through a `TrieCommandManager`, and time the
+    handlers registered from now on."""
+    manager = TrieCommandManager(metrics)
+    for _, cmd in list(bot.command.items()):
+        manager.add(cmd)
+    bot.command = manager
+
+    add_message_handler = bot.add_message_handler
+    add_event_handler = bot.add_event_handler
+
+    def add_timed_message_handler(handler, *except_type):
+        name = f"on_message:{_handler_name(handler)}"
+        return add_message_handler(timed(metrics, name, handler), *except_type)
+
+    def add_timed_event_handler(type, handler):
+        name = f"on_event:{_handler_name(handler)}"
+        return add_event_handler(type, timed(metrics, name, handler))
+
+    # `on_message` and `on_event` look these up on the instance
+    bot.add_message_handler = add_timed_message_handler
+    bot.add_event_handler = add_timed_event_handler
@@ -0,0 +1,130 @@
+"""A fake KOOK gateway, to run KookBotX locally on recorded events.
+
+`ReplayReceiver` feeds the packages of a recording into a bot instead of the websocket.
+A recording is a JSONL file with one `{"t": <unix time>, "d": <package>}` per line, as
+written by `EventRecorder` (the sharded runtime records with `--record`).
+`FakeRequester` answers the KOOK API without sending anything and logs what the bot
+would have sent, so a replay needs no token and touches no server.
+"""
+
+import asyncio
+import time
+import uuid
+from pathlib import Path
+from typing import IO, Optional, Union
+
+import orjson
+from khl import Cert
+from khl.receiver import Receiver
+from loguru import logger
+
+from kbx.scheduler import OutboundScheduler, ScheduledRequester
+
+# Returned by the fake `user/me`; packages authored by this id are ignored as the bot's
+# own
+FAKE_BOT_USER = {
+    "id": "1000000000",
+    "username": "KookBotX",
+    "identify_num": "0000",
+    "online": True,
+    "bot": True,
+    "status": 0,
+    "avatar": "",
+}
+
+
+class EventRecorder:
+    """Appends packages to a recording, flushing at most every `flush_interval` seconds."""
+
+    def __init__(self, path: Union[str, Path], flush_interval: float = 1.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        self._file: Optional[IO[bytes]] = open(self.path, "ab")
+        self._flushed_at = time.monotonic()
+        self.recorded = 0
+
+    def record(self, pkg: dict):
+        if self._file is None:
+            return
+        self._file.write(orjson.dumps({"t": time.time(), "d": pkg}) + b"\n")
+        self.recorded += 1
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self._file.flush()
+            self._flushed_at = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ReplayReceiver(Receiver):
+    """Puts the packages of a recording into the bot's queue. With `speed` 1 the
+    original gaps between packages are kept, 2 replays twice as fast, and 0 replays as
+    fast as the bot takes them. `done` is set at the end.
+    """
+
+    def __init__(self, path: Union[str, Path], speed: float = 0.0):
+        super().__init__()
+        self.path = Path(path)
+        self.speed = speed
+        self.replayed = 0
+        self.done = asyncio.Event()
+
+    @property
+    def type(self) -> str:
+        return "replay"
+
+    async def start(self):
+        lines = await asyncio.to_thread(self.path.read_bytes)
+        started = time.monotonic()
+        first = None
+        for line in lines.splitlines():
+            if not line.strip():
+                continue
+            entry = orjson.loads(line)
+            if self.speed > 0:
+                first = entry["t"] if first is None else first
+                delay = (entry["t"] - first) / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.pkg_queue.put(entry["d"])
+            self.replayed += 1
+        logger.info("Replayed {} packages from {}", self.replayed, self.path)
+        self.done.set()
+        # Like the websocket receiver, never returns
+        await asyncio.Event().wait()
+
+
+class FakeRequester(ScheduledRequester):
+    """`ScheduledRequester` answering the KOOK API itself. Requests still go through the
+    scheduler."""
+
+    def __init__(self, scheduler: OutboundScheduler, token: str = "fake"):
+        super().__init__(Cert(token=token), scheduler)
+        self.sent = 0
+
+    async def _send(self, method: str, route: str, params: dict):
+        self.sent += 1
+        payload = params.get("json") or params.get("params") or params.get("data")
+        logger.info("Fake KOOK API {} {}: {}", method, route, payload)
+        if route == "user/me":
+            return dict(FAKE_BOT_USER)
+        if route.endswith("message/create"):
+            return {
+                "msg_id": str(uuid.uuid4()),
+                "msg_timestamp": int(time.time() * 1000),
+                "nonce": "",
+            }
+        return {}
+
+
+async def stop_after_replay(receiver: ReplayReceiver, stop, linger: float = 3.0):
+    """Call `stop()` `linger` seconds after `receiver` replayed its last package,
+    leaving time to handle them."""
+    await receiver.done.wait()
+    await asyncio.sleep(linger)
+    ret = stop()
+    if asyncio.iscoroutine(ret):
+        await ret
@@ -0,0 +1,281 @@
+"""Batched, non-blocking log file sink.
+
+Loguru's file sink writes (and flushes) every record on the thread that logs it, which
+for KookBotX is the event loop. `BatchingSink` only appends the record to a bounded ring
+buffer; a background thread writes the buffer out in batches. When the writer falls
+behind and the buffer is full, the oldest records are dropped and counted (the count is
+written to the log as soon as the writer catches up) rather than stalling the loop.
+Structured records keep the formatted traceback of their exception, like the text format
+does.
+
+```python
+sink = BatchingSink("logs", fmt="jsonl", compress=True)
+logger.add(sink, format=sink.format, level="INFO")
+```
+
+Logs are written to segments named `kookbotx.<timestamp>.log` (`.jsonl` for structured
+logs), a new one every `segment_bytes` or `segment_age` seconds. Finished segments are
+gzipped with `compress=True`, and segments older than `retention` seconds are deleted.
+"""
+
+import collections
+import datetime
+import gzip
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Optional, Union
+
+import orjson
+
+TEXT_FORMAT = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {name}:{function}:{line} - {message}"
+
+# Seconds between two reports of a failing writer on stderr
+FAILURE_REPORT_INTERVAL = 60.0
+
+
+def compact_exception(exception) -> dict:
+    # Formatted right away, the frames of the traceback change once the handler returns
+    return {
+        "type": exception.type.__name__ if exception.type is not None else None,
+        "value": repr(exception.value),
+        "traceback": "".join(
+            traceback.format_exception(
+                exception.type, exception.value, exception.traceback
+            )
+        ),
+    }
+
+
+def compact_record(record: dict) -> tuple:
+    """The fields of a loguru record that go into a structured log. Buffering these
+    instead of the whole record keeps far fewer objects alive, and garbage collection
+    pauses of the logging thread short.
+    """
+    exception = record["exception"]
+    return (
+        record["time"],
+        record["level"].name,
+        record["name"],
+        record["function"],
+        record["line"],
+        record["message"],
+        record["extra"] or None,
+        compact_exception(exception) if exception is not None else None,
+    )
+
+
+def record_to_json(compact: tuple) -> bytes:
+    time_, level, name, function, line, message, extra, exception = compact
+    entry = {
+        "time": time_.isoformat(),
+        "level": level,
+        "name": name,
+        "function": function,
+        "line": line,
+        "message": message,
+    }
+    if extra:
+        entry["extra"] = extra
+    if exception is not None:
+        entry["exception"] = exception
+    return orjson.dumps(entry, default=str) + b"\n"
+
+
+class BatchingSink:
+    """A loguru sink handing records to a writer thread through a bounded ring buffer.
+
+    Pass it to `logger.add` with `format=sink.format`; `logger.remove` stops it after
+    writing what is buffered.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        name: str = "kookbotx",
+        fmt: str = "text",
+        compress: bool = False,
+        capacity: int = 65536,
+        batch_size: int = 1024,
+        flush_interval: float = 0.5,
+        segment_bytes: int = 64 * 1024 * 1024,
+        segment_age: Optional[float] = 24 * 3600,
+        retention: Optional[float] = 28 * 24 * 3600,
+    ):
+        if fmt not in ("text", "jsonl"):
+            raise ValueError(f"Unknown log format {fmt!r}, expected 'text' or 'jsonl'")
+        self.directory = Path(directory)
+        self.name = name
+        self.fmt = fmt
+        # Structured records are built from the record itself, loguru needs not format
+        # anything
+        self.format = TEXT_FORMAT if fmt == "text" else "{message}"
+        self.compress = compress
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.retention = retention
+        self.buffer = collections.deque(maxlen=capacity)
+        self.dropped = 0  # since the last batch, reported in the log
+        self.total_dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self._failure_reported_at: Optional[float] = None
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._file = None
+        self._segment_path: Optional[Path] = None
+        self._segment_started = 0.0
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self._run, name="kbx-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, message):
+        # Called by loguru on the logging thread, this must stay cheap
+        buffer = self.buffer
+        if len(buffer) == buffer.maxlen:
+            # The append below pushes the oldest record out
+            self.dropped += 1
+            self.total_dropped += 1
+        buffer.append(
+            compact_record(message.record) if self.fmt == "jsonl" else str(message)
+        )
+        if len(buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            stopping = self._stopping
+            try:
+                self._write_batches()
+            except Exception as e:
+                # Never let the writer die, records keep being dropped and counted
+                # instead
+                self._report_failure(e)
+            if stopping:
+                break
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _report_failure(self, error: Exception):
+        # Not through loguru, which would hand the report back to this sink
+        self.failures += 1
+        now = time.monotonic()
+        if (
+            self._failure_reported_at is not None
+            and now - self._failure_reported_at < FAILURE_REPORT_INTERVAL
+        ):
+            return
+        self._failure_reported_at = now
+        try:
+            sys.stderr.write(
+                f"KookBotX log writer failed ({self.failures} failures so far): {error!r}\n"
+            )
+            sys.stderr.flush()
+        except Exception:
+            pass
+
+    def _write_batches(self):
+        buffer = self.buffer
+        while buffer or self.dropped:
+            lines = []
+            dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append(self._dropped_line(dropped))
+            for _ in range(min(self.batch_size, len(buffer))):
+                item = buffer.popleft()
+                if self.fmt == "jsonl":
+                    lines.append(record_to_json(item))
+                else:
+                    lines.append(item.encode("utf-8", "replace"))
+            data = b"".join(lines)
+            self._segment_for(len(data)).write(data)
+            self._file.flush()
+            self.written += len(lines)
+            self.batches += 1
+
+    def _dropped_line(self, dropped: int) -> bytes:
+        text = f"{dropped} log records dropped, the writer fell behind"
+        now = datetime.datetime.now().astimezone()
+        if self.fmt == "jsonl":
+            return (
+                orjson.dumps(
+                    {
+                        "time": now.isoformat(),
+                        "level": "WARNING",
+                        "name": __name__,
+                        "message": text,
+                    }
+                )
+                + b"\n"
+            )
+        return (
+            f"{now:%Y-%m-%d %H:%M:%S.%f}"[:-3].encode()
+            + f" | WARNING  | {__name__} - {text}\n".encode()
+        )
+
+    def _segment_for(self, size: int):
+        now = time.time()
+        if self._file is not None and (
+            self._file.tell() + size > self.segment_bytes
+            or (
+                self.segment_age is not None
+                and now - self._segment_started > self.segment_age
+            )
+        ):
+            self._file.close()
+            self._file = None
+            self._finish_segment(self._segment_path)
+            self._apply_retention()
+        if self._file is None:
+            if self._segment_path is None:
+                # Segments of earlier runs
+                self._apply_retention()
+            suffix = "jsonl" if self.fmt == "jsonl" else "log"
+            stamp = datetime.datetime.fromtimestamp(now).strftime(
+                "%Y-%m-%d_%H-%M-%S_%f"
+            )
+            self._segment_path = self.directory / f"{self.name}.{stamp}.{suffix}"
+            self._file = open(self._segment_path, "ab")
+            self._segment_started = now
+        return self._file
+
+    def _finish_segment(self, path: Path):
+        if not self.compress:
+            return
+        with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+
+    def _apply_retention(self):
+        if self.retention is None:
+            return
+        deadline = time.time() - self.retention
+        for path in self.directory.glob(f"{self.name}.*"):
+            if path != self._segment_path and path.stat().st_mtime < deadline:
+                path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self.buffer),
+            "written": self.written,
+            "dropped": self.total_dropped,
+            "batches": self.batches,
+            "failures": self.failures,
+        }
@@ -0,0 +1,211 @@
+"""Event loop health: lag, blocking callbacks and an on-demand sampling profiler.
+
+`LoopMonitor` schedules a tick on the event loop every `interval` seconds and measures
+how late each one runs (the loop lag). A watchdog thread notices when a tick is more
+than `slow_threshold` seconds overdue, which means some callback is blocking the loop,
+and logs the stack of the loop thread at that moment along with the task running it;
+when the loop gets going again, the total stall is logged too.
+
+`LoopMonitor.profile` samples the stack of the loop thread from another thread every few
+milliseconds and writes the samples in the collapsed ("folded") format read by
+flamegraph.pl, speedscope and inferno. Ticks and samples cost a few microseconds each,
+so the monitor can stay on in production.
+"""
+
+import asyncio
+import collections
+import statistics
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Optional, Union
+
+from aiohttp import web
+from loguru import logger
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+
+
+def collapse_stack(frame) -> str:
+    """`frame` and its callers as `outermost;...;innermost`."""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        labels.append(
+            f"{getattr(code, 'co_qualname', code.co_name)} ({Path(code.co_filename).name})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        interval: float = 0.05,
+        slow_threshold: float = 0.1,
+        window: int = 1200,
+        profile_dir: Union[str, Path] = "logs",
+    ):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.profile_dir = Path(profile_dir)
+        self.lags = collections.deque(
+            maxlen=window
+        )  # the last minute with the defaults
+        self.max_lag = 0.0
+        self.slow_callbacks = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._due = 0.0  # monotonic time of the next tick
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._stall_reported = False
+        self._stopping = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+        self._profiling = threading.Lock()
+
+    def start(self):
+        """Start monitoring the running loop."""
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopping.clear()
+        self._schedule()
+        self._watchdog = threading.Thread(
+            target=self._watch, name="kbx-loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    # ---- Lag ----
+
+    def _schedule(self):
+        self._due = time.monotonic() + self.interval
+        self._handle = self.loop.call_at(self.loop.time() + self.interval, self._tick)
+
+    def _tick(self):
+        lag = max(0.0, time.monotonic() - self._due)
+        self.lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        if self._stall_reported:
+            self._stall_reported = False
+            logger.warning("Event loop was blocked for {:.0f}ms", lag * 1000)
+        if not self._stopping.is_set():
+            self._schedule()
+
+    # ---- Blocking callbacks ----
+
+    def _watch(self):
+        while not self._stopping.wait(self.slow_threshold / 2):
+            overdue = time.monotonic() - self._due
+            if overdue < self.slow_threshold or self._stall_reported:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self._stall_reported = True
+            self.slow_callbacks += 1
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(
+                "Event loop blocked for {:.0f}ms so far, in {} at {}. Stack of the loop thread:\n{}",
+                overdue * 1000,
+                self._current_task_name(frame),
+                _frame_label(frame),
+                stack,
+            )
+
+    def _current_task_name(self, frame) -> str:
+        # The task whose coroutine is on the stack of the loop thread: this runs in the
+        # watchdog thread, where `asyncio.current_task` does not apply
+        on_stack = {}
+        while frame is not None:
+            on_stack[id(frame)] = frame
+            frame = frame.f_back
+        for task in asyncio.all_tasks(self.loop):
+            coro_frames = task.get_stack(limit=1)
+            if coro_frames and id(coro_frames[0]) in on_stack:
+                coro = task.get_coro()
+                return f"task {task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+        return "a callback outside of any task"
+
+    # ---- Profiler ----
+
+    async def profile(
+        self,
+        duration: float = 30.0,
+        sample_interval: float = 0.005,
+        path: Union[str, Path, None] = None,
+    ) -> Path:
+        """Sample the loop thread for `duration` seconds and write the collapsed stacks
+        to `path` (by default `logs/profile-<time>.folded`). Render it with e.g.
+        `flamegraph.pl profile.folded > profile.svg`.
+        """
+        if path is None:
+            path = self.profile_dir / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        path = Path(path)
+        if not self._profiling.acquire(blocking=False):
+            raise RuntimeError("A profile is already being taken")
+        try:
+            samples = await asyncio.to_thread(self._sample, duration, sample_interval)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            lines = [f"{stack} {count}\n" for stack, count in samples.most_common()]
+            await asyncio.to_thread(path.write_text, "".join(lines), "utf-8")
+        finally:
+            self._profiling.release()
+        logger.info(
+            "Wrote {} samples of the event loop to {}", sum(samples.values()), path
+        )
+        return path
+
+    def _sample(self, duration: float, sample_interval: float) -> collections.Counter:
+        samples = collections.Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                samples[collapse_stack(frame)] += 1
+            del frame
+            time.sleep(sample_interval)
+        return samples
+
+    async def handle_profile_request(self, request: web.Request) -> web.Response:
+        """aiohttp handler profiling for `?seconds=` (default 10, at most 300) and
+        answering the collapsed stacks."""
+        try:
+            seconds = min(300.0, float(request.query.get("seconds", "10")))
+        except ValueError:
+            raise web.HTTPBadRequest(text="seconds must be a number")
+        try:
+            path = await self.profile(seconds)
+        except RuntimeError as e:
+            raise web.HTTPConflict(text=str(e))
+        text = await asyncio.to_thread(path.read_text, "utf-8")
+        return web.Response(text=text, content_type="text/plain")
+
+    # ---- Stats ----
+
+    def stats(self) -> dict:
+        lags = list(self.lags)
+        if len(lags) >= 2:
+            cuts = statistics.quantiles(lags, n=100, method="inclusive")
+            p50, p99 = cuts[49], cuts[98]
+        else:
+            p50 = p99 = lags[0] if lags else 0.0
+        return {
+            "lag_p50_seconds": p50,
+            "lag_p99_seconds": p99,
+            "lag_max_seconds": self.max_lag,
+            "slow_callbacks": self.slow_callbacks,
+        }
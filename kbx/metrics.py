@@ -0,0 +1,198 @@
+"""Latency metrics of KookBotX handlers, and a local HTTP endpoint to scrape them.
+
+`Metrics.track(name)` times a block of code (a command, a message handler...) and counts
+its calls, errors and concurrent runs. Other components add gauges with
+`Metrics.add_source(prefix, stats)`, where `stats()` returns a dict of numbers (nested
+dicts are flattened). `MetricsServer` serves all of it on `/metrics` in the Prometheus
+text format and on `/metrics.json`.
+"""
+
+import collections
+import contextlib
+import re
+import statistics
+import time
+from typing import Callable, Dict, Optional
+
+from aiohttp import web
+from loguru import logger
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyStats:
+    """Calls, errors and in-flight runs of one handler, with quantiles over its last
+    `window` durations."""
+
+    def __init__(self, window: int = 1024):
+        self.durations = collections.deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.total_seconds = 0.0
+
+    def record(self, duration: float, failed: bool):
+        self.durations.append(duration)
+        self.calls += 1
+        self.total_seconds += duration
+        if failed:
+            self.errors += 1
+
+    def quantiles(self) -> Dict[float, Optional[float]]:
+        if len(self.durations) < 2:
+            only = self.durations[0] if self.durations else None
+            return {q: only for q in QUANTILES}
+        cuts = statistics.quantiles(self.durations, n=100, method="inclusive")
+        return {q: cuts[int(q * 100) - 1] for q in QUANTILES}
+
+    def to_dict(self) -> dict:
+        return {
+            **{f"p{int(q * 100)}": value for q, value in self.quantiles().items()},
+            "calls": self.calls,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "total_seconds": self.total_seconds,
+        }
+
+
+class Metrics:
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.handlers: Dict[str, LatencyStats] = {}
+        self.sources: Dict[str, Callable[[], dict]] = {}
+
+    def stats_of(self, name: str) -> LatencyStats:
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = LatencyStats(self.window)
+        return stats
+
+    @contextlib.contextmanager
+    def track(self, name: str):
+        """Time the block as one call of `name`; an exception escaping the block counts
+        as an error."""
+        stats = self.stats_of(name)
+        stats.in_flight += 1
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield stats
+            failed = False
+        finally:
+            stats.in_flight -= 1
+            stats.record(time.perf_counter() - start, failed)
+
+    def add_source(self, prefix: str, stats: Callable[[], dict]):
+        self.sources[prefix] = stats
+
+    def gauges(self) -> Dict[str, float]:
+        gauges = {}
+        for prefix, source in self.sources.items():
+            try:
+                _flatten(prefix, source(), gauges)
+            except Exception as e:
+                logger.warning("Cannot collect metrics of {}: {}", prefix, e)
+        return gauges
+
+    def snapshot(self) -> dict:
+        return {
+            "handlers": {
+                name: stats.to_dict() for name, stats in sorted(self.handlers.items())
+            },
+            "gauges": self.gauges(),
+        }
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# TYPE kbx_handler_seconds summary",
+        ]
+        for name, stats in sorted(self.handlers.items()):
+            label = _escape(name)
+            for q, value in stats.quantiles().items():
+                if value is not None:
+                    lines.append(
+                        f'kbx_handler_seconds{{handler="{label}",quantile="{q}"}} {value:.6f}'
+                    )
+            lines.append(
+                f'kbx_handler_seconds_sum{{handler="{label}"}} {stats.total_seconds:.6f}'
+            )
+            lines.append(
+                f'kbx_handler_seconds_count{{handler="{label}"}} {stats.calls}'
+            )
+        for metric, attribute in (
+            ("kbx_handler_errors_total", "errors"),
+            ("kbx_handler_in_flight", "in_flight"),
+        ):
+            lines.append(
+                f"# TYPE {metric} {'counter' if metric.endswith('_total') else 'gauge'}"
+            )
+            for name, stats in sorted(self.handlers.items()):
+                lines.append(
+                    f'{metric}{{handler="{_escape(name)}"}} {getattr(stats, attribute)}'
+                )
+        for name, value in sorted(self.gauges().items()):
+            metric = "kbx_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(prefix: str, stats: dict, into: dict):
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            _flatten(name, value, into)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            into[name] = value
+        elif isinstance(value, bool):
+            into[name] = int(value)
+        elif isinstance(value, (list, tuple, set)):
+            into[name] = len(value)
+
+
+def _escape(label: str) -> str:
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsServer:
+    """Serves `metrics` on `http://<host>:<port>/metrics` (Prometheus) and
+    `/metrics.json`, and `routes` (`{path: aiohttp handler}`) on GET."""
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        host: str = "127.0.0.1",
+        port: int = 9464,
+        routes: Optional[Dict[str, Callable]] = None,
+    ):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.routes = routes or {}
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._prometheus)
+        app.router.add_get("/metrics.json", self._json)
+        for path, handler in self.routes.items():
+            app.router.add_get(path, handler)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info("Serving metrics on http://{}:{}/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _prometheus(self, request: web.Request):
+        return web.Response(
+            text=self.metrics.render_prometheus(),
+            content_type="text/plain",
+            charset="utf-8",
+        )
+
+    async def _json(self, request: web.Request):
+        return web.json_response(self.metrics.snapshot())
@@ -0,0 +1,108 @@
+"""Module manifests and the startup report of `KookBotX.load_modules`.
+
+A module folder may contain a `manifest.kbx.json`:
+
+```json
+{
+    "lazy": true,
+    "commands": ["kbx", "kbx-reset"],
+    "requires": ["gum"]
+}
+```
+
+- `lazy`: do not import the module at startup. Its `commands` (triggered with `/`) are
+  registered as placeholders instead, and the first message triggering one of them
+  imports the module, runs its `init()` and is then handled by the module's own
+  commands. Modules handling every message (`on_message`) or events cannot be lazy.
+- `commands`: the commands the module registers, required for lazy modules.
+- `requires`: modules whose asynchronous `init()` must finish before this module's one
+  starts. The asynchronous parts of `init()` (when it returns a coroutine) of all other
+  modules run concurrently.
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import orjson
+from loguru import logger
+
+MANIFEST_NAME = "manifest.kbx.json"
+
+
+@dataclass
+class ModuleManifest:
+    lazy: bool = False
+    commands: List[str] = field(default_factory=list)
+    requires: List[str] = field(default_factory=list)
+
+
+def read_manifest(module_p: Path) -> ModuleManifest:
+    path = module_p / MANIFEST_NAME if module_p.is_dir() else None
+    if path is None or not path.exists():
+        return ModuleManifest()
+    try:
+        raw = orjson.loads(path.read_bytes())
+        manifest = ModuleManifest(
+            lazy=bool(raw.get("lazy", False)),
+            commands=[str(c) for c in raw.get("commands", [])],
+            requires=[str(r) for r in raw.get("requires", [])],
+        )
+    except Exception as e:
+        logger.warning("Ignoring invalid manifest {}: {}", path, e)
+        return ModuleManifest()
+    if manifest.lazy and not manifest.commands:
+        logger.warning(
+            "Module manifest {} is lazy but declares no commands, loading it at startup",
+            path,
+        )
+        manifest.lazy = False
+    return manifest
+
+
+@dataclass
+class ModuleReport:
+    name: str
+    mode: str  # "eager", "lazy", "library" or "failed"
+    import_seconds: Optional[float] = None
+    init_seconds: Optional[float] = None
+    async_init_seconds: Optional[float] = None
+
+
+def dependency_cycle(requires: Dict[str, List[str]]) -> Optional[List[str]]:
+    """A cycle in `requires` (module -> modules it waits for), or `None`."""
+    state = {}  # 1 while visiting, 2 when done
+
+    def visit(name, path):
+        state[name] = 1
+        for dep in requires.get(name, ()):
+            if state.get(dep) == 1:
+                # `dep` is being visited, so it is on `path`
+                return path[path.index(dep) :] + [dep]
+            if dep in requires and state.get(dep) is None:
+                cycle = visit(dep, path + [dep])
+                if cycle:
+                    return cycle
+        state[name] = 2
+        return None
+
+    for name in requires:
+        if state.get(name) is None:
+            cycle = visit(name, [name])
+            if cycle:
+                return cycle
+    return None
+
+
+def format_report(reports: List[ModuleReport]) -> str:
+    def ms(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+    lines = [
+        f"{'module':<24} {'mode':<8} {'import ms':>10} {'init ms':>10} {'async init ms':>14}"
+    ]
+    for r in reports:
+        lines.append(
+            f"{r.name:<24} {r.mode:<8} {ms(r.import_seconds):>10} {ms(r.init_seconds):>10} {ms(r.async_init_seconds):>14}"
+        )
+    return "\n".join(lines)
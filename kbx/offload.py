@@ -0,0 +1,554 @@
+"""Offload pool: run CPU-bound module work (image rendering, page parsing...) in worker
+processes.
+
+`OffloadPool` keeps warm worker processes that imported the heavy libraries (`preload`)
+once at startup, and runs one function call at a time in each of them. A call that takes
+longer than its timeout gets its worker killed and replaced, so a stuck render cannot
+take the pool down. Modules get the pool of KookBotX as the `offload` argument of their
+`init` (`def init(bot, offload)`), or mark module-level functions with `@offload`:
+
+```python
+@offload(timeout=10)
+def render_card(text: str) -> SharedBuffer:
+    image = Image.new("RGB", (800, 200))
+    ...
+    return SharedBuffer.from_image(image)
+
+async def handler(msg: Message):
+    with await render_card(msg.content) as buffer:
+        image = buffer.to_image()
+```
+
+Arguments and results are pickled through a pipe. Large buffers should travel as
+`SharedBuffer`, which lives in shared memory and is pickled as its name only, so both
+processes use the same memory without copying it. Workers import the module of the
+function they run: keep offloaded functions in a module without side effects at import
+(e.g. `modules/my_module/render.py`, not the `__init__.py` that registers commands).
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import importlib
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Iterable, List, Optional
+
+from loguru import logger
+
+DEFAULT_PRELOAD = (
+    "PIL.Image",
+    "PIL.ImageDraw",
+    "PIL.ImageFont",
+    "numpy",
+    "bs4",
+    "fontTools.ttLib",
+)
+
+
+class OffloadError(Exception):
+    """The worker running an offloaded call died."""
+
+
+class OffloadTimeout(OffloadError, asyncio.TimeoutError):
+    """An offloaded call did not finish in time, its worker was killed."""
+
+
+# ---- Shared memory ----
+
+
+class SharedBuffer:
+    """Bytes in shared memory, passed to and from offloaded functions by name instead of
+    by value. `meta` travels along (image mode and size, array shape and dtype...). The
+    process that creates a buffer passes it on; whoever receives it last unlinks it,
+    e.g. with `with buffer:`."""
+
+    def __init__(self, shm: SharedMemory, size: int, meta: Optional[dict] = None):
+        self.shm = shm
+        self.size = size
+        self.meta = meta or {}
+
+    @classmethod
+    def create(cls, nbytes: int, **meta) -> "SharedBuffer":
+        return cls(SharedMemory(create=True, size=max(1, nbytes)), nbytes, meta)
+
+    @classmethod
+    def from_bytes(cls, data, **meta) -> "SharedBuffer":
+        data = memoryview(data).cast("B")
+        buffer = cls.create(len(data), **meta)
+        buffer.buffer[:] = data
+        return buffer
+
+    @classmethod
+    def from_image(cls, image) -> "SharedBuffer":
+        """A PIL image, as raw pixels packed straight into shared memory, instead of
+        through the `tobytes()` copy of the whole image."""
+        from PIL import Image, ImageFile, ImageMode
+
+        image.load()
+        width, height = image.size
+        if image.mode == "1":
+            row = (width + 7) // 8
+        else:
+            mode = ImageMode.getmode(image.mode)
+            row = width * len(mode.bands) * int(mode.typestr[2:])
+        buffer = cls.create(row * height, mode=image.mode, size=image.size)
+        if not buffer.size:
+            return buffer
+        # What `tobytes()` does, writing each block where it belongs instead of joining
+        # them
+        encoder = Image._getencoder(image.mode, "raw", image.mode)
+        encoder.setimage(image.im, (0, 0) + image.size)
+        target = buffer.buffer
+        offset = 0
+        try:
+            while True:
+                _, errcode, data = encoder.encode(max(ImageFile.MAXBLOCK, width * 4))
+                target[offset : offset + len(data)] = data
+                offset += len(data)
+                if errcode:
+                    break
+            if errcode < 0 or offset != buffer.size:
+                raise ValueError(f"encoder error {errcode}")
+        except ValueError as e:
+            del target
+            buffer.unlink()
+            raise RuntimeError(
+                f"Cannot pack a {image.mode} image into shared memory: {e}"
+            ) from None
+        return buffer
+
+    @classmethod
+    def from_array(cls, array) -> "SharedBuffer":
+        """A numpy array, copied once into shared memory."""
+        import numpy
+
+        buffer = cls.create(array.nbytes, shape=array.shape, dtype=array.dtype.str)
+        numpy.ndarray(array.shape, array.dtype, buffer=buffer.buffer)[...] = array
+        return buffer
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def buffer(self) -> memoryview:
+        return self.shm.buf[: self.size]
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.buffer)
+
+    def to_image(self):
+        """The PIL image of a buffer made by `from_image`, backed by the shared memory
+        until copied."""
+        from PIL import Image
+
+        return Image.frombuffer(
+            self.meta["mode"],
+            tuple(self.meta["size"]),
+            self.buffer,
+            "raw",
+            self.meta["mode"],
+            0,
+            1,
+        )
+
+    def to_array(self):
+        """The numpy array of a buffer made by `from_array`, backed by the shared
+        memory."""
+        import numpy
+
+        return numpy.ndarray(
+            tuple(self.meta["shape"]),
+            numpy.dtype(self.meta["dtype"]),
+            buffer=self.buffer,
+        )
+
+    def __reduce__(self):
+        return _attach, (self.name, self.size, self.meta)
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # An image or array still uses the memory, it is unmapped once they are gone
+            pass
+
+    def unlink(self):
+        self.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> "SharedBuffer":
+        return self
+
+    def __exit__(self, *exc):
+        self.unlink()
+
+
+_attached: List[SharedBuffer] = []  # buffers of the current call, in a worker
+
+
+def _attach(name: str, size: int, meta: dict) -> SharedBuffer:
+    buffer = SharedBuffer(SharedMemory(name=name), size, meta)
+    _attached.append(buffer)
+    return buffer
+
+
+# ---- Workers ----
+
+
+def _worker_main(conn: Connection, preload: Iterable[str]):
+    # KookBotX stops the workers, Ctrl+C in a terminal must not interrupt them halfway
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        try:
+            func, args, kwargs = task
+            func = getattr(func, "__offloaded__", func)
+            reply = ("ok", func(*args, **kwargs))
+        except BaseException as e:
+            reply = ("error", e, traceback.format_exc())
+        try:
+            conn.send(reply)
+        except Exception as e:  # unpicklable result or exception
+            conn.send(
+                (
+                    "error",
+                    RuntimeError(f"Cannot send the result back: {e!r}"),
+                    traceback.format_exc(),
+                )
+            )
+        # The caller owns the buffers it passed, they only need to be unmapped here
+        for buffer in _attached:
+            buffer.close()
+        _attached.clear()
+
+
+class _Worker:
+    def __init__(
+        self, process: multiprocessing.Process, conn: Connection, generation: int
+    ):
+        self.process = process
+        self.conn = conn
+        self.generation = generation
+        self.tasks = 0
+        # The thread reading the result of the current call
+        self.reading: Optional[concurrent.futures.Future] = None
+
+
+class OffloadPool:
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        preload: Iterable[str] = DEFAULT_PRELOAD,
+        timeout: Optional[float] = 60.0,
+        max_tasks_per_worker: Optional[int] = None,
+    ):
+        """`workers` processes (by default one per CPU core but one) that imported
+        `preload`. Calls time out after `timeout` seconds unless told otherwise; workers
+        are replaced after `max_tasks_per_worker` calls, if set, to bound the memory
+        leaked by libraries."""
+        self.size = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.preload = list(preload)
+        self.timeout = timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.context = multiprocessing.get_context("spawn")
+        # Set when a module asked for the pool, KookBotX then starts it with the bot
+        self.used = False
+        self.workers: List[_Worker] = []
+        self._idle: Optional[asyncio.Queue] = None
+        # Threads waiting for the results; cancelled calls hold theirs until the worker
+        # answers
+        self._threads = concurrent.futures.ThreadPoolExecutor(
+            2 * self.size + 1, thread_name_prefix="kbx-offload"
+        )
+        self._starting: Optional[asyncio.Future] = None
+        self._closed = False
+        self.generation = (
+            0  # workers of older generations are replaced as soon as they are idle
+        )
+        self.spawning = 0
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.total_seconds = 0.0
+
+    # ---- Workers ----
+
+    def _spawn(self) -> _Worker:
+        # Workers share the resource tracker of this process, so that the shared memory
+        # they create for their results is not unlinked when they are replaced
+        resource_tracker.ensure_running()
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(child_conn, self.preload),
+            name="kbx-offload",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        return _Worker(process, conn, self.generation)
+
+    def _add_worker(self) -> asyncio.Future:
+        # Counted as spawning right away, so that calls wait for the worker replacing
+        # the last one instead of failing
+        self.spawning += 1
+        try:
+            worker = self._spawn()
+        except BaseException:
+            self.spawning -= 1
+            raise
+        return asyncio.ensure_future(self._wait_ready(worker))
+
+    async def _wait_ready(self, worker: _Worker):
+        try:
+            if self._closed:
+                self._stop_worker(worker)
+                return
+            await asyncio.get_running_loop().run_in_executor(
+                self._threads, worker.conn.recv
+            )
+        except (EOFError, OSError):
+            logger.warning(
+                "An offload worker died while starting (exit code {})",
+                worker.process.exitcode,
+            )
+            return
+        finally:
+            self.spawning -= 1
+        if self._closed:
+            self._stop_worker(worker)
+            return
+        self.workers.append(worker)
+        self._idle.put_nowait(worker)
+
+    async def _kill(self, worker: _Worker):
+        """Kill a busy worker and replace it. Its connection is closed once the thread
+        waiting for its result saw it die, not under that thread."""
+        worker.process.kill()
+        await self._join_reading(worker)
+        self._replace(worker)
+
+    @staticmethod
+    async def _join_reading(worker: _Worker, timeout: float = 5.0):
+        if worker.reading is None or worker.reading.done():
+            return
+        done, _ = await asyncio.to_thread(
+            concurrent.futures.wait, [worker.reading], timeout
+        )
+        if not done:
+            logger.warning(
+                "The result of an offload worker was still being read {}s after it"
+                " stopped",
+                timeout,
+            )
+
+    def _replace(self, worker: _Worker):
+        self._stop_worker(worker, kill=True)
+        if worker in self.workers:
+            self.workers.remove(worker)
+        if not self._closed:
+            self.restarts += 1
+            self._add_worker()
+
+    @staticmethod
+    def _stop_worker(worker: _Worker, kill: bool = False):
+        if kill:
+            worker.process.kill()
+        else:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        worker.conn.close()
+
+    async def start(self):
+        """Start the workers and wait until they are ready. Called on first use
+        otherwise."""
+        if self._starting is None:
+            self._idle = asyncio.Queue()
+            self._starting = asyncio.ensure_future(self._start())
+        await asyncio.shield(self._starting)
+
+    async def _start(self):
+        start = time.perf_counter()
+        await asyncio.gather(*(self._add_worker() for _ in range(self.size)))
+        logger.info(
+            "Started {} offload workers in {:.0f}ms (preloaded {})",
+            len(self.workers),
+            (time.perf_counter() - start) * 1000,
+            ", ".join(self.preload) or "nothing",
+        )
+
+    def recycle(self):
+        """Replace every worker, e.g. after a module was reloaded: workers keep the code
+        they imported."""
+        self.generation += 1
+        while self._idle is not None and not self._idle.empty():
+            self._replace(self._idle.get_nowait())
+
+    async def close(self, timeout: float = 5.0):
+        self._closed = True
+        workers, self.workers = self.workers, []
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in workers:
+            await asyncio.to_thread(worker.process.join, timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+            # Busy workers answer their call before stopping
+            await self._join_reading(worker)
+            worker.conn.close()
+        self._threads.shutdown(wait=False)
+
+    # ---- Calls ----
+
+    async def run(
+        self, func: Callable, *args, timeout: Optional[float] = None, **kwargs
+    ):
+        """Await `func(*args, **kwargs)` run in a worker. `func` must be importable by
+        the worker (defined at the top level of a module). Raises what `func` raised,
+        `OffloadTimeout` after `timeout` seconds (the pool's by default) and
+        `OffloadError` if the worker died."""
+        if self._closed:
+            raise OffloadError("The offload pool is closed")
+        await self.start()
+        if not self.workers and not self.spawning:
+            raise OffloadError("No offload worker could be started")
+        timeout = self.timeout if timeout is None else timeout
+        self.waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        start = time.perf_counter()
+        try:
+            worker.conn.send((func, args, kwargs))
+        except Exception:
+            self.running -= 1
+            self._idle.put_nowait(worker)
+            raise
+        result = worker.reading = self._threads.submit(worker.conn.recv)
+        try:
+            reply = await asyncio.wait_for(asyncio.wrap_future(result), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            asyncio.ensure_future(self._kill(worker))
+            raise OffloadTimeout(
+                f"{_name_of(func)} did not finish in {timeout}s, its worker was killed"
+            )
+        except asyncio.CancelledError:
+            # The worker is still busy with the call, it is free again once the result
+            # is read
+            loop = asyncio.get_running_loop()
+            result.add_done_callback(
+                lambda _: loop.call_soon_threadsafe(self._release, worker, result)
+            )
+            raise
+        except (EOFError, OSError):
+            self.failed += 1
+            self._replace(worker)
+            raise OffloadError(
+                f"The worker running {_name_of(func)} died (exit code {worker.process.exitcode})"
+            )
+        finally:
+            self.running -= 1
+            self.total_seconds += time.perf_counter() - start
+        self._release(worker, result)
+        if reply[0] == "ok":
+            self.completed += 1
+            return reply[1]
+        self.failed += 1
+        logger.debug("Offloaded {} failed in its worker:\n{}", _name_of(func), reply[2])
+        raise reply[1]
+
+    def _release(self, worker: _Worker, result: concurrent.futures.Future):
+        worker.reading = None
+        worker.tasks += 1
+        if result.exception() is not None:
+            self._replace(worker)
+        elif (
+            self.max_tasks_per_worker is not None
+            and worker.tasks >= self.max_tasks_per_worker
+        ):
+            self._replace(worker)
+        elif worker.generation != self.generation:
+            self._replace(worker)
+        elif not self._closed:
+            self._idle.put_nowait(worker)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self.workers),
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+            "total_seconds": self.total_seconds,
+        }
+
+
+def _name_of(func: Callable) -> str:
+    return getattr(func, "__qualname__", repr(func))
+
+
+# ---- Decorator ----
+
+_default_pool: Optional[OffloadPool] = None
+
+
+def set_default_pool(pool: Optional[OffloadPool]):
+    """The pool `@offload` functions run in, KookBotX sets its own."""
+    global _default_pool
+    _default_pool = pool
+
+
+def offload(func: Optional[Callable] = None, *, timeout: Optional[float] = None):
+    """Make a module-level function run in the offload pool: calling it returns an
+    awaitable of its result. Without a pool (outside of KookBotX), it runs in a thread
+    instead."""
+
+    def decorate(func: Callable):
+        @functools.wraps(func)
+        def offloaded(*args, **kwargs):
+            if _default_pool is None:
+                return asyncio.to_thread(func, *args, **kwargs)
+            return _default_pool.run(offloaded, *args, timeout=timeout, **kwargs)
+
+        # Workers import `offloaded` by name, and run this
+        offloaded.__offloaded__ = func
+        if _default_pool is not None:
+            _default_pool.used = True
+        return offloaded
+
+    return decorate(func) if func is not None else decorate
@@ -0,0 +1,163 @@
+"""Hot reload of modules: find which modules changed on disk, and take a module's
+handlers off a bot.
+
+`ModuleWatcher` polls the files of every module folder (or singleton `.py` file) and
+reports a module once its files changed and then stayed unchanged for one more poll, so
+that a deploy writing many files triggers a single reload. `unregister_module` removes
+the commands, `on_message` and `on_event` handlers a module registered, telling them
+apart by the module their handler functions were defined in. `KookBotX.reload_module`
+puts both together.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from khl import Bot
+from loguru import logger
+
+
+def owned_by(handler: Callable, module_name: str) -> bool:
+    """Whether `handler` was defined in module `module_name` or one of its submodules."""
+    owner = getattr(handler, "__module__", None) or ""
+    return owner == module_name or owner.startswith(module_name + ".")
+
+
+def unregister_module(bot: Bot, module_name: str) -> int:
+    """Remove the commands and handlers of `module_name` from `bot`, returning how many
+    were removed."""
+    removed = 0
+    for name, cmd in list(bot.command.items()):
+        if owned_by(cmd.handler, module_name):
+            bot.command.pop(name)
+            removed += 1
+    # The same message handler is registered for every message type
+    handler_lists = list(bot.client._handler_map.values()) + list(
+        bot._event_index.values()
+    )
+    seen = set()
+    for handlers in handler_lists:
+        for handler in [h for h in handlers if owned_by(h, module_name)]:
+            handlers.remove(handler)
+            if id(handler) not in seen:
+                seen.add(id(handler))
+                removed += 1
+    return removed
+
+
+def purge_module(module_name: str) -> Dict[str, object]:
+    """Take `module_name` and its submodules out of `sys.modules` so the next import
+    runs the code afresh, returning them so they can be put back."""
+    purged = {}
+    for name in list(sys.modules):
+        if name == module_name or name.startswith(module_name + "."):
+            purged[name] = sys.modules.pop(name)
+    return purged
+
+
+def module_signature(module_p: Path) -> Tuple:
+    """Paths, sizes and modification times of the files of a module."""
+    if module_p.is_file():
+        stat = module_p.stat()
+        return ((module_p.name, stat.st_size, stat.st_mtime_ns),)
+    files = []
+    for root, dirs, names in os.walk(module_p):
+        dirs[:] = sorted(
+            d for d in dirs if d != "__pycache__" and not d.startswith(".")
+        )
+        for name in sorted(names):
+            if name.endswith((".py", ".json")):
+                path = Path(root) / name
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:  # removed while walking
+                    continue
+                files.append(
+                    (str(path.relative_to(module_p)), stat.st_size, stat.st_mtime_ns)
+                )
+    return tuple(files)
+
+
+class ModuleWatcher:
+    """Calls `on_change(module_name)` for each module in `modules` (name -> path) whose
+    files changed."""
+
+    def __init__(
+        self,
+        modules: Dict[str, Path],
+        on_change: Callable[[str], Awaitable],
+        interval: float = 1.0,
+    ):
+        self.modules = dict(modules)
+        self.on_change = on_change
+        self.interval = interval
+        self.signatures: Dict[str, Tuple] = {}
+        self.changing: Dict[str, Tuple] = (
+            {}
+        )  # module name -> signature seen at the last poll
+        self._task: Optional[asyncio.Task] = None
+
+    def _scan(self) -> Dict[str, Tuple]:
+        signatures = {}
+        for name, path in self.modules.items():
+            try:
+                signatures[name] = module_signature(path)
+            except FileNotFoundError:
+                signatures[name] = ()
+        return signatures
+
+    async def snapshot(self):
+        """Take the current files as unchanged."""
+        self.signatures = await asyncio.to_thread(self._scan)
+        self.changing = {}
+
+    async def poll(self, settle: bool = True) -> List[str]:
+        """Modules whose files changed since the last reload. With `settle`, a change is
+        only reported once a poll found the files as they were at the previous one."""
+        current = await asyncio.to_thread(self._scan)
+        changed = []
+        for name, signature in current.items():
+            if signature == self.signatures.get(name):
+                self.changing.pop(name, None)
+                continue
+            if settle and self.changing.get(name) != signature:
+                self.changing[name] = signature
+                continue
+            self.changing.pop(name, None)
+            self.signatures[name] = signature
+            changed.append(name)
+        return changed
+
+    async def check(self, settle: bool = True):
+        for name in await self.poll(settle):
+            try:
+                await self.on_change(name)
+            except Exception as e:
+                logger.exception("Cannot reload module {}: {}", name, e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    async def start(self):
+        await self.snapshot()
+        self._task = asyncio.create_task(self._run(), name="kbx-module-watcher")
+        logger.info("Watching {} modules for changes", len(self.modules))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+async def call_hook(hook: Optional[Callable], *args):
+    """Call a module hook (plain or `async`) if the module defines it."""
+    if hook is None:
+        return None
+    ret = hook(*args)
+    if asyncio.iscoroutine(ret):
+        ret = await ret
+    return ret
@@ -0,0 +1,341 @@
+"""Central scheduler for every request the bot sends to the KOOK API.
+
+`ScheduledRequester` replaces khl.py's `HTTPRequester`, so `msg.reply`,
+`msg.add_reaction`, `gate.exec_req` and friends all go through one `OutboundScheduler`:
+
+- each rate limit bucket (the route, or the `X-Rate-Limit-Bucket` KOOK reports for it)
+  is a token bucket, which follows the `X-Rate-Limit-Remaining` / `X-Rate-Limit-Reset`
+  headers and pauses on `429` for `Retry-After`,
+- queued requests are sent by priority: replies first, then other requests, message
+  edits and finally reactions,
+- a queued edit of a message is replaced by a newer edit of the same message, callers of
+  both get the result of the one that was sent,
+- `stats()` reports queue depths and counters.
+"""
+
+import asyncio
+import collections
+import enum
+import time
+from typing import Callable, Dict, Optional, Union
+
+from aiohttp import ClientSession
+from khl import Cert
+from khl.requester import API, HTTPRequester
+from loguru import logger
+
+
+class Priority(enum.IntEnum):
+    REPLY = 0
+    DEFAULT = 1
+    EDIT = 2
+    REACTION = 3
+
+
+ROUTE_PRIORITIES = {
+    "message/create": Priority.REPLY,
+    "direct-message/create": Priority.REPLY,
+    "message/update": Priority.EDIT,
+    "direct-message/update": Priority.EDIT,
+    "message/add-reaction": Priority.REACTION,
+    "message/delete-reaction": Priority.REACTION,
+    "direct-message/add-reaction": Priority.REACTION,
+    "direct-message/delete-reaction": Priority.REACTION,
+}
+
+# Routes whose requests fully replace the previous one for the same message
+COALESCED_ROUTES = {"message/update", "direct-message/update"}
+
+
+class RateLimited(Exception):
+    """Raised by a send function when KOOK answered 429, the request is queued again
+    after `retry_after`."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a request may be sent, 0 if it may be sent now."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def limit(self, tokens: float, now: float):
+        self._refill(now)
+        self.tokens = min(self.tokens, tokens)
+
+    def pause(self, seconds: float, now: float):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class _Job:
+    __slots__ = (
+        "method",
+        "route",
+        "params",
+        "send",
+        "priority",
+        "key",
+        "futures",
+        "attempts",
+    )
+
+    def __init__(self, method, route, params, send, priority, key):
+        self.method = method
+        self.route = route
+        self.params = params
+        self.send = send
+        self.priority = priority
+        self.key = key
+        self.futures = []
+        self.attempts = 0
+
+
+class OutboundScheduler:
+    def __init__(
+        self,
+        rate: float = 5.0,
+        burst: float = 10.0,
+        max_in_flight: int = 16,
+        max_retries: int = 3,
+    ):
+        """`rate` and `burst` size the token bucket of every rate limit bucket until
+        KOOK's headers tell better; at most `max_in_flight` requests are awaiting a
+        response at any time."""
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.queues = {priority: collections.deque() for priority in Priority}
+        self.pending_by_key: Dict[tuple, _Job] = {}
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.route_buckets: Dict[str, str] = {}
+        self.in_flight = 0
+        self.in_flight_keys = set()
+        self.counters = collections.Counter()
+        self.max_queue_depth = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def bucket_of(self, route: str) -> TokenBucket:
+        name = self.route_buckets.get(route, route)
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def observe(self, route: str, headers):
+        """Learn from the rate limit headers of a response to `route`."""
+        if "X-Rate-Limit-Bucket" not in headers:
+            return
+        name = headers["X-Rate-Limit-Bucket"].lower()
+        if self.route_buckets.get(route) != name:
+            self.route_buckets[route] = name
+        bucket = self.bucket_of(route)
+        remaining = int(headers.get("X-Rate-Limit-Remaining", 1))
+        reset = float(headers.get("X-Rate-Limit-Reset", 0))
+        now = time.monotonic()
+        if remaining <= 0 and reset > 0:
+            bucket.pause(reset, now)
+        elif reset > 0:
+            # Never plan to send more than what is left of the window
+            bucket.limit(remaining, now)
+
+    async def submit(
+        self,
+        method: str,
+        route: str,
+        params: dict,
+        send: Callable,
+        priority: Optional[Priority] = None,
+    ):
+        """Queue `send(method, route, params)` and return its result once it was sent."""
+        if priority is None:
+            priority = ROUTE_PRIORITIES.get(route, Priority.DEFAULT)
+        key = None
+        if route in COALESCED_ROUTES:
+            msg_id = params.get("json", {}).get("msg_id")
+            if msg_id is not None:
+                key = (route, msg_id)
+        future = asyncio.get_running_loop().create_future()
+        job = self.pending_by_key.get(key) if key is not None else None
+        if job is not None:
+            # Not sent yet, the newer content replaces it
+            job.params = params
+            job.send = send
+            self.counters["coalesced"] += 1
+        else:
+            job = _Job(method, route, params, send, priority, key)
+            if key is not None:
+                self.pending_by_key[key] = job
+            self.queues[priority].append(job)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+        job.futures.append(future)
+        self.counters["submitted"] += 1
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        return await future
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _next_job(self, now: float):
+        """The highest priority job whose bucket allows sending now, or the time to wait
+        for one."""
+        wait = None
+        for priority in Priority:
+            queue = self.queues[priority]
+            for i, job in enumerate(queue):
+                if job.key in self.in_flight_keys:
+                    # Edits of one message are sent one at a time, so they cannot arrive
+                    # out of order
+                    continue
+                delay = self.bucket_of(job.route).delay(now)
+                if delay == 0:
+                    del queue[i]
+                    return job, None
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _dispatch(self):
+        while self.queue_depth() or self.in_flight:
+            self._wakeup.clear()
+            job, wait = (None, None)
+            if self.in_flight < self.max_in_flight:
+                job, wait = self._next_job(time.monotonic())
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if job.key is not None:
+                del self.pending_by_key[job.key]
+                self.in_flight_keys.add(job.key)
+            self.bucket_of(job.route).take(time.monotonic())
+            self.in_flight += 1
+            asyncio.create_task(self._run(job))
+
+    async def _run(self, job: _Job):
+        try:
+            result = await job.send(job.method, job.route, job.params)
+        except RateLimited as e:
+            self.counters["rate_limited"] += 1
+            self.bucket_of(job.route).pause(e.retry_after, time.monotonic())
+            job.attempts += 1
+            if job.attempts <= self.max_retries:
+                self._requeue(job)
+                return
+            self._settle(job, error=e)
+        except Exception as e:
+            self.counters["failed"] += 1
+            self._settle(job, error=e)
+        else:
+            self.counters["sent"] += 1
+            self._settle(job, result=result)
+        finally:
+            self.in_flight -= 1
+            self.in_flight_keys.discard(job.key)
+            self._wakeup.set()
+
+    def _requeue(self, job: _Job):
+        newer = self.pending_by_key.get(job.key) if job.key is not None else None
+        if newer is not None:
+            # A newer edit of the same message is already queued, it supersedes this one
+            newer.futures.extend(job.futures)
+            return
+        if job.key is not None:
+            self.pending_by_key[job.key] = job
+        self.queues[job.priority].appendleft(job)
+
+    @staticmethod
+    def _settle(job: _Job, result=None, error: Optional[Exception] = None):
+        for future in job.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue_depth(),
+            "queued_by_priority": {
+                p.name.lower(): len(q) for p, q in self.queues.items()
+            },
+            "max_queue_depth": self.max_queue_depth,
+            "in_flight": self.in_flight,
+            "paused_buckets": sorted(
+                name
+                for name, bucket in self.buckets.items()
+                if bucket.paused_until > time.monotonic()
+            ),
+            **self.counters,
+        }
+
+
+class ScheduledRequester(HTTPRequester):
+    """`HTTPRequester` that sends through an `OutboundScheduler` instead of khl.py's
+    `RateLimiter`."""
+
+    def __init__(self, cert: Cert, scheduler: OutboundScheduler):
+        super().__init__(cert, None)
+        self.scheduler = scheduler
+
+    async def request(
+        self, method: str, route: str, **params
+    ) -> Union[dict, list, bytes]:
+        return await self.scheduler.submit(method, route, params, self._send)
+
+    async def _send(self, method: str, route: str, params: dict):
+        # Same as `HTTPRequester.request`, plus rate limit feedback for the scheduler
+        params = dict(params)
+        headers = dict(params.pop("headers", {}))
+        headers["Authorization"] = f"Bot {self._cert.token}"
+        logger.debug("{} {}: req: {}", method, route, params)  # token is excluded
+        if self._cs is None:  # lazy init
+            self._cs = ClientSession()
+        async with self._cs.request(
+            method, f"{API}/{route}", headers=headers, **params
+        ) as res:
+            self.scheduler.observe(route, res.headers)
+            if res.status == 429:
+                retry_after = res.headers.get("Retry-After") or res.headers.get(
+                    "X-Rate-Limit-Reset", "1"
+                )
+                logger.warning(
+                    "KOOK API rate limited {}, retrying in {}s", route, retry_after
+                )
+                raise RateLimited(float(retry_after))
+            if res.content_type == "application/json":
+                rsp = await res.json()
+                if rsp["code"] != 0:
+                    raise HTTPRequester.APIRequestFailed(
+                        method, route, params, rsp["code"], rsp["message"]
+                    )
+                rsp = rsp["data"]
+            else:
+                rsp = await res.read()
+            logger.debug("{} {}: rsp: {}", method, route, rsp)
+            return rsp
@@ -0,0 +1,480 @@
+"""Sharded runtime: one gateway process owns the KOOK websocket, N worker processes run
+the modules.
+
+`ShardedRuntime` receives the packages, hashes each one by guild (or channel,
+`by="channel"`) to a shard and sends it to that shard's worker process over a pipe, in
+batches. Packages of one guild always reach the same worker, in order, so per-guild
+state and card callbacks keep working. Direct messages are hashed by user.
+
+Each worker runs `target(shard_id, shards, link, options)`. `main.run_shard` builds a
+`KookBotX` whose bot reads its packages from `ShardReceiver(link)` and sends its
+requests to KOOK itself.
+
+State shared by all workers stays in the gateway process. `shared` maps a name to the
+`"module:attribute"` of an object, which is imported there on first use. Workers call
+its async methods through `shared(name)`, so every call runs in one place. gum does this
+with `KOOKBOTX_GUM_BACKEND=remote` (see `modules/gum/remote.py`), which the runtime sets
+for its workers.
+"""
+
+import asyncio
+import collections
+import importlib
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import threading
+import zlib
+from multiprocessing.connection import Connection
+from typing import Callable, Dict, List, Optional
+
+from khl.receiver import Receiver
+from loguru import logger
+
+DEFAULT_SHARED = {"gum": "gum:gum"}
+
+
+def shard_key(pkg: dict, by: str = "guild") -> str:
+    """The guild (or channel) a package belongs to, or the user for direct messages."""
+    extra = pkg.get("extra") or {}
+    group = pkg.get("channel_type") == "GROUP"
+    if pkg.get("type") == 255:
+        # System events: button clicks carry the guild and channel of their card in the
+        # body
+        body = extra.get("body") or {}
+        guild = body.get("guild_id") or (pkg.get("target_id") if group else None)
+        channel = body.get("channel_id") or body.get("target_id")
+        user = body.get("user_id")
+    else:
+        guild = extra.get("guild_id")
+        channel = pkg.get("target_id") if group else None
+        user = pkg.get("author_id")
+    key = guild if by == "guild" else channel
+    return str(key or guild or channel or user or "")
+
+
+def shard_of(key: str, shards: int) -> int:
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(key.encode()) % shards
+
+
+# ---- Worker side ----
+
+
+class ShardLink:
+    """The worker end of the pipe to the gateway: receives packages, and calls shared
+    objects."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.packages: Optional[asyncio.Queue] = None
+        self.early_packages = []  # received before the bot started
+        self.on_stop: Optional[Callable[[], None]] = None
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._reader: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start receiving from the gateway, on the running loop."""
+        self.loop = asyncio.get_running_loop()
+        self._reader = threading.Thread(
+            target=self._read, name="kbx-shard-link", daemon=True
+        )
+        self._reader.start()
+
+    def attach(self, packages: asyncio.Queue):
+        """Put the packages from the gateway into `packages` from now on."""
+        self.packages = packages
+        for pkg in self.early_packages:
+            packages.put_nowait(pkg)
+        self.early_packages = []
+
+    def _read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                message = ("stop",)
+            self.loop.call_soon_threadsafe(self._handle, message)
+            if message[0] == "stop":
+                return
+
+    def _handle(self, message: tuple):
+        kind = message[0]
+        if kind == "events":
+            if self.packages is None:
+                self.early_packages.extend(message[1])
+                return
+            for pkg in message[1]:
+                self.packages.put_nowait(pkg)
+        elif kind == "result":
+            _, call_id, ok, value = message
+            future = self._calls.pop(call_id, None)
+            if future is not None and not future.done():
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        elif kind == "stop":
+            for future in self._calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("The gateway process stopped"))
+            self._calls.clear()
+            if self.on_stop is not None:
+                self.on_stop()
+
+    def send(self, message: tuple):
+        with self._send_lock:
+            self.conn.send(message)
+
+    async def call(self, target: str, method: str, *args, **kwargs):
+        """Await `method(*args, **kwargs)` of the shared object `target` in the gateway
+        process."""
+        call_id = next(self._ids)
+        future = self._calls[call_id] = asyncio.get_running_loop().create_future()
+        try:
+            self.send(("call", call_id, target, method, args, kwargs))
+        except (OSError, ValueError) as e:
+            self._calls.pop(call_id, None)
+            raise ConnectionError("The gateway process is gone") from e
+        return await future
+
+
+class SharedProxy:
+    """Calls the async methods of a shared object of the gateway process."""
+
+    def __init__(self, link: ShardLink, name: str):
+        self._link = link
+        self._name = name
+
+    def __getattr__(self, method: str):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            return await self._link.call(self._name, method, *args, **kwargs)
+
+        call.__name__ = method
+        return call
+
+
+_link: Optional[ShardLink] = None
+
+
+def shared(name: str) -> SharedProxy:
+    """Proxy of the shared object `name`, only available in a worker of the sharded
+    runtime."""
+    if _link is None:
+        raise RuntimeError(
+            f"{name} is shared by the sharded runtime, but this process is not one of its workers"
+        )
+    return SharedProxy(_link, name)
+
+
+class ShardReceiver(Receiver):
+    """Receiver of a worker bot, putting the packages its gateway sends into the bot's
+    queue."""
+
+    def __init__(self, link: ShardLink):
+        super().__init__()
+        self.link = link
+
+    @property
+    def type(self) -> str:
+        return "shard"
+
+    async def start(self):
+        self.link.attach(self.pkg_queue)
+        # Like the websocket receiver, never returns
+        await asyncio.Event().wait()
+
+
+def _worker_main(
+    target: Callable, shard_id: int, shards: int, conn: Connection, options: dict
+):
+    global _link
+    # The gateway stops the workers, Ctrl+C in a terminal must not interrupt them
+    # halfway
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ.update(options.get("env", {}))
+    _link = ShardLink(conn)
+
+    async def main():
+        # Modules may call shared objects from their init()
+        _link.start()
+        await target(shard_id, shards, _link, options)
+
+    asyncio.run(main())
+
+
+# ---- Gateway side ----
+
+
+class _Shard:
+    def __init__(self, shard_id: int):
+        self.shard_id = shard_id
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn: Optional[Connection] = None
+        self.outbox: "queue.SimpleQueue[Optional[tuple]]" = queue.SimpleQueue()
+        self.pending = 0  # packages in `outbox`
+        self.pending_lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        self.restarts = 0
+
+
+class ShardedRuntime:
+    def __init__(
+        self,
+        target: Callable,
+        shards: int,
+        receiver: Receiver,
+        by: str = "guild",
+        options: Optional[dict] = None,
+        shared: Optional[Dict[str, str]] = None,
+        recorder=None,
+        max_pending: int = 10000,
+        batch_size: int = 256,
+    ):
+        """Run `target` in `shards` worker processes and send them the packages from
+        `receiver`. At most `max_pending` packages wait for a worker, newer ones are
+        dropped (and counted) while it is busy or restarting. `recorder` (an
+        `EventRecorder`) records every package received."""
+        if by not in ("guild", "channel"):
+            raise ValueError(f"Unknown shard key {by}, expected guild or channel")
+        self.target = target
+        self.receiver = receiver
+        self.by = by
+        self.options = options or {}
+        self.shared_paths = DEFAULT_SHARED if shared is None else shared
+        self.shared_objects: Dict[str, object] = {}
+        self.recorder = recorder
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.shards = [_Shard(i) for i in range(shards)]
+        self.context = multiprocessing.get_context("spawn")
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.received = 0
+        self._stopping = False
+        self._tasks: List[asyncio.Task] = []
+
+    # ---- Workers ----
+
+    def _worker_options(self, shard: _Shard) -> dict:
+        env = dict(self.options.get("env", {}))
+        if "gum" in self.shared_paths:
+            env["KOOKBOTX_GUM_BACKEND"] = "remote"
+        if os.environ.get("KOOKBOTX_METRICS_PORT"):
+            # One metrics endpoint per worker, on consecutive ports
+            env["KOOKBOTX_METRICS_PORT"] = str(
+                int(os.environ["KOOKBOTX_METRICS_PORT"]) + shard.shard_id
+            )
+        return {**self.options, "env": env}
+
+    def _start_worker(self, shard: _Shard):
+        conn, child_conn = self.context.Pipe()
+        shard.conn = conn
+        shard.process = self.context.Process(
+            target=_worker_main,
+            args=(
+                self.target,
+                shard.shard_id,
+                len(self.shards),
+                child_conn,
+                self._worker_options(shard),
+            ),
+            name=f"kbx-shard-{shard.shard_id}",
+            daemon=True,
+        )
+        shard.process.start()
+        child_conn.close()
+        threading.Thread(
+            target=self._send_loop, args=(shard, conn), daemon=True
+        ).start()
+        threading.Thread(
+            target=self._read_loop, args=(shard, conn), daemon=True
+        ).start()
+        logger.info("Started shard {} (pid {})", shard.shard_id, shard.process.pid)
+
+    def _send_loop(self, shard: _Shard, conn: Connection):
+        while True:
+            message = shard.outbox.get()
+            if message is None:
+                return
+            try:
+                conn.send(message)
+            except (OSError, ValueError):
+                return  # the worker is gone, `_supervise` restarts it
+            if message[0] == "events":
+                with shard.pending_lock:
+                    shard.pending -= len(message[1])
+                shard.sent += len(message[1])
+            elif message[0] == "stop":
+                return
+
+    def _read_loop(self, shard: _Shard, conn: Connection):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            if message[0] == "call":
+                self.loop.call_soon_threadsafe(self._serve_call, shard, conn, message)
+
+    def _serve_call(self, shard: _Shard, conn: Connection, message: tuple):
+        async def serve():
+            _, call_id, target, method, args, kwargs = message
+            try:
+                if method.startswith("_"):
+                    raise AttributeError(f"{method} of {target} is private")
+                ret = getattr(self._shared_object(target), method)(*args, **kwargs)
+                if asyncio.iscoroutine(ret):
+                    ret = await ret
+                reply = ("result", call_id, True, ret)
+            except Exception as e:
+                reply = ("result", call_id, False, e)
+            try:
+                pickle.dumps(reply)
+            except Exception:
+                reply = ("result", call_id, False, RuntimeError(repr(reply[3])))
+            if shard.conn is conn:  # not restarted meanwhile
+                shard.outbox.put(reply)
+
+        asyncio.ensure_future(serve())
+
+    def _shared_object(self, name: str):
+        obj = self.shared_objects.get(name)
+        if obj is None:
+            if name not in self.shared_paths:
+                raise KeyError(f"No shared object named {name}")
+            module_name, attribute = self.shared_paths[name].split(":")
+            obj = self.shared_objects[name] = getattr(
+                importlib.import_module(module_name), attribute
+            )
+        return obj
+
+    async def _supervise(self):
+        while not self._stopping:
+            await asyncio.sleep(1.0)
+            for shard in self.shards:
+                if self._stopping or shard.process.is_alive():
+                    continue
+                logger.warning(
+                    "Shard {} exited with code {}, restarting it",
+                    shard.shard_id,
+                    shard.process.exitcode,
+                )
+                shard.outbox.put(None)
+                shard.outbox = queue.SimpleQueue()
+                with shard.pending_lock:
+                    shard.dropped += shard.pending
+                    shard.pending = 0
+                shard.restarts += 1
+                self._start_worker(shard)
+
+    # ---- Packages ----
+
+    def _route(self, pkg: dict) -> int:
+        return shard_of(shard_key(pkg, self.by), len(self.shards))
+
+    async def _pump(self, packages: asyncio.Queue):
+        while True:
+            batches = collections.defaultdict(list)
+            pkg = await packages.get()
+            while True:
+                self.received += 1
+                if self.recorder is not None:
+                    self.recorder.record(pkg)
+                batches[self._route(pkg)].append(pkg)
+                if packages.empty() or self.received % self.batch_size == 0:
+                    break
+                pkg = packages.get_nowait()
+            for shard_id, pkgs in batches.items():
+                shard = self.shards[shard_id]
+                with shard.pending_lock:
+                    room = self.max_pending - shard.pending
+                    if room < len(pkgs):
+                        shard.dropped += len(pkgs) - max(room, 0)
+                        pkgs = pkgs[: max(room, 0)]
+                    shard.pending += len(pkgs)
+                if pkgs:
+                    shard.outbox.put(("events", pkgs))
+
+    # ---- Lifecycle ----
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        logger.success(
+            "KookBotX gateway is starting {} shards by {}", len(self.shards), self.by
+        )
+        for shard in self.shards:
+            self._start_worker(shard)
+        packages = asyncio.Queue()
+        self.receiver.loop = self.loop
+        self.receiver.pkg_queue = packages
+        self._tasks = [
+            asyncio.ensure_future(self.receiver.start()),
+            asyncio.ensure_future(self._pump(packages)),
+            asyncio.ensure_future(self._supervise()),
+        ]
+
+    async def run(self):
+        """Start, and run until the receiver or pump fails or the task is cancelled."""
+        await self.start()
+        try:
+            await asyncio.wait(self._tasks[:2], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            await self.stop()
+
+    async def stop(self, timeout: float = 10.0):
+        if self._stopping:
+            return
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        for shard in self.shards:
+            shard.outbox.put(("stop",))
+        for shard in self.shards:
+            await asyncio.to_thread(shard.process.join, timeout)
+            if shard.process.is_alive():
+                logger.warning(
+                    "Shard {} did not stop in {}s, terminating it",
+                    shard.shard_id,
+                    timeout,
+                )
+                shard.process.terminate()
+        for name in self.shared_objects:
+            module = importlib.import_module(self.shared_paths[name].split(":")[0])
+            teardown = getattr(module, "teardown", None)
+            if teardown is None:
+                continue
+            try:
+                ret = teardown()
+                if asyncio.iscoroutine(ret):
+                    await ret
+            except Exception as e:
+                logger.warning(
+                    "Cannot run teardown() from shared module {}: {}", name, e
+                )
+        if self.recorder is not None:
+            self.recorder.close()
+        logger.info("KookBotX gateway has shut down: {}", self.stats())
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "shards": {
+                shard.shard_id: {
+                    "sent": shard.sent,
+                    "pending": shard.pending,
+                    "dropped": shard.dropped,
+                    "restarts": shard.restarts,
+                }
+                for shard in self.shards
+            },
+        }
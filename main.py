@@ -8,32 +8,141 @@
 
 import asyncio
 import importlib
+import inspect
 import os
+import signal
 import sys
+import time
 from pathlib import Path
 from typing import Optional, Union
 
-from khl import Bot
+from khl import Bot, Cert, Message
+from khl.command import Command
+from khl.gateway import Gateway
+from khl.receiver import Receiver, WebsocketReceiver
 from loguru import logger
 
+from kbx.dispatch import instrument_bot
+from kbx.fake_gateway import (
+    EventRecorder,
+    FakeRequester,
+    ReplayReceiver,
+    stop_after_replay,
+)
+from kbx.log_pipeline import BatchingSink
+from kbx.loop_monitor import LoopMonitor
+from kbx.metrics import Metrics, MetricsServer
+from kbx.offload import OffloadPool, set_default_pool
+from kbx.modules import (
+    ModuleManifest,
+    ModuleReport,
+    dependency_cycle,
+    format_report,
+    read_manifest,
+)
+from kbx.reload import (
+    ModuleWatcher,
+    call_hook,
+    owned_by,
+    purge_module,
+    unregister_module,
+)
+from kbx.scheduler import OutboundScheduler, ScheduledRequester
+from kbx.sharding import ShardedRuntime, ShardLink, ShardReceiver
+
 
 class KookBotX:
 
-    def __init__(self, token: str):
-        self.kookbot = Bot(token=token)
+    def __init__(
+        self,
+        token: str,
+        receiver: Optional[Receiver] = None,
+        fake_api: bool = False,
+        scheduler: Optional[OutboundScheduler] = None,
+        offload_workers: Optional[int] = None,
+    ):
+        # Every outgoing API request is rate limited and prioritized by one scheduler.
+        # `fake_api` answers API requests locally instead of sending them (see
+        # kbx/fake_gateway.py), there is no rate limit to respect then
+        if scheduler is None:
+            scheduler = (
+                OutboundScheduler(rate=1e6, burst=1e6)
+                if fake_api
+                else OutboundScheduler()
+            )
+        self.scheduler = scheduler
+        cert = Cert(token=token)
+        out = (
+            FakeRequester(self.scheduler, token)
+            if fake_api
+            else ScheduledRequester(cert, self.scheduler)
+        )
+        if receiver is None:
+            self.kookbot = Bot(cert=cert, out=out)
+        else:
+            # Packages come from `receiver` instead of KOOK's websocket (a shard, a
+            # replay)
+            self.kookbot = Bot(cert=cert, gate=Gateway(out, receiver))
+        # Commands are dispatched through a trie, and every handler is timed
+        self.metrics = Metrics()
+        instrument_bot(self.kookbot, self.metrics)
+        self.metrics.add_source("scheduler", self.scheduler.stats)
+        self.metrics_server = None
+        # Measures event loop lag and logs callbacks blocking the loop, with their stack
+        self.loop_monitor = LoopMonitor(profile_dir=Path(__file__).parent / "logs")
+        self.metrics.add_source("loop", self.loop_monitor.stats)
+        # Worker processes for CPU-bound module work, started with the bot once a module
+        # uses them. Modules get the pool as the `offload` argument of init(), or use
+        # the `@offload` decorator, see kbx/offload.py
+        if offload_workers is None and os.environ.get("KOOKBOTX_OFFLOAD_WORKERS"):
+            offload_workers = int(os.environ["KOOKBOTX_OFFLOAD_WORKERS"])
+        self.offload = OffloadPool(workers=offload_workers)
+        set_default_pool(self.offload)
+        self.metrics.add_source("offload", self.offload.stats)
+        self.modules = {}
+        self.manifests = {}
+        self.module_paths = {}
+        self.pending_inits = {}  # module name -> awaitable returned by its init()
+        self.lazy_commands = {}  # lazy module name -> its commands, once loaded
+        self.startup_report = []
+        self.library_module_names = []
+        self.reload_lock = asyncio.Lock()
+        self.module_watcher = None
+        self.is_shut_down = False
+        self.log_sink = None
 
-    def configure_logger(self, log_path: Optional[Union[str, Path]] = None):
-        # Configure logger, you may change the log file path and rotation settings as you like
+    def configure_logger(
+        self,
+        log_path: Optional[Union[str, Path]] = None,
+        fmt: Optional[str] = None,
+        compress: Optional[bool] = None,
+        name: str = "kookbotx",
+    ):
+        # Configure logger, you may change the log file path and rotation settings as
+        # you like. Log files are written in batches by a background thread, so logging
+        # never blocks the event loop. `fmt` is "text" or "jsonl" (KOOKBOTX_LOG_FORMAT),
+        # finished daily segments are gzipped with `compress` (KOOKBOTX_LOG_COMPRESS=1)
         log_path = (
             Path(log_path) if log_path is not None else (Path(__file__).parent / "logs")
         )
         log_path.mkdir(parents=True, exist_ok=True)
-        logger.add(
-            "logs/kookbotx.log",
-            retention="4 weeks",
-            rotation="1 month",
+        self.log_sink = BatchingSink(
+            log_path,
+            name=name,
+            fmt=fmt or os.environ.get("KOOKBOTX_LOG_FORMAT", "text"),
+            compress=(
+                compress
+                if compress is not None
+                else os.environ.get("KOOKBOTX_LOG_COMPRESS") == "1"
+            ),
+            retention=4 * 7 * 24 * 3600,
+        )
+        self.log_handler_id = logger.add(
+            self.log_sink,
+            format=self.log_sink.format,
             level="DEBUG" if os.environ.get("KOOKBOTX_DEBUG") == "1" else "INFO",
         )
+        self.metrics.add_source("log", self.log_sink.stats)
 
     def load_modules(self, module_path: Optional[Union[str, Path]] = None):
         # Load modules
@@ -45,8 +154,10 @@ class KookBotX:
         module_path.mkdir(parents=True, exist_ok=True)
         # Append to sys.path to make sure the modules can be imported
         sys.path.append(str(module_path))
-        # Module could be a singleton .py file, or a folder containing __init__.py and other .py files
-        # For each module, import it via invoking the init() function with bot as argument
+        # Module could be a singleton .py file, or a folder containing __init__.py and
+        # other .py files
+        # For each module, import it via invoking the init() function with bot as
+        # argument
         bot = self.kookbot
         for module_p in module_path.glob("*"):
             if module_p.is_file() and module_p.suffix == ".py":
@@ -67,34 +178,477 @@ class KookBotX:
             # Check if .kbxignore exists
             if (module_p / ".nomodule.kbx").exists():
                 logger.info("Skipping {} (.nomodule.kbx exists)", module_name)
+                # Library modules are imported by other modules, they still get torn
+                # down on shutdown
+                self.library_module_names.append(module_name)
+                self.startup_report.append(ModuleReport(module_name, "library"))
+                continue
+            self.module_paths[module_name] = module_p
+            manifest = read_manifest(module_p)
+            self.manifests[module_name] = manifest
+            if manifest.lazy:
+                # Imported when one of its commands is first used, see kbx/modules.py
+                self._register_lazy(module_name, manifest)
+                self.startup_report.append(ModuleReport(module_name, "lazy"))
+                logger.info("Registered lazy module {} from {}", module_name, module_p)
                 continue
+            report = ModuleReport(module_name, "eager")
+            self.startup_report.append(report)
+            ret = self._import_module(module_name, module_p, report)
+            if report.mode == "failed":
+                continue
+            if inspect.isawaitable(ret):
+                # Awaited concurrently with the other modules' by `initialize_modules`
+                self.pending_inits[module_name] = ret
+            logger.info("Imported module {} from {}", module_name, module_p)
+
+    def _import_module(self, module_name: str, module_p, report: ModuleReport):
+        """Import a module and run its init(), returning what init() returned."""
+        module = self._import(module_name, module_p, report)
+        if module is None:
+            return None
+        return self._run_init(module_name, module_p, module, report)
+
+    def _import(self, module_name: str, module_p, report: ModuleReport):
+        # Safe to run in a worker thread, see `_load_lazy`
+        start = time.perf_counter()
+        try:
+            module = importlib.import_module(module_name)
+        except Exception as e:
+            logger.warning(
+                "Failed to import module {} ({}): {}", module_name, module_p, e
+            )
+            report.mode = "failed"
+            return None
+        report.import_seconds = time.perf_counter() - start
+        return module
+
+    def _run_init(self, module_name: str, module_p, module, report: ModuleReport):
+        start = time.perf_counter()
+        try:
+            ret = self._init_module(module)
+        except Exception as e:
+            logger.warning(
+                "Cannot run init() from module {} ({}): {}",
+                module_name,
+                module_p,
+                e,
+            )
+            report.mode = "failed"
+            return None
+        report.init_seconds = time.perf_counter() - start
+        self.modules[module_name] = module
+        return ret
+
+    def _init_module(self, module):
+        """Run the init() of a module, with the offload pool if it takes an `offload`
+        argument."""
+        if "offload" in inspect.signature(module.init).parameters:
+            self.offload.used = True
+            return module.init(self.kookbot, offload=self.offload)
+        return module.init(self.kookbot)
+
+    async def initialize_modules(self):
+        # Run the asynchronous part of every module's init() concurrently, except that a
+        # module waits for the modules listed in the `requires` of its manifest
+        requires = {
+            name: [
+                dep
+                for dep in self.manifests[name].requires
+                if dep in self.pending_inits
+            ]
+            for name in self.pending_inits
+        }
+        cycle = dependency_cycle(requires)
+        if cycle is not None:
+            logger.warning(
+                "Module requirements form a cycle ({}), ignoring them",
+                " -> ".join(cycle),
+            )
+            requires = {name: [] for name in requires}
+        reports = {report.name: report for report in self.startup_report}
+        tasks = {}
+
+        async def run(name, awaitable):
+            for dep in requires[name]:
+                await asyncio.wait([tasks[dep]])
+            start = time.perf_counter()
             try:
-                module = importlib.import_module(module_name)
+                await awaitable
             except Exception as e:
-                logger.warning(
-                    "Failed to import module {} ({}): {}", module_name, module_p, e
+                logger.warning("Cannot run init() from module {}: {}", name, e)
+                reports[name].mode = "failed"
+            reports[name].async_init_seconds = time.perf_counter() - start
+
+        for name, awaitable in self.pending_inits.items():
+            tasks[name] = asyncio.ensure_future(run(name, awaitable))
+        self.pending_inits = {}
+        if tasks:
+            await asyncio.gather(*tasks.values())
+        logger.info("Module startup report:\n{}", format_report(self.startup_report))
+
+    def _register_lazy(self, module_name: str, manifest: ModuleManifest):
+        lock = asyncio.Lock()
+        placeholders = []
+
+        async def load_on_first_use(msg: Message, *args):
+            await self._load_lazy(module_name, lock, placeholders, msg)
+
+        for command_name in manifest.commands:
+            placeholders.append(
+                self.kookbot.command.add(
+                    Command.command(command_name)(load_on_first_use)
                 )
-                continue
+            )
+
+    async def _load_lazy(
+        self, module_name: str, lock: asyncio.Lock, placeholders: list, msg: Message
+    ):
+        bot = self.kookbot
+        async with lock:
+            if module_name not in self.lazy_commands:
+                # The module registers its real commands under the same names
+                for placeholder in placeholders:
+                    bot.command.pop(placeholder.name)
+                before = set(bot.command)
+                report = next(r for r in self.startup_report if r.name == module_name)
+                # Importing takes long (llm_api: about a second), the loop keeps serving
+                # other guilds meanwhile. Only init() runs on the loop, as it registers
+                # commands and handlers
+                module = await asyncio.to_thread(
+                    self._import, module_name, module_name, report
+                )
+                ret = None
+                if module is not None:
+                    ret = self._run_init(module_name, module_name, module, report)
+                if inspect.isawaitable(ret):
+                    start = time.perf_counter()
+                    try:
+                        await ret
+                    except Exception as e:
+                        logger.warning(
+                            "Cannot run init() from module {}: {}", module_name, e
+                        )
+                    report.async_init_seconds = time.perf_counter() - start
+                self.lazy_commands[module_name] = [
+                    bot.command[name] for name in bot.command if name not in before
+                ]
+                logger.info(
+                    "Loaded lazy module {} on first use (import {:.0f}ms, init {:.0f}ms)",
+                    module_name,
+                    (report.import_seconds or 0) * 1000,
+                    ((report.init_seconds or 0) + (report.async_init_seconds or 0))
+                    * 1000,
+                )
+        # Hand the message that triggered the loading to the module's own commands
+        for cmd in self.lazy_commands[module_name]:
+            asyncio.ensure_future(cmd.handle(msg, bot.client, {Message: msg, Bot: bot}))
+
+    async def reload_module(self, module_name: str) -> bool:
+        # Reload a module in place: import its new code, hand the state of the running
+        # version over, unregister the running version's commands and handlers and run
+        # the new init(). The running version is kept (or restored) when the new one
+        # cannot be imported or initialized. Modules may define `dump_state()`, called
+        # before teardown(), and `load_state(state)`, called with what it returned after
+        # the new init(). What `dump_state()` returns belongs to the new version, the
+        # teardown() of the running one must leave it open.
+        async with self.reload_lock:
+            return await self._reload_module(module_name)
+
+    async def _reload_module(self, module_name: str) -> bool:
+        bot = self.kookbot
+        if module_name in self.library_module_names:
+            logger.warning(
+                "{} is a library module, restart KookBotX to load its changes",
+                module_name,
+            )
+            return False
+        old = self.modules.get(module_name)
+        if (
+            old is None
+            and module_name in self.manifests
+            and self.manifests[module_name].lazy
+        ):
+            logger.info(
+                "Lazy module {} is not loaded yet, its new code will be used on first use",
+                module_name,
+            )
+            return False
+        start = time.perf_counter()
+        purged = purge_module(module_name)
+        importlib.invalidate_caches()
+        try:
+            new = importlib.import_module(module_name)
+        except Exception as e:
+            purge_module(module_name)
+            sys.modules.update(purged)
+            logger.warning(
+                "Cannot reload module {}, keeping the running version: {}",
+                module_name,
+                e,
+            )
+            return False
+        state = None
+        if old is not None:
             try:
-                _ = module.init(bot)
+                state = await call_hook(getattr(old, "dump_state", None))
+                await call_hook(getattr(old, "teardown", None))
             except Exception as e:
                 logger.warning(
-                    "Cannot run init() from module {} ({}): {}",
-                    module_name,
-                    module_p,
-                    e,
+                    "Cannot hand module {} over to its new version: {}", module_name, e
                 )
-                continue
-            logger.info("Imported module {} from {}", module_name, module_p)
+        removed = unregister_module(bot, module_name)
+        try:
+            await call_hook(self._init_module, new)
+            if state is not None:
+                await call_hook(getattr(new, "load_state", None), state)
+        except Exception as e:
+            unregister_module(bot, module_name)
+            purge_module(module_name)
+            sys.modules.update(purged)
+            if old is None:
+                logger.warning("Cannot run init() from module {}: {}", module_name, e)
+                return False
+            logger.warning(
+                "Cannot run init() from the new version of module {}, restoring the running version: {}",
+                module_name,
+                e,
+            )
+            try:
+                await call_hook(self._init_module, old)
+                if state is not None:
+                    await call_hook(getattr(old, "load_state", None), state)
+            except Exception as e:
+                logger.warning("Cannot restore module {}: {}", module_name, e)
+                self.modules.pop(module_name, None)
+            return False
+        self.modules[module_name] = new
+        # Offload workers run the code they imported first
+        self.offload.recycle()
+        if module_name in self.lazy_commands:
+            self.lazy_commands[module_name] = [
+                cmd
+                for _, cmd in bot.command.items()
+                if owned_by(cmd.handler, module_name)
+            ]
+        logger.success(
+            "Reloaded module {} in {:.1f}ms, replacing {} handlers",
+            module_name,
+            (time.perf_counter() - start) * 1000,
+            removed,
+        )
+        return True
 
     async def start(self):
         assert not hasattr(self, "kookbot_task"), "KookBotX is already running"
         logger.success("KookBotX is starting up!")
+        self.loop_monitor.start()
+        if hasattr(signal, "SIGUSR1"):
+            # `kill -USR1 <pid>` writes a 30 second profile of the event loop to
+            # logs/profile-<time>.folded
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGUSR1,
+                lambda: asyncio.ensure_future(self._profile_loop()),
+            )
+        # Set KOOKBOTX_METRICS_PORT to scrape the metrics from
+        # http://127.0.0.1:<port>/metrics, and profiles from
+        # http://127.0.0.1:<port>/profile?seconds=10
+        if os.environ.get("KOOKBOTX_METRICS_PORT"):
+            self.metrics_server = MetricsServer(
+                self.metrics,
+                port=int(os.environ["KOOKBOTX_METRICS_PORT"]),
+                routes={"/profile": self.loop_monitor.handle_profile_request},
+            )
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.warning("Cannot serve metrics: {}", e)
+                self.metrics_server = None
+        await self.initialize_modules()
+        if self.offload.used:
+            # Warm the workers before the first message needs them
+            await self.offload.start()
+        # Set KOOKBOTX_HOT_RELOAD=1 to reload modules as soon as their files change.
+        # `kill -HUP <pid>` reloads the modules changed since startup (or the last
+        # reload) in any case.
+        self.module_watcher = ModuleWatcher(self.module_paths, self.reload_module)
+        if os.environ.get("KOOKBOTX_HOT_RELOAD") == "1":
+            await self.module_watcher.start()
+        else:
+            await self.module_watcher.snapshot()
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP,
+                lambda: asyncio.ensure_future(self.module_watcher.check(settle=False)),
+            )
         self.kookbot_task = asyncio.create_task(self.kookbot.start())
-        await asyncio.wait([self.kookbot_task])
+        try:
+            await asyncio.wait([self.kookbot_task])
+        finally:
+            await self.shutdown()
+
+    def stop(self):
+        # Makes `start()` return after shutting down
+        if hasattr(self, "kookbot_task"):
+            self.kookbot_task.cancel()
+
+    async def _profile_loop(self):
+        try:
+            await self.loop_monitor.profile()
+        except RuntimeError as e:
+            logger.warning("Cannot profile the event loop: {}", e)
+
+    async def shutdown(self):
+        # Run the optional teardown() of every module, in reverse loading order, then of
+        # library modules that have been imported by them. Safe to call more than once.
+        if self.is_shut_down:
+            return
+        self.is_shut_down = True
+        if self.module_watcher is not None:
+            self.module_watcher.stop()
+        module_names = list(reversed(self.modules)) + [
+            name for name in self.library_module_names if name in sys.modules
+        ]
+        for module_name in module_names:
+            teardown = getattr(sys.modules.get(module_name), "teardown", None)
+            if teardown is None:
+                continue
+            try:
+                ret = teardown()
+                if asyncio.iscoroutine(ret):
+                    await ret
+            except Exception as e:
+                logger.warning(
+                    "Cannot run teardown() from module {}: {}", module_name, e
+                )
+                continue
+            logger.debug("Tore down module {}", module_name)
+        await self.offload.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        self.loop_monitor.stop()
+        logger.info("KookBotX has shut down")
+        if self.log_sink is not None:
+            # Writes out the buffered records
+            logger.remove(self.log_handler_id)
+            self.log_sink = None
+
+
+async def run_shard(shard_id: int, shards: int, link: ShardLink, options: dict):
+    # Runs in each worker process of the sharded runtime, with the packages of its share
+    # of the guilds
+    fake_api = options.get("fake_api", False)
+    kookbotx = KookBotX(
+        options["token"],
+        receiver=ShardReceiver(link),
+        fake_api=fake_api,
+        # Until KOOK's rate limit headers tell better, every worker starts with its
+        # share of the default budget
+        scheduler=(
+            None
+            if fake_api
+            else OutboundScheduler(rate=5.0 / shards, burst=max(1.0, 10.0 / shards))
+        ),
+        # The cores are shared by the offload pools of all workers
+        offload_workers=(
+            None
+            if os.environ.get("KOOKBOTX_OFFLOAD_WORKERS")
+            else max(1, ((os.cpu_count() or 2) - 1) // shards)
+        ),
+    )
+    kookbotx.configure_logger(
+        log_path=options.get("log_path"), name=f"kookbotx-shard{shard_id}"
+    )
+    kookbotx.load_modules(options.get("module_path"))
+    link.on_stop = kookbotx.stop
+    await kookbotx.start()
+
+
+def run_sharded(
+    token: str,
+    shards: int,
+    replay: Optional[str],
+    module_path: Optional[Union[str, Path]] = None,
+    log_path: Optional[Union[str, Path]] = None,
+):
+    # KOOKBOTX_SHARDS=N runs the modules in N worker processes, sharded by guild
+    # (KOOKBOTX_SHARD_BY=channel to shard by channel). KOOKBOTX_RECORD=events.jsonl
+    # records the packages received, KOOKBOTX_REPLAY replays them.
+    log_path = (
+        Path(log_path) if log_path is not None else Path(__file__).parent / "logs"
+    )
+    log_path.mkdir(parents=True, exist_ok=True)
+    log_sink = BatchingSink(
+        log_path, name="kookbotx-gateway", retention=4 * 7 * 24 * 3600
+    )
+    log_handler_id = logger.add(
+        log_sink,
+        format=log_sink.format,
+        level="DEBUG" if os.environ.get("KOOKBOTX_DEBUG") == "1" else "INFO",
+    )
+    # Shared objects (gum) are imported by the gateway
+    sys.path.append(str(Path(__file__).parent / "modules"))
+    receiver = (
+        ReplayReceiver(replay)
+        if replay
+        else WebsocketReceiver(Cert(token=token), compress=True)
+    )
+    runtime = ShardedRuntime(
+        run_shard,
+        shards,
+        receiver,
+        by=os.environ.get("KOOKBOTX_SHARD_BY", "guild"),
+        options={
+            "token": token,
+            "fake_api": bool(replay),
+            "module_path": str(module_path) if module_path is not None else None,
+            "log_path": str(log_path),
+        },
+        recorder=(
+            EventRecorder(os.environ["KOOKBOTX_RECORD"])
+            if os.environ.get("KOOKBOTX_RECORD")
+            else None
+        ),
+    )
+
+    async def run():
+        task = asyncio.ensure_future(runtime.run())
+        if replay:
+            asyncio.ensure_future(stop_after_replay(receiver, task.cancel))
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        logger.info("Interrupted, KookBotX gateway has shut down")
+    finally:
+        logger.remove(log_handler_id)
 
 
 if __name__ == "__main__":
+    # KOOKBOTX_REPLAY=events.jsonl runs on recorded packages with a fake KOOK API, no
+    # token needed
+    replay = os.environ.get("KOOKBOTX_REPLAY")
+    if os.environ.get("KOOKBOTX_SHARDS"):
+        run_sharded(
+            os.environ.get("KOOKBOT_WS_TOKEN", "fake"),
+            int(os.environ["KOOKBOTX_SHARDS"]),
+            replay,
+        )
+        sys.exit(0)
+    if replay:
+        kookbotx = KookBotX("fake", receiver=ReplayReceiver(replay), fake_api=True)
+        kookbotx.configure_logger()
+        kookbotx.load_modules()
+        loop = asyncio.get_event_loop()
+        loop.create_task(
+            stop_after_replay(kookbotx.kookbot.client.gate.receiver, kookbotx.stop)
+        )
+        loop.run_until_complete(kookbotx.start())
+        sys.exit(0)
     # Load token from environment variable
     if not os.environ.get("KOOKBOT_WS_TOKEN"):
         logger.error(
@@ -112,5 +666,9 @@ if __name__ == "__main__":
     kookbotx.load_modules()
     # Start KookBotX
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(kookbotx.start())
+    try:
+        loop.run_until_complete(kookbotx.start())
+    except KeyboardInterrupt:
+        logger.info("Interrupted, shutting down KookBotX...")
+        loop.run_until_complete(kookbotx.shutdown())
     loop.close()
@@ -1,39 +1,358 @@
-from khl import Bot, Event, Message, EventTypes, Event
-from khl.card import Card, CardMessage, Module, Types, Element, Struct
-from khl.api import Message as MessageAPI
+"""await_sel_manager
+
+Keeps the callbacks of cards waiting for a user to click one of their buttons. When a
+button is clicked, pass the `MESSAGE_BTN_CLICK` event to
+`await_selection_manager.callback(event)`.
+
+Selections expire after `ttl` seconds (a day by default), calling their optional
+`on_expire(msg_id)` hook, and at most `capacity` of them are kept: when full, the one
+closest to expiring makes room. Callbacks and hooks may be `async`, in which case they
+run as tasks instead of on the handler of the click.
+
+Callbacks given as the name of a handler registered with
+`await_selection_manager.handler(name)` are called with `(event, data)` and survive a
+restart: selections whose callbacks (and `on_expire`) are all names are saved under
+`data/await_selection.json`.
+
+```python
+@await_selection_manager.handler("poll_vote")
+async def poll_vote(event, data):
+    ...
+
+await_selection_manager.add(msg_id, {"yes": "poll_vote", "no": "poll_vote"}, ttl=3600, data={"poll": 1})
+```
+"""
+
+import asyncio
+import heapq
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import orjson
+from khl import Event
 from loguru import logger
 
+DEFAULT_STORE_PATH = (
+    Path(__file__).resolve().parent.parent.parent / "data" / "await_selection.json"
+)
+
+Callback = Union[Callable, str]
+
+
+@dataclass
+class Selection:
+    msg_id: str
+    callbacks: Dict[str, Callback]
+    expires_at: float  # time.time()
+    on_expire: Optional[Callback] = None
+    data: Optional[dict] = None
+    seq: int = 0  # tells the heap entries of a replaced selection apart
+
+    @property
+    def persistent(self) -> bool:
+        return all(isinstance(c, str) for c in self.callbacks.values()) and (
+            self.on_expire is None or isinstance(self.on_expire, str)
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "msg_id": self.msg_id,
+            "callbacks": self.callbacks,
+            "expires_at": self.expires_at,
+            "on_expire": self.on_expire,
+            "data": self.data,
+        }
+
+
 class AwaitingUserSelection:
-    def __init__(self):
-        self.awaiting_user_selection = dict()
+    def __init__(
+        self,
+        ttl: float = 24 * 3600,
+        capacity: int = 10000,
+        store_path: Optional[Union[str, Path]] = None,
+        save_interval: float = 1.0,
+    ):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.store_path = Path(store_path) if store_path is not None else None
+        self.save_interval = save_interval
+        self.awaiting_user_selection: Dict[str, Selection] = dict()
+        self.handlers: Dict[str, Callable] = {}
+        # (expires_at, seq, msg_id); entries of selections that are gone are skipped
+        # when popped
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at = float("inf")
+        self._tasks = set()
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        self.expired = 0
+        self.evicted = 0
+        if self.store_path is not None:
+            self._load()
+
+    # ---- Handlers ----
+
+    def handler(self, name: str):
+        """Decorator registering `func(event, data)` as the callback named `name`."""
+
+        def dec(func: Callable):
+            self.handlers[name] = func
+            return func
+
+        return dec
+
+    def _resolve(self, callback: Callback) -> Optional[Callable]:
+        if not isinstance(callback, str):
+            return callback
+        func = self.handlers.get(callback)
+        if func is None:
+            logger.warning(
+                f"No handler named {callback} is registered in await_selection_manager"
+            )
+        return func
+
+    def _run(self, description: str, func: Callable, *args):
+        # Coroutines run as tasks, exceptions are logged
+        try:
+            ret = func(*args)
+        except Exception as e:
+            logger.error(f"Error while executing {description} {func}: {e}")
+            return None
+        if asyncio.iscoroutine(ret):
+            task = asyncio.get_running_loop().create_task(ret)
+            self._tasks.add(task)
+            task.add_done_callback(lambda t: self._task_done(description, func, t))
+            return task
+        return ret
 
-    def add(self, msg_id, callbacks: dict):
-        self.awaiting_user_selection[msg_id] = callbacks
+    def _task_done(self, description: str, func: Callable, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                f"Error while executing {description} {func}: {task.exception()}"
+            )
+
+    # ---- Selections ----
+
+    def add(
+        self,
+        msg_id,
+        callbacks: Dict[str, Callback],
+        ttl: Optional[float] = None,
+        on_expire: Optional[Callback] = None,
+        data: Optional[dict] = None,
+    ):
+        now = time.time()
+        self._expire(now)
+        if msg_id not in self.awaiting_user_selection:
+            while len(self.awaiting_user_selection) >= self.capacity and self._pop_next(
+                evict=True
+            ):
+                pass
+        self._seq += 1
+        selection = Selection(
+            msg_id,
+            dict(callbacks),
+            now + (self.ttl if ttl is None else ttl),
+            on_expire,
+            data,
+            self._seq,
+        )
+        self._put(selection)
+        if selection.persistent:
+            self._mark_dirty()
+
+    def _put(self, selection: Selection):
+        self.awaiting_user_selection[selection.msg_id] = selection
+        heapq.heappush(
+            self._heap, (selection.expires_at, selection.seq, selection.msg_id)
+        )
+        # Cancelled and clicked selections leave their heap entries behind, drop them
+        # once they are the majority
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(
+            self.awaiting_user_selection
+        ):
+            self._heap = [
+                (s.expires_at, s.seq, s.msg_id)
+                for s in self.awaiting_user_selection.values()
+            ]
+            heapq.heapify(self._heap)
+        self._arm_timer()
+
+    def _remove(self, msg_id) -> Optional[Selection]:
+        selection = self.awaiting_user_selection.pop(msg_id, None)
+        if selection is not None and selection.persistent:
+            self._mark_dirty()
+        return selection
 
     def callback(self, event: Event):
         msg_id = event.body["msg_id"]
         choice = event.body["value"]
+        self._expire(time.time())
         if not msg_id in self.awaiting_user_selection:
             return
-        callbacks = self.awaiting_user_selection[msg_id]
+        selection = self._remove(msg_id)
         rets = None
-        if choice in callbacks:
-            try:
-                rets = callbacks[choice](event)
-            except Exception as e:
-                logger.error(f"Error while executing callback {callbacks[choice]} from choice {choice}: {e}")
+        if choice in selection.callbacks:
+            func = self._resolve(selection.callbacks[choice])
+            if func is not None:
+                args = (
+                    (event, selection.data)
+                    if isinstance(selection.callbacks[choice], str)
+                    else (event,)
+                )
+                rets = self._run(f"callback from choice {choice}:", func, *args)
         else:
-            logger.warning(f"Choice {choice} not found in {callbacks}")
-        del self.awaiting_user_selection[msg_id]
+            logger.warning(f"Choice {choice} not found in {selection.callbacks}")
         return rets
-    
+
     def cancel(self, msg_id):
-        if msg_id in self.awaiting_user_selection:
-            del self.awaiting_user_selection[msg_id]
-        else:
+        if self._remove(msg_id) is None:
             logger.warning(f"Message {msg_id} not found in awaiting_user_selection")
 
     def contains(self, msg_id) -> bool:
+        self._expire(time.time())
         return msg_id in self.awaiting_user_selection
 
-await_selection_manager = AwaitingUserSelection()
+    def __len__(self):
+        return len(self.awaiting_user_selection)
+
+    # ---- Expiry ----
+
+    def _pop_next(self, evict: bool = False) -> bool:
+        """Remove the selection closest to expiring, returning False when there is none."""
+        while self._heap:
+            _, seq, msg_id = heapq.heappop(self._heap)
+            selection = self.awaiting_user_selection.get(msg_id)
+            if selection is None or selection.seq != seq:
+                continue  # clicked, cancelled or replaced
+            self._remove(msg_id)
+            if evict:
+                self.evicted += 1
+            else:
+                self.expired += 1
+            if selection.on_expire is not None:
+                func = self._resolve(selection.on_expire)
+                if func is not None:
+                    self._run("on_expire hook", func, msg_id)
+            return True
+        return False
+
+    def _expire(self, now: float):
+        # Every selection is pushed and popped once, plus the stale entries the heap is
+        # compacted of
+        while self._heap and self._heap[0][0] <= now:
+            self._pop_next()
+        self._arm_timer()
+
+    def _arm_timer(self):
+        # Expires selections on time while the loop runs; without a loop, they expire on
+        # the next access
+        if not self._heap:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        due = self._heap[0][0]
+        if self._timer is not None and self._timer_at <= due:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_at = due
+        self._timer = loop.call_later(max(0.0, due - time.time()), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_at = float("inf")
+        self._expire(time.time())
+
+    # ---- Persistence ----
+
+    def _load(self):
+        if not self.store_path.exists():
+            return
+        try:
+            entries = orjson.loads(self.store_path.read_bytes())
+        except Exception as e:
+            logger.warning(
+                f"Cannot read pending selections from {self.store_path}: {e}"
+            )
+            return
+        # Selections that expired while the bot was down expire on the next access, once
+        # the modules registered their hooks
+        for entry in entries:
+            self._seq += 1
+            self._put(Selection(seq=self._seq, **entry))
+        logger.info(
+            f"Restored {len(entries)} pending selections from {self.store_path}"
+        )
+
+    def _mark_dirty(self):
+        if self.store_path is None:
+            return
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_later())
+
+    async def _save_later(self):
+        while self._dirty:
+            await asyncio.sleep(self.save_interval)
+            await self.save()
+
+    def _snapshot(self) -> bytes:
+        return orjson.dumps(
+            [s.to_dict() for s in self.awaiting_user_selection.values() if s.persistent]
+        )
+
+    def _write(self, payload: bytes):
+        self.store_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.store_path.with_name(
+            f".{self.store_path.name}.{os.getpid()}.tmp"
+        )
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, self.store_path)
+
+    async def save(self):
+        """Write the persistent selections out, if they changed."""
+        if self.store_path is None or not self._dirty:
+            return
+        self._dirty = False
+        try:
+            await asyncio.to_thread(self._write, self._snapshot())
+        except Exception as e:
+            self._dirty = True
+            logger.warning(f"Cannot save pending selections to {self.store_path}: {e}")
+
+    async def aclose(self):
+        await self.save()
+        if self._save_task is not None:
+            self._save_task.cancel()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_at = float("inf")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.awaiting_user_selection),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "running_callbacks": len(self._tasks),
+        }
+
+
+await_selection_manager = AwaitingUserSelection(store_path=DEFAULT_STORE_PATH)
+
+
+async def teardown():
+    await await_selection_manager.aclose()
@@ -0,0 +1,260 @@
+"""Backups of one `JSONUserManager` user, blocking like `fileio`: run every call in a
+worker thread.
+
+A `backups` folder holds:
+
+- recent backups as loose files named `{name}.{ts}.{kind}` (hard links, see
+  `fileio.link_or_copy`),
+- `index.jsonl`, one line per loose backup, so listing never scans the folder,
+- `archive.kbxa`, a zip file of older backups. Versions of a file form chains: the
+  newest archived version is zlib-compressed on its own, each older one is compressed
+  with the next newer version as zlib preset dictionary whenever that comes out smaller,
+  which stores mostly-unchanged game states as little more than their diff.
+"""
+
+import io
+import json
+import re
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Optional
+
+from .fileio import atomic_write_bytes, link_or_copy, move_if_exists, read_bytes_or_none
+from .retention import BackupInfo, RetentionPolicy
+
+BACKUP_NAME_PATTERN = re.compile(
+    r"^(?P<name>.+?)\.(?P<ts>\d+(?:\.\d+)?)\.(?P<kind>bak|del)$"
+)
+
+INDEX_NAME = "index.jsonl"
+ARCHIVE_NAME = "archive.kbxa"
+ARCHIVE_INDEX_MEMBER = "index.json"
+# A chain of delta-encoded versions is restarted every so often to bound the cost of a
+# restore
+KEYFRAME_INTERVAL = 16
+
+
+def backup_file_name(name: str, ts: float, kind: str) -> str:
+    return f"{name}.{ts}.{kind}"
+
+
+def parse_backup_file_name(file_name: str) -> Optional[BackupInfo]:
+    match = BACKUP_NAME_PATTERN.match(file_name)
+    if match is None:
+        return None
+    return BackupInfo(match["name"], float(match["ts"]), match["kind"])
+
+
+class BackupStore:
+
+    def __init__(self, backups_dir: Path, fsync: bool = True):
+        self.backups_dir = backups_dir
+        self.fsync = fsync
+
+    @property
+    def index_path(self) -> Path:
+        return self.backups_dir / INDEX_NAME
+
+    @property
+    def archive_path(self) -> Path:
+        return self.backups_dir / ARCHIVE_NAME
+
+    def _path_of(self, info: BackupInfo) -> Path:
+        return self.backups_dir / backup_file_name(info.name, info.ts, info.kind)
+
+    def _record(self, info: BackupInfo):
+        # Not fsync-ed: a lost line only hides a backup until the next compaction
+        # rescans the folder
+        with open(self.index_path, "ab") as f:
+            f.write(
+                json.dumps(
+                    {"name": info.name, "ts": info.ts, "kind": info.kind}
+                ).encode()
+                + b"\n"
+            )
+
+    def add(self, src: Path, info: BackupInfo):
+        link_or_copy(src, self._path_of(info))
+        self._record(info)
+
+    def add_moved(self, src: Path, info: BackupInfo) -> bool:
+        """Move `src` into the backups, returning `False` if it does not exist."""
+        if not move_if_exists(src, self._path_of(info)):
+            return False
+        self._record(info)
+        return True
+
+    def _loose(self) -> list:
+        if not self.index_path.exists():
+            # Written before backups were indexed, rebuild the index once
+            loose = self._scan_loose()
+            self._write_index(loose)
+            return loose
+        loose = []
+        for line in self.index_path.read_bytes().splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            loose.append(BackupInfo(entry["name"], entry["ts"], entry["kind"]))
+        return loose
+
+    def _scan_loose(self) -> list:
+        loose = []
+        for path in self.backups_dir.iterdir():
+            info = parse_backup_file_name(path.name)
+            if info is not None:
+                loose.append(info)
+        return loose
+
+    def _write_index(self, loose: list):
+        data = b"".join(
+            json.dumps({"name": i.name, "ts": i.ts, "kind": i.kind}).encode() + b"\n"
+            for i in loose
+        )
+        atomic_write_bytes(self.index_path, data, self.fsync)
+
+    def _archive_index(self, archive: zipfile.ZipFile) -> dict:
+        entries = json.loads(archive.read(ARCHIVE_INDEX_MEMBER))
+        return {entry["member"]: entry for entry in entries}
+
+    def _decode(self, archive: zipfile.ZipFile, index: dict, member: str) -> bytes:
+        entry = index[member]
+        payload = archive.read(member)
+        if entry["codec"] == "zlib":
+            return zlib.decompress(payload)
+        decompressor = zlib.decompressobj(
+            zdict=self._decode(archive, index, entry["base"])
+        )
+        return decompressor.decompress(payload) + decompressor.flush()
+
+    def list_backups(self) -> list:
+        backups = {(i.name, i.ts): i for i in self._loose()}
+        if self.archive_path.exists():
+            with zipfile.ZipFile(self.archive_path) as archive:
+                for entry in self._archive_index(archive).values():
+                    backups.setdefault(
+                        (entry["name"], entry["ts"]),
+                        BackupInfo(
+                            entry["name"], entry["ts"], entry["kind"], archived=True
+                        ),
+                    )
+        return list(backups.values())
+
+    def read(self, name: str, ts: float) -> Optional[bytes]:
+        for kind in ("bak", "del"):
+            data = read_bytes_or_none(self._path_of(BackupInfo(name, ts, kind)))
+            if data is not None:
+                return data
+        if not self.archive_path.exists():
+            return None
+        with zipfile.ZipFile(self.archive_path) as archive:
+            index = self._archive_index(archive)
+            for member, entry in index.items():
+                if entry["name"] == name and entry["ts"] == ts:
+                    return self._decode(archive, index, member)
+        return None
+
+    def compact(self, policy: RetentionPolicy, now: Optional[float] = None) -> tuple:
+        """Apply `policy`: drop expired backups and pack kept ones that are not among
+        the `keep_last` newest into the archive. Returns the number of dropped and of
+        newly archived backups."""
+        # Rescan rather than trust the index, so that backups whose index line got lost
+        # are handled too
+        loose = {(i.name, i.ts): i for i in self._scan_loose()}
+        archive = (
+            zipfile.ZipFile(self.archive_path) if self.archive_path.exists() else None
+        )
+        try:
+            archive_index = self._archive_index(archive) if archive is not None else {}
+            archived = {(e["name"], e["ts"]): e for e in archive_index.values()}
+
+            versions = {}
+            for name, ts in set(loose) | set(archived):
+                versions.setdefault(name, []).append(ts)
+            stay_loose, to_archive = set(), set()
+            for name, timestamps in versions.items():
+                kept = policy.select(timestamps, now)
+                newest = sorted(kept, reverse=True)
+                stay_loose.update(
+                    (name, ts)
+                    for ts in newest[: policy.keep_last]
+                    if (name, ts) in loose
+                )
+                to_archive.update(
+                    (name, ts) for ts in kept if (name, ts) not in stay_loose
+                )
+
+            newly_archived = to_archive - set(archived)
+            dropped = (set(loose) | set(archived)) - stay_loose - to_archive
+            if to_archive != set(archived):
+                plain = {}
+                for key in to_archive:
+                    if key in archived:
+                        plain[key] = self._decode(
+                            archive, archive_index, archived[key]["member"]
+                        )
+                    else:
+                        plain[key] = (
+                            self.backups_dir / backup_file_name(*key, loose[key].kind)
+                        ).read_bytes()
+                kinds = {
+                    key: (archived[key]["kind"] if key in archived else loose[key].kind)
+                    for key in to_archive
+                }
+                new_archive = self._encode_archive(plain, kinds)
+            else:
+                new_archive = None
+        finally:
+            if archive is not None:
+                archive.close()
+
+        if new_archive is not None:
+            if to_archive:
+                atomic_write_bytes(self.archive_path, new_archive, self.fsync)
+            else:
+                self.archive_path.unlink(missing_ok=True)
+        self._write_index([loose[key] for key in stay_loose])
+        for key, info in loose.items():
+            if key not in stay_loose:
+                self._path_of(info).unlink(missing_ok=True)
+        return len(dropped), len(newly_archived)
+
+    @staticmethod
+    def _encode_archive(plain: dict, kinds: dict) -> bytes:
+        buffer = io.BytesIO()
+        index = []
+        by_name = {}
+        for name, ts in plain:
+            by_name.setdefault(name, []).append(ts)
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            for name, timestamps in by_name.items():
+                newer = None
+                for position, ts in enumerate(sorted(timestamps, reverse=True)):
+                    data = plain[name, ts]
+                    member = backup_file_name(name, ts, kinds[name, ts])
+                    entry = {
+                        "name": name,
+                        "ts": ts,
+                        "kind": kinds[name, ts],
+                        "member": member,
+                    }
+                    payload = zlib.compress(data, 9)
+                    entry["codec"] = "zlib"
+                    if (
+                        newer is not None
+                        and plain[newer[0]]
+                        and position % KEYFRAME_INTERVAL != 0
+                    ):
+                        compressor = zlib.compressobj(9, zdict=plain[newer[0]])
+                        delta = compressor.compress(data) + compressor.flush()
+                        if len(delta) < len(payload):
+                            payload = delta
+                            entry["codec"] = "zlib-delta"
+                            entry["base"] = newer[1]
+                    archive.writestr(member, payload)
+                    index.append(entry)
+                    newer = ((name, ts), member)
+            archive.writestr(ARCHIVE_INDEX_MEMBER, json.dumps(index))
+        return buffer.getvalue()
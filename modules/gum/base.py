@@ -0,0 +1,329 @@
+import asyncio
+import copy
+import random
+import string
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+
+from loguru import logger
+
+from .batch import BatchMixin
+from .cache import MISSING, CacheMixin
+from .errors import (
+    BackupError,
+    BackupNotFoundError,
+    DuplicateRegistrationError,
+    GameDataCorruptionError,
+    GameDataNotFoundError,
+    UserNotFoundError,
+)
+from .locks import UserLockMixin
+from .meta_index import MetaIndexMixin
+from .retention import BackupRetentionMixin, RetentionPolicy
+from .write_behind import WriteBehindMixin
+
+DEFAULT_DATA_DIR = Path(__file__).resolve().parent.parent.parent / "data"
+
+
+def get_random_string(length: int = 8) -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=length))
+
+
+class UserManager(
+    UserLockMixin,
+    CacheMixin,
+    WriteBehindMixin,
+    BackupRetentionMixin,
+    BatchMixin,
+    MetaIndexMixin,
+):
+    """Global user manager interface.
+
+    The public API (see `readme_zh-cn.md`) is implemented here once: the in-memory user
+    table, locking and error translation are shared by every backend. A storage backend
+    subclasses `UserManager` and implements the underscore-prefixed storage primitives
+    below. Users are stored under a random storage id (`rsid`), so an unregistered
+    user's data is never handed to a later registration with the same `user_id`.
+
+    The read cache (`CacheMixin`), write-behind mode (`WriteBehindMixin`), backup
+    retention (`BackupRetentionMixin`), batch API (`BatchMixin`) and meta indexes
+    (`MetaIndexMixin`) live in the modules of their features, see their docstrings for
+    the parameters they take.
+    """
+
+    def __init__(
+        self,
+        cache_max_bytes: int = 64 * 1024 * 1024,
+        cache_ttl: Optional[float] = None,
+        write_behind: bool = False,
+        flush_interval: float = 1.0,
+        flush_max_dirty: int = 1000,
+        backup_retention: Optional[RetentionPolicy] = RetentionPolicy(),
+        backup_compaction_interval: float = 600,
+        batch_concurrency: int = 32,
+        meta_indexes: Iterable[str] = ("registration.from_game",),
+        meta_index_save_interval: float = 30,
+    ):
+        self.user_table = {}
+        # The global lock only guards user table changes, everything else takes the lock
+        # of its user
+        self.lock = asyncio.Lock()
+        self._user_locks = {}
+        self._init_cache(cache_max_bytes, cache_ttl)
+        self._init_write_behind(write_behind, flush_interval, flush_max_dirty)
+        self._init_backup_retention(backup_retention, backup_compaction_interval)
+        self.batch_concurrency = batch_concurrency
+        self.load_user_table()
+        self._init_meta_index(meta_indexes, meta_index_save_interval)
+
+    def load_user_table(self):
+        self.user_table = self._load_user_table()
+
+    def _rsid_of(self, user_id) -> str:
+        if user_id not in self.user_table:
+            raise UserNotFoundError(f"User {user_id} not found.")
+        return self.user_table[user_id]
+
+    async def register(self, user_id, game_id=None):
+        async with self.user_lock(user_id):
+            async with self.lock:
+                if user_id in self.user_table:
+                    raise DuplicateRegistrationError(
+                        f"User {user_id} is already registered."
+                    )
+                rsid = get_random_string()
+                self.user_table[user_id] = rsid
+            try:
+                meta = {
+                    "kook_id": user_id,
+                    "registration": {
+                        "ts": datetime.now().timestamp(),
+                        "time": datetime.now().isoformat(),
+                        "from_game": game_id,
+                    },
+                }
+                async with self._meta_index_change():
+                    await self._create_user(user_id, rsid, meta)
+                    self._index_meta(user_id, meta)
+            except Exception as e:
+                # Rollback if anything goes wrong
+                async with self.lock:
+                    if user_id in self.user_table:
+                        del self.user_table[user_id]
+                raise e
+
+    async def unregister(self, user_id):
+        async with self.user_lock(user_id):
+            async with self.lock:
+                rsid = self._rsid_of(user_id)
+                del self.user_table[user_id]
+            try:
+                async with self._meta_index_change():
+                    await self._remove_user(user_id, rsid)
+                    self._index_meta(user_id, None)
+            except Exception as e:
+                async with self.lock:
+                    self.user_table[user_id] = rsid
+                raise e
+
+    async def save_user_table(self):
+        """Persist the whole user table. Backends that persist every registration on its
+        own keep this a no-op."""
+        pass
+
+    async def has_user(self, user_id):
+        return user_id in self.user_table
+
+    async def get_data_for_game(self, user_id, game_id):
+        rsid = self._rsid_of(user_id)
+        if (rsid, game_id) in self._dirty:
+            return self._dirty[rsid, game_id][1]
+        data = self.cache.get(("data", rsid, game_id))
+        if data is MISSING:
+            epoch = self._cache_epoch
+            try:
+                data = await self._read_data(rsid, game_id)
+            except Exception as e:
+                raise GameDataCorruptionError(
+                    f"Data corruption for game {game_id} of user {user_id}, failed to read {game_id} data of {rsid}."
+                ) from e
+            if epoch == self._cache_epoch:
+                self._cache_data(rsid, game_id, data)
+        if data is None:
+            raise GameDataNotFoundError(
+                f"Data for game {game_id} not found for user {user_id}."
+            )
+        return data
+
+    async def has_data_for_game(self, user_id, game_id):
+        if user_id not in self.user_table:
+            return False
+        rsid = self.user_table[user_id]
+        if (rsid, game_id) in self._dirty:
+            return True
+        data = self.cache.get(("data", rsid, game_id), count=False)
+        if data is not MISSING:
+            return data is not None
+        return await self._has_data(rsid, game_id)
+
+    async def set_data_for_game(self, user_id, game_id, data, backup=False):
+        async with self.user_lock(user_id):
+            rsid = self._rsid_of(user_id)
+
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+                logger.warning(
+                    "Writing string to game data is not recommended, please use bytes."
+                )
+
+            if self.write_behind:
+                self._defer_write(user_id, rsid, game_id, data, backup)
+            else:
+                await self._persist_data(user_id, rsid, game_id, data, backup)
+
+    async def _persist_data(
+        self, user_id, rsid: str, game_id, data: bytes, backup: bool
+    ):
+        # Callers hold the lock of the user
+        if backup and await self._has_data(rsid, game_id):
+            try:
+                await self._backup_data(rsid, game_id)
+            except Exception as e:
+                raise BackupError(
+                    f"Failed to backup data for game {game_id} of user {user_id}."
+                ) from e
+            self._touch_backups(user_id, rsid)
+        with self._cache_write():
+            try:
+                await self._write_data(rsid, game_id, data)
+            except Exception as e:
+                self.cache.invalidate(("data", rsid, game_id))
+                raise GameDataCorruptionError(
+                    f"Failed to set data for game {game_id} of user {user_id}, failed to write {game_id} data of {rsid}."
+                ) from e
+            self._cache_data(rsid, game_id, data)
+
+    async def delete_data_for_game(self, user_id, game_id):
+        async with self.user_lock(user_id):
+            rsid = self._rsid_of(user_id)
+            dirty = self._dirty.pop((rsid, game_id), None)
+            if dirty is not None:
+                # Write it first so the deletion keeps it as a `.del` backup like any
+                # stored data
+                await self._persist_data(user_id, rsid, game_id, dirty[1], dirty[2])
+            with self._cache_write():
+                self.cache.invalidate(("data", rsid, game_id))
+                if not await self._delete_data(rsid, game_id):
+                    raise GameDataNotFoundError(
+                        f"Data for game {game_id} not found for user {user_id}."
+                    )
+                self._cache_data(rsid, game_id, None)
+            self._touch_backups(user_id, rsid)
+
+    async def meta_get(self, user_id):
+        rsid = self._rsid_of(user_id)
+        # Callers may modify the returned dict, never hand out the cached one
+        return copy.deepcopy(await self._get_meta(rsid))
+
+    async def _get_meta(self, rsid: str) -> dict:
+        meta = self.cache.get(("meta", rsid))
+        if meta is MISSING:
+            epoch = self._cache_epoch
+            meta = await self._read_meta(rsid)
+            if epoch == self._cache_epoch:
+                self._cache_meta(rsid, meta)
+        return meta
+
+    async def meta_set(self, user_id, meta_key, meta_value):
+        async with self.user_lock(user_id):
+            rsid = self._rsid_of(user_id)
+            # Backup current meta, then read, update, and write back meta
+            await self._backup_meta(rsid)
+            self._touch_backups(user_id, rsid)
+            meta = copy.deepcopy(await self._get_meta(rsid))
+            meta[meta_key] = meta_value
+            async with self._meta_index_change():
+                with self._cache_write():
+                    try:
+                        await self._write_meta(rsid, meta)
+                    except Exception as e:
+                        self.cache.invalidate(("meta", rsid))
+                        raise e
+                    self._cache_meta(rsid, meta)
+                self._index_meta(user_id, meta)
+
+    async def dump_user_table(self):
+        return self.user_table
+
+    async def close(self):
+        """Flush dirty data and release resources held by the backend (threads,
+        connections...)."""
+        for task in (self._flusher, self._backup_compactor, self._meta_index_saver):
+            if task is not None:
+                task.cancel()
+        self._flusher = self._backup_compactor = self._meta_index_saver = None
+        await self.flush()
+        if self._meta_index_marker is not None:
+            await self._save_meta_index()
+        await self._close()
+
+    # Storage primitives, implemented by backends
+
+    async def _close(self):
+        pass
+
+    def _load_user_table(self) -> dict:
+        """Load and return the persisted `user_id -> rsid` mapping. Called synchronously
+        on construction."""
+        raise NotImplementedError
+
+    async def _create_user(self, user_id, rsid: str, meta: dict):
+        """Create the storage of a new user. `self.user_table` already contains the new
+        entry."""
+        raise NotImplementedError
+
+    async def _remove_user(self, user_id, rsid: str):
+        """Forget a user. `self.user_table` no longer contains the entry. User data must
+        be kept."""
+        raise NotImplementedError
+
+    async def _read_data(self, rsid: str, game_id):
+        """Return the stored bytes, or `None` if there is no data for the game."""
+        raise NotImplementedError
+
+    async def _has_data(self, rsid: str, game_id) -> bool:
+        raise NotImplementedError
+
+    async def _write_data(self, rsid: str, game_id, data: bytes):
+        raise NotImplementedError
+
+    async def _backup_data(self, rsid: str, game_id):
+        """Keep a `.bak` copy of the current data, which is known to exist."""
+        raise NotImplementedError
+
+    async def _delete_data(self, rsid: str, game_id) -> bool:
+        """Move the data to a `.del` backup. Return `False` if there is no data for the
+        game."""
+        raise NotImplementedError
+
+    async def _read_meta(self, rsid: str) -> dict:
+        raise NotImplementedError
+
+    async def _write_meta(self, rsid: str, meta: dict):
+        raise NotImplementedError
+
+    async def _backup_meta(self, rsid: str):
+        raise NotImplementedError
+
+    async def _list_backups(self, rsid: str) -> list:
+        raise NotImplementedError
+
+    async def _read_backup(self, rsid: str, name: str, ts: float):
+        """Return the content of a backup, or `None` if it does not exist."""
+        raise NotImplementedError
+
+    async def _compact_backups(self, rsid: str, policy: RetentionPolicy) -> tuple:
+        """Apply `policy` to the backups of a user, returning the number of dropped and
+        newly compressed backups."""
+        raise NotImplementedError
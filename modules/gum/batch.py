@@ -0,0 +1,188 @@
+import asyncio
+import contextlib
+import copy
+
+from loguru import logger
+
+from .cache import MISSING
+from .errors import (
+    BackupError,
+    GameDataCorruptionError,
+    GameDataNotFoundError,
+    UserNotFoundError,
+)
+
+
+class BatchMixin:
+    """Batch API of `UserManager`. `get_many`, `set_many` and `meta_get_many` handle
+    many users at once and return a result or an exception per user. The default batch
+    primitives run at most `batch_concurrency` single operations at a time; backends
+    that can do better (one query, one transaction) override them.
+    """
+
+    @contextlib.asynccontextmanager
+    async def _user_locks_of(self, user_ids):
+        # Always taken in the same order, so that two batches sharing users cannot
+        # deadlock
+        async with contextlib.AsyncExitStack() as stack:
+            for user_id in sorted(set(user_ids), key=repr):
+                await stack.enter_async_context(self.user_lock(user_id))
+            yield
+
+    async def _gather(self, coros) -> list:
+        """Run `coros` at most `batch_concurrency` at a time, returning the result or
+        the exception of each."""
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def bounded(coro):
+            async with semaphore:
+                return await coro
+
+        return await asyncio.gather(
+            *(bounded(c) for c in coros), return_exceptions=True
+        )
+
+    async def get_many(self, user_ids, game_id) -> dict:
+        """`get_data_for_game` for many users. Returns `user_id -> data`, or the
+        exception `get_data_for_game` would have raised for that user."""
+        results, to_read = {}, {}
+        for user_id in user_ids:
+            rsid = self.user_table.get(user_id)
+            if rsid is None:
+                results[user_id] = UserNotFoundError(f"User {user_id} not found.")
+            elif (rsid, game_id) in self._dirty:
+                results[user_id] = self._dirty[rsid, game_id][1]
+            else:
+                data = self.cache.get(("data", rsid, game_id))
+                if data is MISSING:
+                    to_read[user_id] = rsid
+                else:
+                    results[user_id] = data
+        if to_read:
+            epoch = self._cache_epoch
+            read = await self._read_data_many(list(to_read.values()), game_id)
+            for (user_id, rsid), data in zip(to_read.items(), read):
+                if isinstance(data, Exception):
+                    error = GameDataCorruptionError(
+                        f"Data corruption for game {game_id} of user {user_id}, failed to read {game_id} data of {rsid}."
+                    )
+                    error.__cause__ = data
+                    results[user_id] = error
+                    continue
+                if epoch == self._cache_epoch:
+                    self._cache_data(rsid, game_id, data)
+                results[user_id] = data
+        for user_id, data in results.items():
+            if data is None:
+                results[user_id] = GameDataNotFoundError(
+                    f"Data for game {game_id} not found for user {user_id}."
+                )
+        return results
+
+    async def set_many(self, items: dict, game_id, backup=False) -> dict:
+        """`set_data_for_game` for many users, `items` maps `user_id -> data`. The locks
+        of all users are taken once for the whole batch. Returns `user_id -> None`, or
+        the exception `set_data_for_game` would have raised for that user."""
+        results, to_write = {}, {}
+        async with self._user_locks_of(items):
+            for user_id, data in items.items():
+                rsid = self.user_table.get(user_id)
+                if rsid is None:
+                    results[user_id] = UserNotFoundError(f"User {user_id} not found.")
+                    continue
+                if isinstance(data, str):
+                    data = data.encode("utf-8")
+                    logger.warning(
+                        "Writing string to game data is not recommended, please use bytes."
+                    )
+                results[user_id] = None
+                to_write[user_id] = (rsid, data)
+
+            if self.write_behind:
+                for user_id, (rsid, data) in to_write.items():
+                    self._defer_write(user_id, rsid, game_id, data, backup)
+                return results
+
+            with self._cache_write():
+                written = await self._write_data_many(
+                    game_id, list(to_write.values()), backup
+                )
+                for (user_id, (rsid, data)), error in zip(to_write.items(), written):
+                    if error is None:
+                        self._cache_data(rsid, game_id, data)
+                        if backup:
+                            self._touch_backups(user_id, rsid)
+                        continue
+                    self.cache.invalidate(("data", rsid, game_id))
+                    if not isinstance(error, BackupError):
+                        cause, error = error, GameDataCorruptionError(
+                            f"Failed to set data for game {game_id} of user {user_id}, failed to write {game_id} data of {rsid}."
+                        )
+                        error.__cause__ = cause
+                    results[user_id] = error
+        return results
+
+    async def meta_get_many(self, user_ids) -> dict:
+        """`meta_get` for many users. Returns `user_id -> meta`, or the exception
+        `meta_get` would have raised for that user."""
+        results, to_read = {}, {}
+        for user_id in user_ids:
+            rsid = self.user_table.get(user_id)
+            if rsid is None:
+                results[user_id] = UserNotFoundError(f"User {user_id} not found.")
+                continue
+            meta = self.cache.get(("meta", rsid))
+            if meta is MISSING:
+                to_read[user_id] = rsid
+            else:
+                results[user_id] = copy.deepcopy(meta)
+        if to_read:
+            epoch = self._cache_epoch
+            read = await self._read_meta_many(list(to_read.values()))
+            for (user_id, rsid), meta in zip(to_read.items(), read):
+                if not isinstance(meta, Exception) and epoch == self._cache_epoch:
+                    self._cache_meta(rsid, meta)
+                    meta = copy.deepcopy(meta)
+                results[user_id] = meta
+        return results
+
+    async def iter_game_data(self, game_id, batch_size: int = 256):
+        """Yield `(user_id, data)` for every user that has data for `game_id`, reading
+        `batch_size` users at a time. Users registered while iterating may be missed.
+        Read errors other than missing data are raised.
+        """
+        user_ids = list(self.user_table)
+        for start in range(0, len(user_ids), batch_size):
+            batch = await self.get_many(user_ids[start : start + batch_size], game_id)
+            for user_id, data in batch.items():
+                if isinstance(data, (GameDataNotFoundError, UserNotFoundError)):
+                    continue
+                if isinstance(data, Exception):
+                    raise data
+                yield user_id, data
+
+    # Batch primitives, returning the result or the exception for each item in order
+
+    async def _read_data_many(self, rsids: list, game_id) -> list:
+        return await self._gather(self._read_data(rsid, game_id) for rsid in rsids)
+
+    async def _read_meta_many(self, rsids: list) -> list:
+        return await self._gather(self._read_meta(rsid) for rsid in rsids)
+
+    async def _write_data_many(self, game_id, items: list, backup: bool) -> list:
+        """Write `(rsid, data)` items, backing up existing data first if `backup`. A
+        failed backup is reported as `BackupError` and skips the write of that item.
+        Successful items return `None`.
+        """
+
+        async def write(rsid, data):
+            if backup and await self._has_data(rsid, game_id):
+                try:
+                    await self._backup_data(rsid, game_id)
+                except Exception as e:
+                    raise BackupError(
+                        f"Failed to backup data for game {game_id} of {rsid}."
+                    ) from e
+            await self._write_data(rsid, game_id, data)
+
+        return await self._gather(write(rsid, data) for rsid, data in items)
@@ -0,0 +1,188 @@
+"""Benchmarks for gum backends, run them from the `modules` directory:
+
+```bash
+python -m gum.benchmark concurrency --backend json --writes 2000
+python -m gum.benchmark stall --size 8388608
+```
+
+Every benchmark works on a fresh temporary data directory and never touches `data/`.
+"""
+
+import argparse
+import asyncio
+import shutil
+import statistics
+import tempfile
+import time
+
+import aiofiles
+
+from .backup_store import backup_file_name
+from .base import UserManager
+from .json_manager import JSONUserManager
+from .sqlite_manager import SQLiteUserManager
+
+
+def create_manager(backend: str, data_dir: str) -> UserManager:
+    if backend == "json":
+        return JSONUserManager(data_dir)
+    return SQLiteUserManager(f"{data_dir}/gum.sqlite3")
+
+
+class InPlaceJSONUserManager(JSONUserManager):
+    """Reproduces the former write path: blocking `shutil.copy` backups and in-place
+    rewrites."""
+
+    async def _write_data(self, rsid: str, game_id, data: bytes):
+        async with aiofiles.open(self._game_data_path(rsid, game_id), "wb") as f:
+            await f.write(data)
+
+    async def _backup_data(self, rsid: str, game_id):
+        info = self._new_backup(f"{game_id}.dat")
+        shutil.copy(
+            self._game_data_path(rsid, game_id),
+            self._user_dir(rsid)
+            / "backups"
+            / backup_file_name(info.name, info.ts, info.kind),
+        )
+
+
+class SingleLock:
+    """Stands in for `UserManager.user_lock` to reproduce one lock shared by every user."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+
+    def __call__(self, user_id):
+        return self.lock
+
+
+async def run_writes(
+    manager: UserManager,
+    users: int,
+    writes: int,
+    concurrency: int,
+    size: int,
+    backup: bool,
+):
+    user_ids = [f"bench-{i}" for i in range(users)]
+    for user_id in user_ids:
+        await manager.register(user_id, "bench")
+    payload = b"x" * size
+    remaining = iter(range(writes))
+
+    async def worker():
+        for i in remaining:
+            await manager.set_data_for_game(
+                user_ids[i % users], "bench", payload, backup=backup
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return writes / (time.perf_counter() - start)
+
+
+async def bench_concurrency(args):
+    print(
+        f"backend={args.backend} writes={args.writes} concurrency={args.concurrency} size={args.size}B backup={args.backup}"
+    )
+    print(f"{'users':>6} {'per-user locks':>16} {'single lock':>14}")
+    for users in args.users:
+        results = []
+        for single_lock in (False, True):
+            with tempfile.TemporaryDirectory() as data_dir:
+                manager = create_manager(args.backend, data_dir)
+                if single_lock:
+                    manager.user_lock = SingleLock()
+                results.append(
+                    await run_writes(
+                        manager,
+                        users,
+                        args.writes,
+                        args.concurrency,
+                        args.size,
+                        args.backup,
+                    )
+                )
+                await manager.close()
+        print(f"{users:>6} {results[0]:>12.0f} w/s {results[1]:>10.0f} w/s")
+
+
+async def measure_stalls(workload, interval: float = 0.001):
+    """Run `workload` while a probe task repeatedly sleeps for `interval`, returning how
+    late each wake-up was."""
+    stalls = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            stalls.append(time.perf_counter() - start - interval)
+
+    probe_task = asyncio.create_task(probe())
+    try:
+        await workload
+    finally:
+        done.set()
+        await probe_task
+    return stalls
+
+
+async def bench_stall(args):
+    print(f"writes={args.writes} size={args.size}B backup=True")
+    print(f"{'write path':>10} {'max stall':>10} {'p99 stall':>10} {'total':>9}")
+    payload = b"x" * args.size
+    for name, manager_class in (
+        ("in-place", InPlaceJSONUserManager),
+        ("atomic", JSONUserManager),
+    ):
+        with tempfile.TemporaryDirectory() as data_dir:
+            manager = manager_class(data_dir, cache_max_bytes=0)
+            await manager.register("bench-0", "bench")
+            await manager.set_data_for_game("bench-0", "bench", payload)
+
+            async def workload():
+                for _ in range(args.writes):
+                    await manager.set_data_for_game(
+                        "bench-0", "bench", payload, backup=True
+                    )
+
+            start = time.perf_counter()
+            stalls = await measure_stalls(workload())
+            total = time.perf_counter() - start
+            await manager.close()
+        p99 = statistics.quantiles(stalls, n=100)[-1] if len(stalls) > 1 else stalls[0]
+        print(
+            f"{name:>10} {max(stalls) * 1000:>8.2f}ms {p99 * 1000:>8.2f}ms {total:>8.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="gum benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    concurrency = subparsers.add_parser(
+        "concurrency", help="write throughput against the number of distinct users"
+    )
+    concurrency.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    concurrency.add_argument("--writes", type=int, default=2000)
+    concurrency.add_argument("--concurrency", type=int, default=64)
+    concurrency.add_argument(
+        "--size", type=int, default=4096, help="payload size in bytes"
+    )
+    concurrency.add_argument("--backup", action="store_true")
+    concurrency.add_argument("--users", type=int, nargs="+", default=[1, 4, 16, 64])
+    concurrency.set_defaults(run=bench_concurrency)
+
+    stall = subparsers.add_parser(
+        "stall", help="event loop stall time during large backed-up writes"
+    )
+    stall.add_argument("--writes", type=int, default=20)
+    stall.add_argument(
+        "--size", type=int, default=8 * 1024 * 1024, help="payload size in bytes"
+    )
+    stall.set_defaults(run=bench_stall)
+
+    args = parser.parse_args()
+    asyncio.run(args.run(args))
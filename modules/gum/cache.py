@@ -0,0 +1,121 @@
+import contextlib
+import json
+import time
+from collections import OrderedDict
+from typing import Optional
+
+MISSING = object()
+
+# Rough per-entry bookkeeping cost (key tuple, OrderedDict node), counted against the
+# cache budget
+CACHE_ENTRY_OVERHEAD = 200
+
+
+class LRUCache:
+    """Least-recently-used cache bounded by the total size of its values, with an
+    optional time-to-live.
+
+    Sizes are given by the caller on `put`, so the cache itself never inspects values. A
+    value larger than the whole budget is simply not cached. `max_bytes=0` disables the
+    cache.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not MISSING
+
+    def get(self, key, default=MISSING, count: bool = True):
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            if count:
+                self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        if count:
+            self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size: int):
+        self.invalidate(key)
+        if size > self.max_bytes:
+            return
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self.entries[key] = (value, size, expires_at)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if key in self.entries:
+            self._remove(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class CacheMixin:
+    """Read cache of `UserManager`: game data and meta are kept in an `LRUCache` of
+    `cache_max_bytes` bytes (0 disables it), whose entries expire after `cache_ttl`
+    seconds if set. Every write goes through the cache, so it never serves stale data as
+    long as the storage is only modified through the manager.
+    """
+
+    def _init_cache(self, cache_max_bytes: int, cache_ttl: Optional[float]):
+        self.cache = LRUCache(cache_max_bytes, cache_ttl)
+        self._cache_epoch = 0
+
+    def cache_stats(self) -> dict:
+        """Hit/miss/eviction counters and memory usage of the read cache."""
+        return self.cache.stats()
+
+    @contextlib.contextmanager
+    def _cache_write(self):
+        # A read that overlaps a write may have read either version, it must not
+        # populate the cache
+        self._cache_epoch += 1
+        try:
+            yield
+        finally:
+            self._cache_epoch += 1
+
+    def _cache_data(self, rsid: str, game_id, data):
+        # Absent data is cached too, `has_data_for_game` is mostly asked about players
+        # who have none yet
+        size = CACHE_ENTRY_OVERHEAD + (0 if data is None else len(data))
+        self.cache.put(("data", rsid, game_id), data, size)
+
+    def _cache_meta(self, rsid: str, meta: dict):
+        self.cache.put(
+            ("meta", rsid), meta, CACHE_ENTRY_OVERHEAD + len(json.dumps(meta))
+        )
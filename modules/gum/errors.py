@@ -0,0 +1,22 @@
+class GameDataCorruptionError(Exception):
+    pass
+
+
+class UserNotFoundError(Exception):
+    pass
+
+
+class DuplicateRegistrationError(Exception):
+    pass
+
+
+class GameDataNotFoundError(Exception):
+    pass
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupNotFoundError(Exception):
+    pass
@@ -0,0 +1,74 @@
+"""Blocking file helpers of the JSON backend. They are meant to run in a worker thread
+(`asyncio.to_thread`), one call per operation, so that each operation costs a single
+thread hop and never blocks the event loop.
+"""
+
+import os
+import secrets
+import shutil
+from pathlib import Path
+from typing import Optional
+
+
+def fsync_dir(path: Path):
+    """Make a rename or a newly created file inside `path` durable. No-op where
+    directories cannot be opened."""
+    if os.name != "posix":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write_bytes(path: Path, data: bytes, fsync: bool = True):
+    """Write `data` to a temporary file next to `path`, fsync it and rename it over
+    `path`.
+
+    Readers see either the old or the new content, never a partially written file. The
+    old content keeps its inode, so hard links to it (see `link_or_copy`) are left
+    untouched.
+    """
+    tmp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if fsync:
+        fsync_dir(path.parent)
+
+
+def read_bytes_or_none(path: Path) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def link_or_copy(src: Path, dst: Path):
+    """Back up `src` as `dst` without copying data when possible.
+
+    Files are only ever replaced through `atomic_write_bytes`, never modified in place,
+    so a hard link is as good as a copy. Falls back to copying on filesystems without
+    hard links.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def move_if_exists(src: Path, dst: Path) -> bool:
+    try:
+        os.replace(src, dst)
+    except FileNotFoundError:
+        return False
+    return True
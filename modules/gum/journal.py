@@ -0,0 +1,200 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+
+from .fileio import atomic_write_bytes, fsync_dir
+
+
+class UserTableJournal:
+    """Write-ahead journal of the `user_id -> rsid` table.
+
+    `user_table.json` is a snapshot; every registration and unregistration since then is
+    a JSON line appended to a `user_table.{n}.journal` segment. Concurrent appends are
+    group-committed: they are written and fsync-ed together by a single flusher task,
+    and `append` only returns once its record is durable.
+
+    When enough records piled up, or when `compact()` asks for it, the flusher starts a
+    new segment and writes a fresh snapshot in the background, after which older
+    segments are deleted. Only the flusher does so, between two batches, so the snapshot
+    always covers every record of the segments it replaces. Records only set or remove a
+    key, so replaying a segment that the snapshot already covers is harmless and a crash
+    at any point of a compaction loses nothing.
+    """
+
+    def __init__(
+        self, data_dir: Path, fsync_delay: float = 0.005, compact_every: int = 1000
+    ):
+        self.data_dir = data_dir
+        self.snapshot_path = data_dir / "user_table.json"
+        self.fsync_delay = fsync_delay
+        self.compact_every = compact_every
+        self.table = {}  # State covered by durable records only
+        self.segment = 0
+        self.records_since_compaction = 0
+        self.pending = []
+        self.compaction_requests = (
+            []
+        )  # futures of `compact()` calls, resolved with their compaction task
+        self.flusher: Optional[asyncio.Task] = None
+        self.compaction: Optional[asyncio.Task] = None
+        self._segment_file = None
+        self._segment_file_index = None
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.data_dir / f"user_table.{segment}.journal"
+
+    def _segments(self) -> list:
+        segments = []
+        for path in self.data_dir.glob("user_table.*.journal"):
+            try:
+                segments.append(int(path.name.split(".")[1]))
+            except ValueError:
+                logger.warning("Ignoring unexpected journal file {}", path)
+        return sorted(segments)
+
+    @staticmethod
+    def _apply(table: dict, record: dict):
+        if record["op"] == "register":
+            table[record["user_id"]] = record["rsid"]
+        else:
+            table.pop(record["user_id"], None)
+
+    def replay(self) -> dict:
+        """Load the snapshot and replay all journal segments onto it. Called
+        synchronously on startup."""
+        if self.snapshot_path.exists():
+            self.table = json.loads(self.snapshot_path.read_text())
+        else:
+            self.data_dir.mkdir(parents=True, exist_ok=True)
+            self.table = {}
+            atomic_write_bytes(self.snapshot_path, b"{}")
+        records = 0
+        segments = self._segments()
+        for segment in segments:
+            for line in self._segment_path(segment).read_bytes().splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Only the tail of the last segment can be torn by a crash, and it
+                    # was never acknowledged
+                    logger.warning(
+                        "Ignoring torn record at the end of gum journal segment {}",
+                        segment,
+                    )
+                    break
+                self._apply(self.table, record)
+                records += 1
+        self.segment = segments[-1] + 1 if segments else 0
+        self.records_since_compaction = records
+        if records:
+            logger.info("Replayed {} gum journal records", records)
+        return self.table
+
+    async def append(self, op: str, user_id, rsid: Optional[str] = None):
+        future = asyncio.get_running_loop().create_future()
+        record = {"op": op, "user_id": user_id, "rsid": rsid}
+        self.pending.append((record, future))
+        self._start_flusher()
+        await future
+
+    def _start_flusher(self):
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush())
+
+    def _write(self, segment: int, data: bytes):
+        # Runs in a worker thread, at most one at a time
+        if self._segment_file_index != segment:
+            if self._segment_file is not None:
+                self._segment_file.close()
+            self._segment_file = open(self._segment_path(segment), "ab")
+            self._segment_file_index = segment
+            fsync_dir(self.data_dir)
+        self._segment_file.write(data)
+        self._segment_file.flush()
+        os.fsync(self._segment_file.fileno())
+
+    async def _flush(self):
+        while self.pending or self.compaction_requests:
+            if self.pending:
+                if self.fsync_delay:
+                    await asyncio.sleep(self.fsync_delay)
+                batch, self.pending = self.pending, []
+                data = b"".join(
+                    json.dumps(record).encode("utf-8") + b"\n" for record, _ in batch
+                )
+                try:
+                    await asyncio.to_thread(self._write, self.segment, data)
+                except Exception as e:
+                    # The segment may now end with a torn line, keep it from hiding
+                    # later records
+                    self.segment += 1
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for record, future in batch:
+                    self._apply(self.table, record)
+                    if not future.done():
+                        future.set_result(None)
+                self.records_since_compaction += len(batch)
+            # Every written record is applied to the table by now, it is safe to
+            # snapshot
+            if self.compaction_requests:
+                requests, self.compaction_requests = self.compaction_requests, []
+                if self.compaction is not None and not self.compaction.done():
+                    # Two snapshots written at once could land in the wrong order
+                    await self.compaction
+                self._start_compaction()
+                for request in requests:
+                    if not request.done():
+                        request.set_result(self.compaction)
+            elif self.records_since_compaction >= self.compact_every and (
+                self.compaction is None or self.compaction.done()
+            ):
+                self._start_compaction()
+
+    def _start_compaction(self):
+        # Rotate right away: whatever is written from now on lands in a segment the
+        # snapshot does not replace
+        self.segment += 1
+        self.records_since_compaction = 0
+        self.compaction = asyncio.create_task(
+            asyncio.to_thread(self._write_snapshot, dict(self.table), self.segment)
+        )
+
+    def _write_snapshot(self, snapshot: dict, segment: int):
+        # Runs in a worker thread
+        try:
+            atomic_write_bytes(self.snapshot_path, json.dumps(snapshot).encode("utf-8"))
+            for obsolete in self._segments():
+                if obsolete < segment:
+                    self._segment_path(obsolete).unlink(missing_ok=True)
+        except Exception as e:
+            logger.warning("Failed to compact gum journal: {}", e)
+            return
+        logger.debug("Compacted gum journal into a snapshot of {} users", len(snapshot))
+
+    async def compact(self):
+        """Force a snapshot, e.g. before a backup of the data directory. The snapshot
+        covers every record appended before the call."""
+        request = asyncio.get_running_loop().create_future()
+        self.compaction_requests.append(request)
+        self._start_flusher()
+        await asyncio.shield(await request)
+
+    async def flush(self):
+        if self.flusher is not None and not self.flusher.done():
+            await self.flusher
+
+    async def close(self):
+        await self.flush()
+        if self.compaction is not None and not self.compaction.done():
+            await self.compaction
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._segment_file = None
+            self._segment_file_index = None
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+from .backup_store import BackupStore
+from .base import DEFAULT_DATA_DIR, UserManager
+from .fileio import atomic_write_bytes, fsync_dir, read_bytes_or_none
+from .journal import UserTableJournal
+from .retention import BackupInfo, RetentionPolicy
+
+
+class JSONUserManager(UserManager):
+    """The example backend: every user is a random-named directory under `data_dir`,
+    holding `meta.json`, one `{game_id}.dat` per game and a `backups` folder. The user
+    table is the `user_table.json` snapshot plus the records of `UserTableJournal`.
+
+    All file I/O runs in worker threads. Files are replaced atomically (temporary file,
+    fsync, `os.replace`), which also lets backups be hard links instead of copies.
+    `durable_writes=False` skips the fsyncs. Backups are managed by `BackupStore`, which
+    packs the older ones into a compressed archive on compaction.
+    """
+
+    def __init__(
+        self,
+        data_dir: Optional[Union[str, Path]] = None,
+        durable_writes: bool = True,
+        **kwargs,
+    ):
+        self.data_dir = Path(data_dir) if data_dir is not None else DEFAULT_DATA_DIR
+        self.durable_writes = durable_writes
+        super().__init__(**kwargs)
+
+    def _load_user_table(self) -> dict:
+        self.journal = UserTableJournal(self.data_dir)
+        return dict(self.journal.replay())
+
+    async def save_user_table(self):
+        # Registrations are journaled one by one, saving the whole table only compacts
+        # the journal
+        await self.journal.compact()
+
+    async def _close(self):
+        await self.journal.close()
+
+    def _user_dir(self, rsid: str) -> Path:
+        return self.data_dir / rsid
+
+    def _game_data_path(self, rsid: str, game_id) -> Path:
+        return self._user_dir(rsid) / f"{game_id}.dat"
+
+    def _backup_store(self, rsid: str) -> BackupStore:
+        return BackupStore(self._user_dir(rsid) / "backups", self.durable_writes)
+
+    @staticmethod
+    def _new_backup(name: str, kind: str = "bak") -> BackupInfo:
+        return BackupInfo(name, datetime.now().timestamp(), kind)
+
+    def _create_user_dir(self, rsid: str, meta: bytes):
+        user_dir = self._user_dir(rsid)
+        os.makedirs(user_dir / "backups")
+        atomic_write_bytes(user_dir / "meta.json", meta, self.durable_writes)
+        if self.durable_writes:
+            fsync_dir(self.data_dir)
+
+    async def _create_user(self, user_id, rsid: str, meta: dict):
+        await asyncio.to_thread(
+            self._create_user_dir, rsid, json.dumps(meta).encode("utf-8")
+        )
+        await self.journal.append("register", user_id, rsid)
+
+    async def _remove_user(self, user_id, rsid: str):
+        await self.journal.append("unregister", user_id)
+
+    async def _read_data(self, rsid: str, game_id):
+        return await asyncio.to_thread(
+            read_bytes_or_none, self._game_data_path(rsid, game_id)
+        )
+
+    async def _has_data(self, rsid: str, game_id) -> bool:
+        return await asyncio.to_thread(self._game_data_path(rsid, game_id).exists)
+
+    async def _write_data(self, rsid: str, game_id, data: bytes):
+        await asyncio.to_thread(
+            atomic_write_bytes,
+            self._game_data_path(rsid, game_id),
+            data,
+            self.durable_writes,
+        )
+
+    async def _backup_data(self, rsid: str, game_id):
+        await asyncio.to_thread(
+            self._backup_store(rsid).add,
+            self._game_data_path(rsid, game_id),
+            self._new_backup(f"{game_id}.dat"),
+        )
+
+    async def _delete_data(self, rsid: str, game_id) -> bool:
+        return await asyncio.to_thread(
+            self._backup_store(rsid).add_moved,
+            self._game_data_path(rsid, game_id),
+            self._new_backup(f"{game_id}.dat", "del"),
+        )
+
+    async def _read_meta(self, rsid: str) -> dict:
+        meta = await asyncio.to_thread(
+            read_bytes_or_none, self._user_dir(rsid) / "meta.json"
+        )
+        if meta is None:
+            raise FileNotFoundError(f"meta.json of {rsid} does not exist")
+        return json.loads(meta)
+
+    async def _write_meta(self, rsid: str, meta: dict):
+        await asyncio.to_thread(
+            atomic_write_bytes,
+            self._user_dir(rsid) / "meta.json",
+            json.dumps(meta).encode("utf-8"),
+            self.durable_writes,
+        )
+
+    async def _backup_meta(self, rsid: str):
+        await asyncio.to_thread(
+            self._backup_store(rsid).add,
+            self._user_dir(rsid) / "meta.json",
+            self._new_backup("meta.json"),
+        )
+
+    async def _list_backups(self, rsid: str) -> list:
+        return await asyncio.to_thread(self._backup_store(rsid).list_backups)
+
+    async def _read_backup(self, rsid: str, name: str, ts: float):
+        return await asyncio.to_thread(self._backup_store(rsid).read, name, ts)
+
+    async def _compact_backups(self, rsid: str, policy: RetentionPolicy) -> tuple:
+        return await asyncio.to_thread(self._backup_store(rsid).compact, policy)
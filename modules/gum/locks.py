@@ -0,0 +1,24 @@
+import asyncio
+import contextlib
+
+
+class UserLockMixin:
+    """Per-user locks, kept in `self._user_locks`."""
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id):
+        """Serialize mutations of one user. Locks are reference-counted and dropped as
+        soon as nobody holds or waits for them, so the lock table only ever contains
+        users that are busy right now.
+        """
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
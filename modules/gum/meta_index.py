@@ -0,0 +1,305 @@
+import asyncio
+import contextlib
+import json
+from pathlib import Path
+from typing import Iterable, Optional
+
+from loguru import logger
+
+from .cache import MISSING
+from .fileio import atomic_write_bytes, read_bytes_or_none
+
+INDEX_FILE_NAME = "meta.json"
+# Present while the index on disk may lag behind the stored meta, i.e. from the first
+# change until the next save
+DIRTY_MARKER_NAME = "meta.dirty"
+INDEX_FORMAT_VERSION = 1
+
+
+def lookup(meta: dict, path: str):
+    """Value at a dotted `path` such as `registration.from_game`, or `MISSING`."""
+    value = meta
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def value_key(value) -> str:
+    # Any JSON value can be indexed, equal values always give the same key
+    return json.dumps(value, sort_keys=True, ensure_ascii=False)
+
+
+class MetaIndex:
+    """Inverted indexes from values of meta keys to the users that have them.
+
+    Every indexed `path` maps each value to the set of user ids whose meta holds it, so
+    a query is one dict lookup regardless of the number of users. Users whose meta lacks
+    the key are not indexed under it.
+    """
+
+    def __init__(self, paths: Iterable[str] = ()):
+        self.paths = tuple(dict.fromkeys(paths))
+        self.postings = {
+            path: {} for path in self.paths
+        }  # path -> value key -> user ids
+        self.entries = {}  # user_id -> {path: value key}
+
+    def add(self, user_id, meta: dict):
+        """Index `meta` as the current meta of `user_id`, replacing what was indexed for
+        it before."""
+        self.remove(user_id)
+        entry = {}
+        for path in self.paths:
+            value = lookup(meta, path)
+            if value is MISSING:
+                continue
+            key = entry[path] = value_key(value)
+            self.postings[path].setdefault(key, set()).add(user_id)
+        if entry:
+            self.entries[user_id] = entry
+
+    def remove(self, user_id):
+        for path, key in self.entries.pop(user_id, {}).items():
+            users = self.postings[path][key]
+            users.discard(user_id)
+            if not users:
+                del self.postings[path][key]
+
+    def find(self, path: str, value) -> set:
+        if path not in self.postings:
+            raise KeyError(f"Meta key {path} is not indexed.")
+        return set(self.postings[path].get(value_key(value), ()))
+
+    def values(self, path: str) -> dict:
+        """Number of users per distinct value of `path`."""
+        if path not in self.postings:
+            raise KeyError(f"Meta key {path} is not indexed.")
+        return {
+            json.loads(key): len(users) for key, users in self.postings[path].items()
+        }
+
+    def dumps(self) -> bytes:
+        return json.dumps(
+            {
+                "version": INDEX_FORMAT_VERSION,
+                "paths": self.paths,
+                "entries": [
+                    [user_id, entry] for user_id, entry in self.entries.items()
+                ],
+            },
+            ensure_ascii=False,
+        ).encode("utf-8")
+
+    @classmethod
+    def loads(cls, data: bytes, paths: Iterable[str]) -> Optional["MetaIndex"]:
+        """Restore an index saved by `dumps`, or `None` if it is unusable for `paths`."""
+        try:
+            saved = json.loads(data)
+        except ValueError:
+            return None
+        index = cls(paths)
+        if (
+            saved.get("version") != INDEX_FORMAT_VERSION
+            or tuple(saved["paths"]) != index.paths
+        ):
+            return None
+        for user_id, entry in saved["entries"]:
+            index.entries[user_id] = entry
+            for path, key in entry.items():
+                index.postings[path].setdefault(key, set()).add(user_id)
+        return index
+
+
+# Blocking persistence helpers, run them in a worker thread
+
+
+def load_index(index_dir: Path, paths: Iterable[str]) -> Optional[MetaIndex]:
+    """The saved index, or `None` if it is missing, unusable, or was left dirty by a
+    crash."""
+    if (index_dir / DIRTY_MARKER_NAME).exists():
+        return None
+    data = read_bytes_or_none(index_dir / INDEX_FILE_NAME)
+    return None if data is None else MetaIndex.loads(data, paths)
+
+
+def mark_dirty(index_dir: Path, fsync: bool = True):
+    index_dir.mkdir(parents=True, exist_ok=True)
+    atomic_write_bytes(index_dir / DIRTY_MARKER_NAME, b"", fsync)
+
+
+def save_index(index_dir: Path, data: bytes, fsync: bool = True):
+    index_dir.mkdir(parents=True, exist_ok=True)
+    atomic_write_bytes(index_dir / INDEX_FILE_NAME, data, fsync)
+    (index_dir / DIRTY_MARKER_NAME).unlink(missing_ok=True)
+
+
+class MetaIndexMixin:
+    """Meta indexes of `UserManager`. The meta keys in `meta_indexes` (dotted paths such
+    as `registration.from_game`) are indexed, `find_users` answers "which users have
+    this value" without reading any meta. The index is kept up to date on `register`,
+    `meta_set` and `unregister`, saved under `data_dir/indexes` at most every
+    `meta_index_save_interval` seconds and on `close()`, and rebuilt from all meta when
+    the saved copy is missing or may be outdated after a crash."""
+
+    def _init_meta_index(
+        self, meta_indexes: Iterable[str], meta_index_save_interval: float
+    ):
+        # Called once the user table is loaded
+        self.meta_index_save_interval = meta_index_save_interval
+        self.meta_index = load_index(self._meta_index_dir, meta_indexes)
+        self._meta_index_stale = self.meta_index is None
+        if self.meta_index is None:
+            self.meta_index = MetaIndex(meta_indexes)
+        self._meta_index_io = (
+            asyncio.Lock()
+        )  # orders writes of the saved index and of its dirty marker
+        self._meta_index_rebuild = asyncio.Lock()
+        self._meta_index_rebuilding: Optional[asyncio.Task] = None
+        self._meta_index_touched: Optional[set] = (
+            None  # users changed while a rebuild runs
+        )
+        self._meta_index_marker: Optional[asyncio.Future] = None
+        self._meta_index_saver: Optional[asyncio.Task] = None
+        # Meta changes between their dirty marker and `_index_meta`, the index is only
+        # saved when there are none
+        self._meta_index_changes = 0
+        self._meta_index_idle = asyncio.Event()
+        self._meta_index_idle.set()
+
+    @property
+    def _meta_index_dir(self) -> Path:
+        return self.data_dir / "indexes"
+
+    async def find_users(self, meta_key: str, value) -> list:
+        """Users whose meta has `value` at the indexed `meta_key`, e.g. `await
+        gum.find_users("registration.from_game", "bingo")`. Raises `KeyError` if
+        `meta_key` is not indexed.
+        """
+        return list((await self._fresh_meta_index()).find(meta_key, value))
+
+    async def count_users_by(self, meta_key: str) -> dict:
+        """Number of users per distinct value of the indexed `meta_key`."""
+        return (await self._fresh_meta_index()).values(meta_key)
+
+    async def declare_meta_index(self, meta_key: str):
+        """Start indexing `meta_key`, building its index from the stored meta of every
+        user."""
+        if meta_key in self.meta_index.paths:
+            return
+        self.meta_index = MetaIndex(self.meta_index.paths + (meta_key,))
+        self._meta_index_stale = True
+        await self._fresh_meta_index()
+
+    async def _fresh_meta_index(self) -> MetaIndex:
+        # Concurrent queries of a stale index share one rebuild
+        if self._meta_index_stale:
+            if (
+                self._meta_index_rebuilding is None
+                or self._meta_index_rebuilding.done()
+            ):
+                self._meta_index_rebuilding = asyncio.ensure_future(
+                    self.rebuild_meta_indexes()
+                )
+            await asyncio.shield(self._meta_index_rebuilding)
+        return self.meta_index
+
+    async def rebuild_meta_indexes(self, batch_size: int = 256):
+        """Rebuild every meta index from the stored meta of all users, then save it."""
+        async with self._meta_index_rebuild:
+            index = MetaIndex(self.meta_index.paths)
+            self._meta_index_touched = set()
+            try:
+                user_ids = list(self.user_table)
+                for start in range(0, len(user_ids), batch_size):
+                    metas = await self.meta_get_many(
+                        user_ids[start : start + batch_size]
+                    )
+                    for user_id, meta in metas.items():
+                        if isinstance(meta, Exception):
+                            logger.warning(
+                                "Cannot index meta of user {}: {}", user_id, meta
+                            )
+                            continue
+                        index.add(user_id, meta)
+                # Users changed meanwhile may have been read before their change, index
+                # them again
+                while self._meta_index_touched:
+                    touched, self._meta_index_touched = self._meta_index_touched, set()
+                    metas = await self.meta_get_many(touched)
+                    for user_id, meta in metas.items():
+                        if isinstance(meta, Exception):
+                            index.remove(user_id)
+                        else:
+                            index.add(user_id, meta)
+            finally:
+                self._meta_index_touched = None
+            self.meta_index = index
+            self._meta_index_stale = False
+            logger.info(
+                "Rebuilt gum meta indexes {} over {} users", index.paths, len(user_ids)
+            )
+        await self._save_meta_index()
+
+    def _index_meta(self, user_id, meta: Optional[dict]):
+        if self._meta_index_touched is not None:
+            self._meta_index_touched.add(user_id)
+        if meta is None:
+            self.meta_index.remove(user_id)
+        else:
+            self.meta_index.add(user_id, meta)
+
+    @contextlib.asynccontextmanager
+    async def _meta_index_change(self):
+        """Wraps a change of stored meta and its `_index_meta`. A save of the index in
+        between would drop the dirty marker without covering the change, so saves wait
+        until no change is in flight.
+        """
+        self._meta_index_changes += 1
+        self._meta_index_idle.clear()
+        try:
+            await self._mark_meta_index_dirty()
+            yield
+        finally:
+            self._meta_index_changes -= 1
+            if self._meta_index_changes == 0:
+                self._meta_index_idle.set()
+
+    async def _mark_meta_index_dirty(self):
+        # The marker must be on disk before the meta change it covers, so that a crash
+        # forces a rebuild
+        if self._meta_index_marker is None:
+            self._meta_index_marker = asyncio.ensure_future(
+                self._write_meta_index_marker()
+            )
+            if self._meta_index_saver is None or self._meta_index_saver.done():
+                self._meta_index_saver = asyncio.create_task(
+                    self._save_meta_index_later()
+                )
+        await asyncio.shield(self._meta_index_marker)
+
+    async def _write_meta_index_marker(self):
+        async with self._meta_index_io:
+            await asyncio.to_thread(mark_dirty, self._meta_index_dir)
+
+    async def _save_meta_index_later(self):
+        await asyncio.sleep(self.meta_index_save_interval)
+        await self._save_meta_index()
+
+    async def _save_meta_index(self):
+        while True:
+            # Not under `_meta_index_io`: the changes in flight may be waiting for it to
+            # write their marker
+            await self._meta_index_idle.wait()
+            async with self._meta_index_io:
+                if self._meta_index_changes:
+                    continue
+                if self._meta_index_stale:
+                    return
+                # Changes from now on write the marker again, after this save removed it
+                self._meta_index_marker = None
+                await asyncio.to_thread(
+                    save_index, self._meta_index_dir, self.meta_index.dumps()
+                )
+                return
@@ -0,0 +1,92 @@
+"""Import an existing `JSONUserManager` data directory into a `SQLiteUserManager`
+database.
+
+Run it from the `modules` directory while the bot is stopped:
+
+```bash
+cd modules && python -m gum.migrate --data-dir ../data --db ../data/gum.sqlite3
+```
+
+The JSON tree is only read, never modified (except that backup folders predating
+`index.jsonl` get one). Users already present in the database are overwritten, so the
+migration can be re-run safely.
+"""
+
+import argparse
+from pathlib import Path
+from typing import Optional, Union
+
+from loguru import logger
+from tqdm import tqdm
+
+from .backup_store import BackupStore
+from .base import DEFAULT_DATA_DIR
+from .journal import UserTableJournal
+from .sqlite_manager import SCHEMA, SQL_UPSERT_DATA, SQL_UPSERT_META, connect
+
+SQL_REPLACE_USER = "INSERT OR REPLACE INTO users (user_id, rsid) VALUES (?, ?)"
+SQL_CLEAR_BACKUPS = "DELETE FROM backups WHERE rsid = ?"
+SQL_INSERT_BACKUP = "INSERT INTO backups (rsid, name, ts, kind, data, codec) VALUES (?, ?, ?, ?, ?, 'raw')"
+
+
+def migrate_json_to_sqlite(
+    data_dir: Optional[Union[str, Path]] = None,
+    db_path: Optional[Union[str, Path]] = None,
+    with_backups: bool = True,
+) -> int:
+    """Copy the user table, meta, game data and (optionally) backups of every registered
+    user. Returns the number of migrated users."""
+    data_dir = Path(data_dir) if data_dir is not None else DEFAULT_DATA_DIR
+    db_path = Path(db_path) if db_path is not None else data_dir / "gum.sqlite3"
+    user_table = UserTableJournal(data_dir).replay()
+
+    conn = connect(db_path)
+    try:
+        conn.executescript(SCHEMA)
+        conn.execute("BEGIN")
+        for user_id, rsid in tqdm(user_table.items(), desc="Migrating users"):
+            user_dir = data_dir / rsid
+            conn.execute(SQL_REPLACE_USER, (user_id, rsid))
+            conn.execute(SQL_UPSERT_META, (rsid, (user_dir / "meta.json").read_text()))
+            for game_data_path in user_dir.glob("*.dat"):
+                conn.execute(
+                    SQL_UPSERT_DATA,
+                    (rsid, game_data_path.stem, game_data_path.read_bytes()),
+                )
+            if not with_backups or not (user_dir / "backups").is_dir():
+                continue
+            conn.execute(SQL_CLEAR_BACKUPS, (rsid,))
+            store = BackupStore(user_dir / "backups")
+            for info in store.list_backups():
+                data = store.read(info.name, info.ts)
+                if data is None:
+                    logger.warning("Skipping missing backup {} of {}", info, rsid)
+                    continue
+                conn.execute(
+                    SQL_INSERT_BACKUP, (rsid, info.name, info.ts, info.kind, data)
+                )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    logger.success(
+        "Migrated {} users from {} to {}", len(user_table), data_dir, db_path
+    )
+    return len(user_table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--data-dir", default=None, help="JSON data directory (default: data/)"
+    )
+    parser.add_argument(
+        "--db", default=None, help="SQLite database (default: <data-dir>/gum.sqlite3)"
+    )
+    parser.add_argument(
+        "--no-backups", action="store_true", help="do not import backups"
+    )
+    args = parser.parse_args()
+    migrate_json_to_sqlite(args.data_dir, args.db, with_backups=not args.no_backups)
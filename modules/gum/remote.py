@@ -0,0 +1,69 @@
+"""`UserManager` of the gateway process, for the worker processes of the sharded runtime
+(see kbx/sharding.py).
+
+Every call is forwarded to the gum of the gateway process, so all workers see the same
+users and data, and the gateway's user locks serialize the mutations of a user across
+workers. Data and exceptions travel pickled. `user_lock` only serializes within one
+worker, and `cache_stats` is that of the gateway (awaited, unlike
+`UserManager.cache_stats`).
+"""
+
+from .base import GameDataNotFoundError, UserNotFoundError
+from .locks import UserLockMixin
+
+FORWARDED = {
+    "register",
+    "unregister",
+    "save_user_table",
+    "has_user",
+    "get_data_for_game",
+    "has_data_for_game",
+    "set_data_for_game",
+    "delete_data_for_game",
+    "flush",
+    "meta_get",
+    "meta_set",
+    "dump_user_table",
+    "get_many",
+    "set_many",
+    "meta_get_many",
+    "list_backups",
+    "get_backup",
+    "restore_backup",
+    "compact_backups",
+    "find_users",
+    "count_users_by",
+    "declare_meta_index",
+    "rebuild_meta_indexes",
+    "cache_stats",
+}
+
+
+class RemoteUserManager(UserLockMixin):
+    def __init__(self, name: str = "gum"):
+        from kbx.sharding import shared
+
+        self._remote = shared(name)
+        self._user_locks = {}
+
+    def __getattr__(self, method: str):
+        if method not in FORWARDED:
+            raise AttributeError(f"{method} is not available on the gum of a shard")
+        return getattr(self._remote, method)
+
+    async def iter_game_data(self, game_id, batch_size: int = 256):
+        user_ids = list(await self._remote.dump_user_table())
+        for start in range(0, len(user_ids), batch_size):
+            batch = await self._remote.get_many(
+                user_ids[start : start + batch_size], game_id
+            )
+            for user_id, data in batch.items():
+                if isinstance(data, (GameDataNotFoundError, UserNotFoundError)):
+                    continue
+                if isinstance(data, Exception):
+                    raise data
+                yield user_id, data
+
+    async def close(self):
+        # The gateway process owns the data and closes it
+        pass
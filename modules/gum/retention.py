@@ -0,0 +1,137 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from loguru import logger
+
+from .errors import BackupNotFoundError
+
+
+@dataclass(frozen=True)
+class BackupInfo:
+    # `name` is the backed-up file, e.g. `{game_id}.dat` or `meta.json`
+    name: str
+    ts: float
+    # `bak` for a backup taken before an overwrite, `del` for deleted data
+    kind: str
+    # Whether the backup was packed into the compressed archive of its user
+    archived: bool = False
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """Which backups of one file survive a compaction.
+
+    The `keep_last` newest backups are always kept (and stay uncompressed). Beyond that,
+    the newest backup of each of the last `hourly` clock hours and of each of the last
+    `daily` days is kept. Everything else is deleted.
+    """
+
+    keep_last: int = 10
+    hourly: int = 24
+    daily: int = 30
+
+    def select(self, timestamps: Iterable[float], now: Optional[float] = None) -> set:
+        now = time.time() if now is None else now
+        newest_first = sorted(timestamps, reverse=True)
+        kept = set(newest_first[: self.keep_last])
+        for bucket_size, buckets in ((3600, self.hourly), (86400, self.daily)):
+            oldest_bucket = int(now // bucket_size) - buckets
+            seen = set()
+            for ts in newest_first:
+                bucket = int(ts // bucket_size)
+                if bucket <= oldest_bucket:
+                    break
+                if bucket not in seen:
+                    seen.add(bucket)
+                    kept.add(ts)
+        return kept
+
+
+class BackupRetentionMixin:
+    """Backups of `UserManager`. Users that got new backups are compacted every
+    `backup_compaction_interval` seconds according to `backup_retention` (`None` keeps
+    every backup forever). `list_backups` and `restore_backup` give access to them."""
+
+    def _init_backup_retention(
+        self,
+        backup_retention: Optional[RetentionPolicy],
+        backup_compaction_interval: float,
+    ):
+        self.backup_retention = backup_retention
+        self.backup_compaction_interval = backup_compaction_interval
+        self._backups_touched = {}  # rsid -> user_id
+        self._backup_compactor: Optional[asyncio.Task] = None
+
+    async def list_backups(self, user_id) -> list:
+        """All backups of a user as `BackupInfo`, sorted by file name then time. `name`
+        is `{game_id}.dat` or `meta.json`."""
+        rsid = self._rsid_of(user_id)
+        return sorted(await self._list_backups(rsid), key=lambda b: (b.name, b.ts))
+
+    async def get_backup(self, user_id, name: str, ts: float) -> bytes:
+        rsid = self._rsid_of(user_id)
+        data = await self._read_backup(rsid, name, ts)
+        if data is None:
+            raise BackupNotFoundError(
+                f"Backup {name} at {ts} not found for user {user_id}."
+            )
+        return data
+
+    async def restore_backup(self, user_id, game_id, ts: float):
+        """Make the backup of game data taken at `ts` the current data. The data it
+        replaces is backed up first."""
+        async with self.user_lock(user_id):
+            rsid = self._rsid_of(user_id)
+            data = await self._read_backup(rsid, f"{game_id}.dat", ts)
+            if data is None:
+                raise BackupNotFoundError(
+                    f"Backup of game {game_id} at {ts} not found for user {user_id}."
+                )
+            dirty = self._dirty.pop((rsid, game_id), None)
+            if dirty is not None:
+                # Write it first so the restore backs it up like any stored data
+                await self._persist_data(user_id, rsid, game_id, dirty[1], dirty[2])
+            await self._persist_data(user_id, rsid, game_id, data, backup=True)
+
+    def _touch_backups(self, user_id, rsid: str):
+        if self.backup_retention is None:
+            return
+        self._backups_touched[rsid] = user_id
+        if self._backup_compactor is None or self._backup_compactor.done():
+            self._backup_compactor = asyncio.create_task(self._compact_periodically())
+
+    async def _compact_periodically(self):
+        while self._backups_touched:
+            await asyncio.sleep(self.backup_compaction_interval)
+            await self.compact_backups()
+
+    async def compact_backups(self, user_id=None):
+        """Apply the retention policy now, to one user or to every user that got new
+        backups since the last compaction."""
+        if self.backup_retention is None:
+            return
+        if user_id is not None:
+            targets = {self._rsid_of(user_id): user_id}
+        else:
+            targets, self._backups_touched = self._backups_touched, {}
+        for rsid, target_user_id in targets.items():
+            self._backups_touched.pop(rsid, None)
+            async with self.user_lock(target_user_id):
+                try:
+                    dropped, archived = await self._compact_backups(
+                        rsid, self.backup_retention
+                    )
+                except Exception as e:
+                    logger.warning(
+                        "Failed to compact backups of user {}: {}", target_user_id, e
+                    )
+                    continue
+            if dropped or archived:
+                logger.debug(
+                    "Compacted backups of user {}: {} dropped, {} archived",
+                    target_user_id,
+                    dropped,
+                    archived,
+                )
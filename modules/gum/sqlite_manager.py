@@ -0,0 +1,413 @@
+import asyncio
+import json
+import queue
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+from loguru import logger
+
+from .base import DEFAULT_DATA_DIR, UserManager
+from .retention import BackupInfo, RetentionPolicy
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    rsid TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    rsid TEXT PRIMARY KEY,
+    meta TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS game_data (
+    rsid TEXT NOT NULL,
+    game_id TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (rsid, game_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rsid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    data BLOB NOT NULL,
+    codec TEXT NOT NULL DEFAULT 'raw'
+);
+CREATE INDEX IF NOT EXISTS backups_by_name ON backups (rsid, name, ts);
+"""
+
+# Statements are kept as module constants so that sqlite3's per-connection statement
+# cache always hits
+SQL_SELECT_USERS = "SELECT user_id, rsid FROM users"
+SQL_INSERT_USER = "INSERT INTO users (user_id, rsid) VALUES (?, ?)"
+SQL_DELETE_USER = "DELETE FROM users WHERE user_id = ?"
+SQL_SELECT_META = "SELECT meta FROM meta WHERE rsid = ?"
+SQL_UPSERT_META = "INSERT OR REPLACE INTO meta (rsid, meta) VALUES (?, ?)"
+# Batches pass their keys as one JSON array, so the statement text (and its cache entry)
+# never depends on the size
+SQL_SELECT_DATA_MANY = (
+    "SELECT rsid, data FROM game_data"
+    " WHERE game_id = ? AND rsid IN (SELECT value FROM json_each(?))"
+)
+SQL_SELECT_META_MANY = (
+    "SELECT rsid, meta FROM meta WHERE rsid IN (SELECT value FROM json_each(?))"
+)
+SQL_SELECT_DATA = "SELECT data FROM game_data WHERE rsid = ? AND game_id = ?"
+SQL_EXISTS_DATA = "SELECT 1 FROM game_data WHERE rsid = ? AND game_id = ?"
+SQL_UPSERT_DATA = (
+    "INSERT OR REPLACE INTO game_data (rsid, game_id, data) VALUES (?, ?, ?)"
+)
+SQL_DELETE_DATA = "DELETE FROM game_data WHERE rsid = ? AND game_id = ?"
+SQL_BACKUP_DATA = (
+    "INSERT INTO backups (rsid, name, ts, kind, data)"
+    " SELECT rsid, ?, ?, ?, data FROM game_data WHERE rsid = ? AND game_id = ?"
+)
+SQL_LIST_BACKUPS = "SELECT name, ts, kind, codec FROM backups WHERE rsid = ?"
+SQL_SELECT_BACKUP = (
+    "SELECT data, codec FROM backups WHERE rsid = ? AND name = ? AND ts = ?"
+)
+SQL_LIST_BACKUP_IDS = "SELECT id, name, ts, codec FROM backups WHERE rsid = ?"
+SQL_DELETE_BACKUP = "DELETE FROM backups WHERE id = ?"
+SQL_COMPRESS_BACKUP = "UPDATE backups SET data = ?, codec = 'zlib' WHERE id = ?"
+SQL_SELECT_BACKUP_BY_ID = "SELECT data FROM backups WHERE id = ?"
+SQL_BACKUP_META = (
+    "INSERT INTO backups (rsid, name, ts, kind, data)"
+    " SELECT rsid, 'meta.json', ?, 'bak', CAST(meta AS BLOB) FROM meta WHERE rsid = ?"
+)
+
+
+def connect(
+    db_path: Union[str, Path],
+    synchronous: str = "NORMAL",
+    check_same_thread: bool = True,
+) -> sqlite3.Connection:
+    """Open a connection in autocommit mode (transactions are explicit) with WAL
+    journaling enabled."""
+    conn = sqlite3.connect(
+        str(db_path),
+        isolation_level=None,
+        check_same_thread=check_same_thread,
+        cached_statements=256,
+    )
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+
+def _resolve(future: asyncio.Future, ok: bool, value):
+    if future.done():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+class SQLiteWriter(threading.Thread):
+    """Owns the only writing connection to the database.
+
+    Jobs are plain functions `fn(conn, *args)` submitted from the event loop. The thread
+    drains everything that is queued and commits it as one transaction, isolating each
+    job in a savepoint so a failing job does not take its neighbours down with it.
+    """
+
+    def __init__(
+        self,
+        db_path: Union[str, Path],
+        synchronous: str = "NORMAL",
+        max_batch: int = 128,
+    ):
+        super().__init__(name="gum-sqlite-writer", daemon=True)
+        self.db_path = db_path
+        self.synchronous = synchronous
+        self.max_batch = max_batch
+        self.jobs = queue.SimpleQueue()
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.jobs.put((fn, args, future, loop))
+        return future
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def run(self):
+        conn = connect(self.db_path, self.synchronous)
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self.jobs.get()]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self.jobs.get_nowait())
+                    except queue.Empty:
+                        break
+                stopping = None in batch
+                self.run_batch(conn, [job for job in batch if job is not None])
+        finally:
+            conn.close()
+
+    def run_batch(self, conn: sqlite3.Connection, batch: list):
+        if not batch:
+            return
+        try:
+            results = self._execute(conn, batch)
+        except Exception as e:
+            # BEGIN (`database is locked` once busy_timeout ran out), a savepoint or the
+            # COMMIT failed: every job of the batch fails, the thread keeps serving
+            logger.warning("gum SQLite batch of {} jobs failed: {}", len(batch), e)
+            if conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception as rollback_error:
+                    logger.warning("gum SQLite rollback failed: {}", rollback_error)
+            results = [(future, loop, False, e) for _, _, future, loop in batch]
+        for future, loop, ok, value in results:
+            try:
+                loop.call_soon_threadsafe(_resolve, future, ok, value)
+            except RuntimeError:
+                # The loop that submitted the job is gone, nobody is waiting for the
+                # result
+                logger.debug("Dropping gum SQLite result for a closed event loop")
+
+    def _execute(self, conn: sqlite3.Connection, batch: list) -> list:
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        for fn, args, future, loop in batch:
+            conn.execute("SAVEPOINT job")
+            try:
+                results.append((future, loop, True, fn(conn, *args)))
+                conn.execute("RELEASE job")
+            except Exception as e:
+                conn.execute("ROLLBACK TO job")
+                conn.execute("RELEASE job")
+                results.append((future, loop, False, e))
+        conn.execute("COMMIT")
+        return results
+
+
+class SQLiteUserManager(UserManager):
+    """Stores users, meta, game data and backups in one SQLite database.
+
+    Writes go through a dedicated `SQLiteWriter` thread, reads run on the default
+    executor with one read-only connection per thread. Thanks to WAL mode readers never
+    wait for the writer. `close()` closes every reader connection, each is only ever
+    used by the thread that opened it before that.
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[Union[str, Path]] = None,
+        synchronous: str = "NORMAL",
+        **kwargs,
+    ):
+        self.db_path = (
+            Path(db_path) if db_path is not None else DEFAULT_DATA_DIR / "gum.sqlite3"
+        )
+        self.data_dir = self.db_path.parent
+        self.synchronous = synchronous
+        self._readers = threading.local()
+        self._reader_conns = []
+        self._reader_conns_lock = threading.Lock()
+        super().__init__(**kwargs)
+        self.writer = SQLiteWriter(self.db_path, synchronous)
+        self.writer.start()
+
+    def _load_user_table(self) -> dict:
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        conn = connect(self.db_path, self.synchronous)
+        try:
+            conn.executescript(SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(backups)")]
+            if "codec" not in columns:
+                # Databases created before backups could be compressed
+                conn.execute(
+                    "ALTER TABLE backups ADD COLUMN codec TEXT NOT NULL DEFAULT 'raw'"
+                )
+            return dict(conn.execute(SQL_SELECT_USERS).fetchall())
+        finally:
+            conn.close()
+
+    async def _close(self):
+        self.writer.stop()
+        await asyncio.to_thread(self.writer.join)
+        with self._reader_conns_lock:
+            conns, self._reader_conns = self._reader_conns, []
+        for conn in conns:
+            conn.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            # Closed by `_close` from another thread
+            conn = connect(self.db_path, self.synchronous, check_same_thread=False)
+            conn.execute("PRAGMA query_only = ON")
+            self._readers.conn = conn
+            with self._reader_conns_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    async def _read(self, sql: str, *params):
+        def fetch_one():
+            return self._reader().execute(sql, params).fetchone()
+
+        return await asyncio.to_thread(fetch_one)
+
+    async def _read_all(self, sql: str, *params) -> list:
+        def fetch_all():
+            return self._reader().execute(sql, params).fetchall()
+
+        return await asyncio.to_thread(fetch_all)
+
+    async def _write(self, fn, *args):
+        return await self.writer.submit(fn, *args)
+
+    @staticmethod
+    def _sql_create_user(conn: sqlite3.Connection, user_id, rsid: str, meta: str):
+        conn.execute(SQL_INSERT_USER, (user_id, rsid))
+        conn.execute(SQL_UPSERT_META, (rsid, meta))
+
+    @staticmethod
+    def _sql_delete_data(
+        conn: sqlite3.Connection, rsid: str, game_id, ts: float
+    ) -> bool:
+        conn.execute(SQL_BACKUP_DATA, (f"{game_id}.dat", ts, "del", rsid, game_id))
+        return conn.execute(SQL_DELETE_DATA, (rsid, game_id)).rowcount > 0
+
+    @staticmethod
+    def _sql_write_data_many(
+        conn: sqlite3.Connection, game_id, items: list, backup: bool, ts: float
+    ):
+        if backup:
+            # Inserts nothing for users without data yet
+            conn.executemany(
+                SQL_BACKUP_DATA,
+                [(f"{game_id}.dat", ts, "bak", rsid, game_id) for rsid, _ in items],
+            )
+        conn.executemany(
+            SQL_UPSERT_DATA, [(rsid, game_id, data) for rsid, data in items]
+        )
+
+    @staticmethod
+    def _sql_compact_backups(
+        conn: sqlite3.Connection, rsid: str, policy: RetentionPolicy
+    ) -> tuple:
+        versions = {}
+        for backup_id, name, ts, codec in conn.execute(SQL_LIST_BACKUP_IDS, (rsid,)):
+            versions.setdefault(name, []).append((ts, backup_id, codec))
+        dropped = compressed = 0
+        for rows in versions.values():
+            kept = policy.select([ts for ts, _, _ in rows])
+            newest = set(sorted(kept, reverse=True)[: policy.keep_last])
+            for ts, backup_id, codec in rows:
+                if ts not in kept:
+                    conn.execute(SQL_DELETE_BACKUP, (backup_id,))
+                    dropped += 1
+                elif ts not in newest and codec == "raw":
+                    data = conn.execute(
+                        SQL_SELECT_BACKUP_BY_ID, (backup_id,)
+                    ).fetchone()[0]
+                    conn.execute(
+                        SQL_COMPRESS_BACKUP, (zlib.compress(data, 9), backup_id)
+                    )
+                    compressed += 1
+        return dropped, compressed
+
+    @staticmethod
+    def _sql_execute(conn: sqlite3.Connection, sql: str, params: tuple):
+        conn.execute(sql, params)
+
+    async def _create_user(self, user_id, rsid: str, meta: dict):
+        await self._write(self._sql_create_user, user_id, rsid, json.dumps(meta))
+
+    async def _remove_user(self, user_id, rsid: str):
+        await self._write(self._sql_execute, SQL_DELETE_USER, (user_id,))
+
+    async def _read_data(self, rsid: str, game_id):
+        row = await self._read(SQL_SELECT_DATA, rsid, game_id)
+        return None if row is None else bytes(row[0])
+
+    async def _has_data(self, rsid: str, game_id) -> bool:
+        return await self._read(SQL_EXISTS_DATA, rsid, game_id) is not None
+
+    async def _write_data(self, rsid: str, game_id, data: bytes):
+        await self._write(self._sql_execute, SQL_UPSERT_DATA, (rsid, game_id, data))
+
+    async def _backup_data(self, rsid: str, game_id):
+        await self._write(
+            self._sql_execute,
+            SQL_BACKUP_DATA,
+            (f"{game_id}.dat", datetime.now().timestamp(), "bak", rsid, game_id),
+        )
+
+    async def _delete_data(self, rsid: str, game_id) -> bool:
+        return await self._write(
+            self._sql_delete_data, rsid, game_id, datetime.now().timestamp()
+        )
+
+    async def _read_meta(self, rsid: str) -> dict:
+        row = await self._read(SQL_SELECT_META, rsid)
+        if row is None:
+            raise FileNotFoundError(f"meta of {rsid} does not exist")
+        return json.loads(row[0])
+
+    async def _write_meta(self, rsid: str, meta: dict):
+        await self._write(self._sql_execute, SQL_UPSERT_META, (rsid, json.dumps(meta)))
+
+    async def _backup_meta(self, rsid: str):
+        await self._write(
+            self._sql_execute, SQL_BACKUP_META, (datetime.now().timestamp(), rsid)
+        )
+
+    async def _list_backups(self, rsid: str) -> list:
+        rows = await self._read_all(SQL_LIST_BACKUPS, rsid)
+        return [
+            BackupInfo(name, ts, kind, codec != "raw") for name, ts, kind, codec in rows
+        ]
+
+    async def _read_backup(self, rsid: str, name: str, ts: float):
+        row = await self._read(SQL_SELECT_BACKUP, rsid, name, ts)
+        if row is None:
+            return None
+        data, codec = row
+        return zlib.decompress(data) if codec == "zlib" else bytes(data)
+
+    async def _compact_backups(self, rsid: str, policy: RetentionPolicy) -> tuple:
+        return await self._write(self._sql_compact_backups, rsid, policy)
+
+    async def _read_data_many(self, rsids: list, game_id) -> list:
+        rows = dict(
+            await self._read_all(SQL_SELECT_DATA_MANY, game_id, json.dumps(rsids))
+        )
+        return [None if rsid not in rows else bytes(rows[rsid]) for rsid in rsids]
+
+    async def _read_meta_many(self, rsids: list) -> list:
+        rows = dict(await self._read_all(SQL_SELECT_META_MANY, json.dumps(rsids)))
+        return [
+            (
+                json.loads(rows[rsid])
+                if rsid in rows
+                else FileNotFoundError(f"meta of {rsid} does not exist")
+            )
+            for rsid in rsids
+        ]
+
+    async def _write_data_many(self, game_id, items: list, backup: bool) -> list:
+        # One job, hence one transaction: the whole batch is written or none of it
+        try:
+            await self._write(
+                self._sql_write_data_many,
+                game_id,
+                items,
+                backup,
+                datetime.now().timestamp(),
+            )
+        except Exception as e:
+            return [e] * len(items)
+        return [None] * len(items)
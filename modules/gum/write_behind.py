@@ -0,0 +1,77 @@
+import asyncio
+from typing import Optional
+
+from loguru import logger
+
+
+class WriteBehindMixin:
+    """Write-behind mode of `UserManager`. With `write_behind=True`, `set_data_for_game`
+    only records the data as dirty and returns; later writes to the same game data
+    replace earlier ones. Dirty data is written every `flush_interval` seconds, as soon
+    as `flush_max_dirty` entries are dirty, and on `flush()` / `close()`. Errors of
+    deferred writes are logged. Reads see dirty data before the stored one."""
+
+    def _init_write_behind(
+        self, write_behind: bool, flush_interval: float, flush_max_dirty: int
+    ):
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_max_dirty = flush_max_dirty
+        self._dirty = {}  # (rsid, game_id) -> (user_id, data, backup)
+        self._flush_wanted = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def _defer_write(self, user_id, rsid: str, game_id, data: bytes, backup: bool):
+        # Callers hold the lock of the user
+        previous = self._dirty.get((rsid, game_id))
+        # One backup of the stored data covers every write coalesced into it
+        backup = backup or (previous is not None and previous[2])
+        self._dirty[rsid, game_id] = (user_id, data, backup)
+        with self._cache_write():
+            self._cache_data(rsid, game_id, data)
+        self._start_flusher()
+        if len(self._dirty) >= self.flush_max_dirty:
+            self._flush_wanted.set()
+
+    def _start_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        # Exits once everything is written, the next deferred write starts it again
+        while self._dirty:
+            try:
+                await asyncio.wait_for(self._flush_wanted.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wanted.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write all dirty game data now. Entries that fail are logged and kept dirty
+        for the next flush."""
+        for key in list(self._dirty):
+            entry = self._dirty.get(key)
+            if entry is None:
+                continue
+            rsid, game_id = key
+            user_id = entry[0]
+            async with self.user_lock(user_id):
+                # Writers of this user are blocked, but the entry may have been deleted
+                # meanwhile
+                entry = self._dirty.get(key)
+                if entry is None:
+                    continue
+                try:
+                    await self._persist_data(user_id, rsid, game_id, entry[1], entry[2])
+                except Exception as e:
+                    logger.warning(
+                        "Deferred write of game {} for user {} failed, will retry: {}",
+                        game_id,
+                        user_id,
+                        e,
+                    )
+                    continue
+                # Only now stop serving it from memory, readers never see a half-written
+                # file
+                del self._dirty[key]
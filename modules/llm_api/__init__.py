@@ -8,58 +8,131 @@ from loguru import logger
 from khl import Bot, Event, Message
 from khl.api import Message as MessageAPI
 
-from .llm_base import LLM, LLMReturnChunk
+from stream_edit import MessageStreamer
+
+from .http_pool import get_http_client, http_clients
+from .config_loader import get_config
+from .conversation import (
+    ConversationStore,
+    JSONConversationBackend,
+    summarize_with,
+)
+from .llm_base import DEFAULT_CACHE_DIR, LLM, CachingLLM, LLMQueueFull, LLMReturnChunk
 from .openai_api import GPT4o
+from .router import RouterLLM
 import os
+from typing import Optional
 
 DEBUG_FLAG = os.environ.get("KOOKBOTX_DEBUG") == "1"
+# Seconds identical prompts are answered from the cache, 0 disables it
+LLM_CACHE_TTL = float(os.environ.get("KOOKBOTX_LLM_CACHE_TTL", "3600"))
+# Cached answers are kept in memory only, unless written to data/llm_cache to survive
+# restarts
+LLM_CACHE_DISK = os.environ.get("KOOKBOTX_LLM_CACHE_DISK") == "1"
 
 llm_GPT4o = GPT4o()
+# With a `router` entry in config.json, /kbx is spread over the listed OpenAI-compatible
+# backends
+router_config = get_config("router") or {}
+if router_config.get("backends"):
+    llm_GPT4o = RouterLLM(
+        "router",
+        [GPT4o(name) for name in router_config["backends"]],
+        hedge=router_config.get("hedge", True),
+        hedge_delay=router_config.get("hedge_delay", 5.0),
+    )
+if LLM_CACHE_TTL > 0:
+    llm_GPT4o = CachingLLM(
+        llm_GPT4o,
+        ttl=LLM_CACHE_TTL,
+        cache_dir=DEFAULT_CACHE_DIR if LLM_CACHE_DISK else None,
+    )
+
+# Tokens of earlier conversation sent with each /kbx (per user and channel), 0 makes
+# every /kbx stand alone
+LLM_HISTORY_TOKENS = int(os.environ.get("KOOKBOTX_LLM_HISTORY_TOKENS", "3000"))
+conversations = (
+    ConversationStore(
+        JSONConversationBackend(),
+        max_tokens=LLM_HISTORY_TOKENS,
+        summarizer=summarize_with(llm_GPT4o),
+    )
+    if LLM_HISTORY_TOKENS > 0
+    else None
+)
 
 
 class LLMStopGeneration(Exception):
     pass
 
 
+def conversation_key(msg: Message) -> str:
+    channel = getattr(msg.ctx, "channel", None)
+    return f"{getattr(channel, 'id', None)}:{msg.author_id}"
+
+
 @logger.catch
 async def call_llm(
-    bot: Bot, msg: Message, llm: LLM, command: str, update_per_modification: int = 5
+    bot: Bot,
+    msg: Message,
+    llm: LLM,
+    command: str,
+    max_edits_per_second: float = 1.0,
+    conversations: Optional[ConversationStore] = None,
 ):
     prompt = msg.content[len(command) :].strip()
     if prompt == "":
         await msg.reply("Please provide a prompt for the LLM.")
         return
+    key = conversation_key(msg)
+    history = await conversations.history(key) if conversations is not None else None
 
     try:
         await msg.add_reaction("☕")
         ret = await msg.reply(f"Querying `{llm.name}`...")
-        msg_id = ret["msg_id"]
-        gate = msg.gate
         response_text = ""
-        modifications = 0
-        async for chunk in llm.query(prompt):
-            if chunk.has_error:
-                raise Exception(chunk.error_info)
-                break
-            if chunk.should_stop:
-                raise LLMStopGeneration(chunk.stop_reason)
-            response_text += chunk.content
-            modifications += 1
-            if modifications % update_per_modification == 0:
-                if response_text.strip() != "":
-                    await gate.exec_req(
-                        MessageAPI.update(msg_id=msg_id, content=response_text.strip())
+        # Edits are sent by the streamer's own task, the LLM stream is consumed at full
+        # speed
+        async with MessageStreamer(
+            msg.gate, ret["msg_id"], max_edits_per_second
+        ) as streamer:
+
+            def show_queue_position(position: int, estimated_wait: float):
+                if response_text == "":
+                    streamer.update(
+                        f"Querying `{llm.name}`... (#{position} in queue, about {estimated_wait:.0f}s)"
                     )
-    except LLMStopGeneration as e:
-        if response_text.strip() != "":
-            await gate.exec_req(
-                MessageAPI.update(msg_id=msg_id, content=response_text.strip())
-            )
-        else:
-            await msg.reply("(No response from `{llm.name}`)")
+
+            guild = getattr(msg.ctx, "guild", None)
+            async for chunk in llm.limited_query(
+                prompt,
+                user_id=msg.author_id,
+                guild_id=guild.id if guild is not None else None,
+                on_queued=show_queue_position,
+                history=history,
+            ):
+                if chunk.has_error:
+                    raise Exception(chunk.error_info)
+                # The last chunk may carry content as well
+                response_text += chunk.content
+                streamer.update(response_text)
+                if chunk.should_stop:
+                    break
+        # Leaving the block above sent the final text
+        if response_text.strip() == "":
+            await msg.reply(f"(No response from `{llm.name}`)")
+        elif conversations is not None:
+            await conversations.record(key, prompt, response_text)
         await msg.delete_reaction("☕")
         await msg.add_reaction("✅")
         return
+    except LLMQueueFull as e:
+        await msg.reply(
+            f"`{llm.name}` is too busy right now (about {e.estimated_wait:.0f}s of queue), please try again later."
+        )
+        await msg.delete_reaction("☕")
+        await msg.add_reaction("❌")
+        return
     except Exception as e:
         await msg.delete_reaction("☕")
         await msg.add_reaction("❌")
@@ -84,4 +157,39 @@ def init(_bot: Bot):
 
     @_bot.command("kbx")
     async def gpt_4o(msg: Message, *args):
-        await call_llm(_bot, msg, llm_GPT4o, command="/kbx")
+        await call_llm(
+            _bot, msg, llm_GPT4o, command="/kbx", conversations=conversations
+        )
+
+    @_bot.command("kbx-reset")
+    async def reset_conversation(msg: Message, *args):
+        if conversations is not None:
+            await conversations.reset(conversation_key(msg))
+        await msg.reply("Conversation forgotten, the next /kbx starts afresh.")
+
+
+async def teardown():
+    if conversations is not None:
+        await conversations.aclose()
+    # Close the pooled connections of every LLM provider
+    await http_clients.aclose()
+
+
+def dump_state():
+    # On hot reload, ongoing conversations are carried over to the new version, which
+    # owns them from then on: teardown() leaves them open
+    global conversations
+    state = {"conversations": conversations}
+    conversations = None
+    return state
+
+
+def load_state(state):
+    global conversations
+    store = state.get("conversations")
+    if LLM_HISTORY_TOKENS > 0 and store is not None:
+        # The summarizer of the handed over store queries the LLM of the version that
+        # dumped it, whose pooled clients its teardown() closed
+        store.summarizer = summarize_with(llm_GPT4o)
+        store.max_tokens = LLM_HISTORY_TOKENS
+        conversations = store
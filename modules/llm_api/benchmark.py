@@ -0,0 +1,142 @@
+"""Benchmark of the pooled HTTP client against one client per query, run it from the
+`modules` directory:
+
+```bash
+python -m llm_api.benchmark --queries 200 --concurrency 16 --handshake-ms 50
+```
+
+A local aiohttp server mimics OpenAI's streamed `/v1/chat/completions`. Localhost
+connections are nearly free, so the server waits `--handshake-ms` before answering the
+first request of every new connection, standing in for the TCP and TLS handshakes to a
+real provider.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+from aiohttp import web
+
+from .http_pool import HTTPClientRegistry
+
+
+def create_mock_server(
+    chunks: int, chunk_delay: float, handshake: float
+) -> web.Application:
+    seen_connections = set()
+
+    async def completions(request: web.Request):
+        # Keeping the transports alive keeps their identities unique
+        connection = request.transport
+        if connection not in seen_connections:
+            seen_connections.add(connection)
+            await asyncio.sleep(handshake)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(chunks):
+            finish_reason = "stop" if i == chunks - 1 else None
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "model": "mock",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": f"token{i} "},
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    app["connections"] = seen_connections
+    return app
+
+
+async def stream_completion(client: httpx.AsyncClient, base_url: str) -> float:
+    """Stream one completion, returning the time to the first chunk."""
+    start = time.perf_counter()
+    first_chunk = None
+    body = {
+        "model": "mock",
+        "stream": True,
+        "messages": [{"role": "user", "content": "hi"}],
+    }
+    async with client.stream(
+        "POST", f"{base_url}/chat/completions", json=body
+    ) as response:
+        async for line in response.aiter_lines():
+            if line.startswith("data: ") and first_chunk is None:
+                first_chunk = time.perf_counter() - start
+    return first_chunk
+
+
+async def run_queries(args, base_url: str, pooled: bool):
+    registry = HTTPClientRegistry({"http2": False})
+    remaining = iter(range(args.queries))
+    ttfts = []
+
+    async def worker():
+        for _ in remaining:
+            if pooled:
+                ttfts.append(await stream_completion(registry.get(base_url), base_url))
+            else:
+                async with registry.build_client() as client:
+                    ttfts.append(await stream_completion(client, base_url))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    total = time.perf_counter() - start
+    await registry.aclose()
+    return total, ttfts
+
+
+async def main(args):
+    print(
+        f"queries={args.queries} concurrency={args.concurrency} chunks={args.chunks} handshake={args.handshake_ms}ms"
+    )
+    print(
+        f"{'client':>10} {'queries/s':>10} {'p50 TTFT':>10} {'p99 TTFT':>10} {'connections':>12}"
+    )
+    for name, pooled in (("pooled", True), ("per-call", False)):
+        app = create_mock_server(
+            args.chunks, args.chunk_delay_ms / 1000, args.handshake_ms / 1000
+        )
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            total, ttfts = await run_queries(
+                args, f"http://127.0.0.1:{port}/v1", pooled
+            )
+        finally:
+            await runner.cleanup()
+        p99 = statistics.quantiles(ttfts, n=100)[-1] if len(ttfts) > 1 else ttfts[0]
+        print(
+            f"{name:>10} {args.queries / total:>10.1f} {statistics.median(ttfts) * 1000:>8.1f}ms"
+            f" {p99 * 1000:>8.1f}ms {len(app['connections']):>12}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="pooled vs per-call HTTP clients for LLM providers"
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--chunks", type=int, default=20, help="streamed chunks per completion"
+    )
+    parser.add_argument("--chunk-delay-ms", type=float, default=1.0)
+    parser.add_argument("--handshake-ms", type=float, default=50.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,352 @@
+"""Multi-turn conversations for LLMs, kept within a token budget.
+
+A `ConversationStore` remembers the turns of every conversation (e.g. one per user and
+channel) and hands out the history to send with the next query. The history never
+exceeds `max_tokens`: older turns are folded into a running summary by a `summarizer` in
+the background (or dropped without one), and the newest turns that fit are sent as they
+are. Idle conversations are evicted from memory in LRU order and read back from the
+persistence backend on demand.
+
+```python
+store = ConversationStore(
+    JSONConversationBackend(), max_tokens=3000, summarizer=summarize_with(llm)
+)
+history = await store.history("channel:user")
+answer = ...  # llm.query(prompt, history=history)
+await store.record("channel:user", prompt, answer)
+```
+"""
+
+import asyncio
+import collections
+import hashlib
+import os
+import re
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+import orjson
+from loguru import logger
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    # Without tiktoken (`pip install tiktoken`) tokens are estimated
+    _encoding = None
+
+DEFAULT_CONVERSATION_DIR = (
+    Path(__file__).resolve().parent.parent.parent / "data" / "llm_conversations"
+)
+# Tokens spent on the role and separators of every message
+MESSAGE_OVERHEAD = 4
+_CJK = re.compile(r"[　-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+
+def count_tokens(text: str) -> int:
+    """Tokens of `text`, exact with tiktoken, otherwise about one per CJK character and
+    one per 4 other characters."""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@dataclass
+class Turn:
+    role: str
+    content: str
+    tokens: int = 0
+
+    def __post_init__(self):
+        if not self.tokens:
+            self.tokens = count_tokens(self.content) + MESSAGE_OVERHEAD
+
+
+@dataclass
+class Conversation:
+    key: str
+    summary: str = ""
+    turns: List[Turn] = field(default_factory=list)
+    last_active: float = field(default_factory=time.time)
+
+    @property
+    def turn_tokens(self) -> int:
+        return sum(turn.tokens for turn in self.turns)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Conversation":
+        return cls(
+            key=data["key"],
+            summary=data.get("summary", ""),
+            turns=[Turn(**turn) for turn in data.get("turns", [])],
+            last_active=data.get("last_active", time.time()),
+        )
+
+
+class ConversationBackend:
+    """Where conversations are persisted. Subclasses implement all three methods."""
+
+    async def load(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def save(self, key: str, data: dict):
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryConversationBackend(ConversationBackend):
+    """Keeps nothing, conversations are forgotten once evicted from the store (or on
+    restart)."""
+
+    async def load(self, key: str) -> Optional[dict]:
+        return None
+
+    async def save(self, key: str, data: dict):
+        pass
+
+    async def delete(self, key: str):
+        pass
+
+
+class JSONConversationBackend(ConversationBackend):
+    """One JSON file per conversation in `directory`."""
+
+    def __init__(self, directory: Union[str, Path] = DEFAULT_CONVERSATION_DIR):
+        self.directory = Path(directory)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{hashlib.sha256(key.encode()).hexdigest()[:32]}.json"
+
+    async def load(self, key: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._load, key)
+
+    def _load(self, key: str) -> Optional[dict]:
+        try:
+            return orjson.loads(self._path(key).read_bytes())
+        except FileNotFoundError:
+            return None
+
+    async def save(self, key: str, data: dict):
+        await asyncio.to_thread(self._save, key, data)
+
+    def _save(self, key: str, data: dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(orjson.dumps(data))
+        os.replace(tmp_path, path)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._path(key).unlink, missing_ok=True)
+
+
+Summarizer = Callable[[str, List[Turn]], Awaitable[str]]
+
+SUMMARY_PROMPT = """Summarize the conversation below in a few sentences, keeping the facts, names, decisions and open \
+questions that later replies may need. Answer with the summary only.
+
+{summary}{transcript}"""
+
+
+def summarize_with(llm) -> Summarizer:
+    """A summarizer asking `llm` (within its concurrency limit) to fold `turns` into the
+    previous summary."""
+
+    async def summarize(summary: str, turns: List[Turn]) -> str:
+        transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in turns)
+        prompt = SUMMARY_PROMPT.format(
+            summary=f"Summary so far: {summary}\n\n" if summary else "",
+            transcript=transcript,
+        )
+        text = ""
+        async for chunk in llm.limited_query(prompt):
+            if chunk.has_error:
+                raise RuntimeError(chunk.error_info)
+            text += chunk.content
+            if chunk.should_stop:
+                break
+        if not text.strip():
+            raise RuntimeError("empty summary")
+        return text.strip()
+
+    return summarize
+
+
+class ConversationStore:
+    """Token-budgeted conversation histories, bounded in memory and persisted through
+    `backend`.
+
+    `history(key)` returns at most `max_tokens` worth of messages: the summary of older
+    turns followed by the newest turns that fit. Once the stored turns of a conversation
+    exceed `max_tokens`, the oldest are folded into the summary in the background until
+    `compact_to` (a fraction of `max_tokens`) is left, so summarization happens once
+    every few turns and never delays a reply. Conversations idle for more than
+    `idle_timeout` seconds start over.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[ConversationBackend] = None,
+        max_tokens: int = 3000,
+        compact_to: float = 0.5,
+        max_conversations: int = 512,
+        idle_timeout: Optional[float] = 24 * 3600,
+        summarizer: Optional[Summarizer] = None,
+    ):
+        self.backend = backend if backend is not None else MemoryConversationBackend()
+        self.max_tokens = max_tokens
+        self.compact_to = compact_to
+        self.max_conversations = max_conversations
+        self.idle_timeout = idle_timeout
+        self.summarizer = summarizer
+        self.conversations: "collections.OrderedDict[str, Conversation]" = (
+            collections.OrderedDict()
+        )
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._compacting: Dict[str, asyncio.Task] = {}
+        self.summaries = self.evictions = 0
+
+    def _lock(self, key: str) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def get(self, key: str) -> Conversation:
+        """The conversation of `key`, loaded from the backend if not in memory."""
+        conversation = self.conversations.get(key)
+        if conversation is None:
+            data = None
+            try:
+                data = await self.backend.load(key)
+            except Exception as e:
+                logger.warning("Failed to load conversation {}: {}", key, e)
+            # Another caller may have loaded it meanwhile
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                conversation = (
+                    Conversation.from_dict(data) if data else Conversation(key)
+                )
+                self.conversations[key] = conversation
+        if (
+            self.idle_timeout is not None
+            and time.time() - conversation.last_active > self.idle_timeout
+        ):
+            conversation = self.conversations[key] = Conversation(key)
+        self.conversations.move_to_end(key)
+        self._evict()
+        return conversation
+
+    def _evict(self):
+        # Everything in memory is already persisted, evicting only drops the in-memory
+        # copy
+        while len(self.conversations) > self.max_conversations:
+            key, _ = self.conversations.popitem(last=False)
+            if key not in self._compacting and not self._lock(key).locked():
+                self._locks.pop(key, None)
+            self.evictions += 1
+
+    async def history(self, key: str, max_tokens: Optional[int] = None) -> List[dict]:
+        """Messages (`{"role": ..., "content": ...}`) to send before the next prompt of
+        `key`."""
+        conversation = await self.get(key)
+        budget = self.max_tokens if max_tokens is None else max_tokens
+        messages = []
+        summary = None
+        if conversation.summary:
+            summary = f"Summary of the earlier conversation: {conversation.summary}"
+            budget -= count_tokens(summary) + MESSAGE_OVERHEAD
+        for turn in reversed(conversation.turns):
+            if turn.tokens > budget:
+                break
+            budget -= turn.tokens
+            messages.append({"role": turn.role, "content": turn.content})
+        messages.reverse()
+        if summary is not None:
+            messages.insert(0, {"role": "system", "content": summary})
+        return messages
+
+    async def record(self, key: str, prompt: str, answer: str):
+        """Append one exchange to the conversation of `key` and persist it."""
+        async with self._lock(key):
+            conversation = await self.get(key)
+            conversation.turns.append(Turn("user", prompt))
+            conversation.turns.append(Turn("assistant", answer))
+            conversation.last_active = time.time()
+            await self._save(conversation)
+        if conversation.turn_tokens > self.max_tokens and key not in self._compacting:
+            task = self._compacting[key] = asyncio.create_task(self.compact(key))
+            task.add_done_callback(lambda _: self._compacting.pop(key, None))
+
+    async def reset(self, key: str):
+        async with self._lock(key):
+            self.conversations[key] = Conversation(key)
+            try:
+                await self.backend.delete(key)
+            except Exception as e:
+                logger.warning("Failed to delete conversation {}: {}", key, e)
+
+    async def compact(self, key: str):
+        """Fold the oldest turns of `key` into its summary until `compact_to *
+        max_tokens` worth of turns is left."""
+        conversation = await self.get(key)
+        target = int(self.max_tokens * self.compact_to)
+        excess = conversation.turn_tokens - target
+        folded = []
+        for turn in conversation.turns:
+            if excess <= 0:
+                break
+            folded.append(turn)
+            excess -= turn.tokens
+        if not folded:
+            return
+        summary = None
+        if self.summarizer is not None:
+            try:
+                # Turns may be recorded while the summarizer runs, only `folded` are
+                # replaced
+                summary = await self.summarizer(conversation.summary, folded)
+            except Exception as e:
+                logger.warning("Failed to summarize conversation {}: {}", key, e)
+                # Keep the turns for the next attempt, but not without bound
+                if conversation.turn_tokens <= 2 * self.max_tokens:
+                    return
+        async with self._lock(key):
+            if self.conversations.get(key) is not conversation or any(
+                a is not b for a, b in zip(conversation.turns, folded)
+            ):
+                # Reset meanwhile
+                return
+            del conversation.turns[: len(folded)]
+            if summary is not None:
+                conversation.summary = summary
+                self.summaries += 1
+            await self._save(conversation)
+
+    async def _save(self, conversation: Conversation):
+        try:
+            await self.backend.save(conversation.key, conversation.to_dict())
+        except Exception as e:
+            logger.warning("Failed to save conversation {}: {}", conversation.key, e)
+
+    async def aclose(self):
+        """Wait for the summaries being written."""
+        if self._compacting:
+            await asyncio.gather(*self._compacting.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "conversations": len(self.conversations),
+            "compacting": len(self._compacting),
+            "summaries": self.summaries,
+            "evictions": self.evictions,
+        }
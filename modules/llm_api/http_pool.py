@@ -0,0 +1,103 @@
+"""Process-wide pooled HTTP clients for LLM providers.
+
+Every provider should get its `httpx.AsyncClient` from `get_http_client` instead of
+building its own, so that connections to the same endpoint are kept alive and reused
+across queries and across LLM instances. Clients are keyed by `(base_url, proxy)`; they
+are closed by the `teardown()` of `llm_api` when KookBotX shuts down.
+
+Pool settings come from the optional `http` entry of `config.json`:
+
+```json
+{
+    "http": {
+        "max_connections": 32,
+        "max_keepalive_connections": 16,
+        "keepalive_expiry": 30,
+        "http2": true,
+        "connect_timeout": 10,
+        "read_timeout": 120
+    }
+}
+```
+
+HTTP/2 is off by default, as it needs the `h2` package (`pip install httpx[http2]`) that
+requirements.txt does not install. With `"http2": true` but without `h2`, clients fall
+back to HTTP/1.1.
+"""
+
+import asyncio
+import importlib.util
+from typing import Dict, Optional, Tuple
+
+import httpx
+from loguru import logger
+
+from .config_loader import default_config_loader
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+DEFAULT_HTTP_CONFIG = {
+    "max_connections": 32,
+    "max_keepalive_connections": 16,
+    "keepalive_expiry": 30.0,
+    "http2": False,
+    "connect_timeout": 10.0,
+    # Streamed completions may pause for a long time between two chunks
+    "read_timeout": 120.0,
+}
+
+
+class HTTPClientRegistry:
+    def __init__(self, config: Optional[dict] = None):
+        self.config = {**DEFAULT_HTTP_CONFIG, **(config or {})}
+        self.clients: Dict[Tuple[Optional[str], Optional[str]], httpx.AsyncClient] = {}
+        if self.config["http2"] and not HTTP2_AVAILABLE:
+            logger.warning(
+                "HTTP/2 for LLM providers needs the h2 package (`pip install httpx[http2]`), using HTTP/1.1"
+            )
+
+    def build_client(self, proxy: Optional[str] = None) -> httpx.AsyncClient:
+        config = self.config
+        return httpx.AsyncClient(
+            proxy=proxy or None,
+            http2=bool(config["http2"]) and HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=config["max_connections"],
+                max_keepalive_connections=config["max_keepalive_connections"],
+                keepalive_expiry=config["keepalive_expiry"],
+            ),
+            timeout=httpx.Timeout(
+                config["read_timeout"], connect=config["connect_timeout"]
+            ),
+        )
+
+    def get(
+        self, base_url: Optional[str] = None, proxy: Optional[str] = None
+    ) -> httpx.AsyncClient:
+        """The shared client for `base_url` through `proxy`, created on first use."""
+        key = (base_url, proxy or None)
+        client = self.clients.get(key)
+        if client is None or client.is_closed:
+            client = self.clients[key] = self.build_client(proxy)
+            logger.debug(
+                "Created pooled HTTP client for {} (proxy: {})", base_url, proxy
+            )
+        return client
+
+    async def aclose(self):
+        clients, self.clients = list(self.clients.values()), {}
+        results = await asyncio.gather(
+            *(client.aclose() for client in clients), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("Failed to close pooled HTTP client: {}", result)
+
+
+http_clients = HTTPClientRegistry(default_config_loader.config.get("http"))
+
+
+def get_http_client(
+    base_url: Optional[str] = None, proxy: Optional[str] = None
+) -> httpx.AsyncClient:
+    return http_clients.get(base_url, proxy)
@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import contextlib
+import math
+import time
+from typing import Callable, Optional
+
+from loguru import logger
+
+
+class LLMQueueFull(Exception):
+    """Raised instead of queueing a query whose estimated wait exceeds the limit."""
+
+    def __init__(self, estimated_wait: float):
+        super().__init__(f"LLM queue is full, estimated wait {estimated_wait:.0f}s")
+        self.estimated_wait = estimated_wait
+
+
+class _Waiter:
+    __slots__ = ("future", "on_queued", "position")
+
+    def __init__(self, future: asyncio.Future, on_queued: Optional[Callable]):
+        self.future = future
+        self.on_queued = on_queued
+        self.position = None
+
+
+class FairLimiter:
+    """Caps the number of concurrent queries of one model and queues the rest fairly.
+
+    Waiting queries are served round-robin across guilds, and round-robin across users
+    inside a guild, so a burst from one user (or one guild) cannot starve the others.
+    `on_queued(position, estimated_wait)` callbacks are told about every change of their
+    position. The wait is estimated from a moving average of recent query durations;
+    queries that would wait longer than `max_wait` seconds are rejected with
+    `LLMQueueFull` right away.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        max_wait: Optional[float] = 120.0,
+        initial_duration: float = 20.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.avg_duration = initial_duration
+        self.active = 0
+        # guild -> user -> waiters, both levels in round-robin order
+        self.queues = collections.OrderedDict()
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(w) for users in self.queues.values() for w in users.values())
+
+    def _service_order(self) -> list:
+        """Waiters in the order they will be served."""
+        guilds = [
+            [collections.deque(waiters) for waiters in users.values()]
+            for users in self.queues.values()
+        ]
+        order = []
+        while guilds:
+            for users in guilds:
+                # The first user of each guild gets one turn, then moves to the back of
+                # its guild
+                waiters = users.pop(0)
+                order.append(waiters.popleft())
+                if waiters:
+                    users.append(waiters)
+            guilds = [users for users in guilds if users]
+        return order
+
+    def estimated_wait(self, position: int) -> float:
+        """Seconds until the query at 1-based `position` of the queue starts."""
+        return math.ceil(position / self.max_concurrency) * self.avg_duration
+
+    def _notify(self):
+        for position, waiter in enumerate(self._service_order(), start=1):
+            if waiter.position == position:
+                continue
+            waiter.position = position
+            if waiter.on_queued is not None:
+                try:
+                    waiter.on_queued(position, self.estimated_wait(position))
+                except Exception as e:
+                    logger.warning("LLM queue position callback failed: {}", e)
+
+    def _enqueue(self, waiter: _Waiter, guild_id, user_id):
+        users = self.queues.setdefault(guild_id, collections.OrderedDict())
+        users.setdefault(user_id, collections.deque()).append(waiter)
+
+    def _dequeue(self, waiter: _Waiter, guild_id, user_id):
+        users = self.queues.get(guild_id)
+        if users is None or user_id not in users:
+            return
+        with contextlib.suppress(ValueError):
+            users[user_id].remove(waiter)
+        if not users[user_id]:
+            del users[user_id]
+        if not users:
+            del self.queues[guild_id]
+
+    def _grant_next(self):
+        while self.active < self.max_concurrency and self.queues:
+            guild_id, users = next(iter(self.queues.items()))
+            user_id, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+            # The served user and guild go to the back of their round
+            if waiters:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if users:
+                self.queues.move_to_end(guild_id)
+            else:
+                del self.queues[guild_id]
+            if waiter.future.done():
+                continue
+            self.active += 1
+            waiter.future.set_result(None)
+        self._notify()
+
+    def _release(self, started: float):
+        self.active -= 1
+        self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - started)
+        self._grant_next()
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self, user_id=None, guild_id=None, on_queued: Optional[Callable] = None
+    ):
+        """Hold one of the `max_concurrency` slots for the duration of the block,
+        queueing until one is free."""
+        if self.active >= self.max_concurrency or self.queues:
+            waiter = _Waiter(asyncio.get_running_loop().create_future(), on_queued)
+            self._enqueue(waiter, guild_id, user_id)
+            position = self._service_order().index(waiter) + 1
+            wait = self.estimated_wait(position)
+            if self.max_wait is not None and wait > self.max_wait:
+                self._dequeue(waiter, guild_id, user_id)
+                self.rejected += 1
+                raise LLMQueueFull(wait)
+            self._grant_next()
+            try:
+                await waiter.future
+            except BaseException:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Granted just before being cancelled, hand the slot on
+                    self.active -= 1
+                    self._grant_next()
+                else:
+                    self._dequeue(waiter, guild_id, user_id)
+                    self._notify()
+                raise
+        else:
+            self.active += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(started)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "avg_duration": self.avg_duration,
+            "rejected": self.rejected,
+        }
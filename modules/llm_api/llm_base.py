@@ -1,10 +1,18 @@
 import asyncio
-from dataclasses import dataclass
-from typing import AsyncIterator
+import collections
+import hashlib
+import os
+import re
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import AsyncIterator, Callable, List, Optional, Union
 
+import orjson
 from loguru import logger
 
 from .config_loader import get_config
+from .limiter import FairLimiter, LLMQueueFull
 
 
 @dataclass
@@ -21,17 +29,30 @@ class LLMReturnChunk:
 class LLM:
 
     def __init__(self, name):
-        """Initialize an LLM instance with the given name. The name is used to load the corresponding configuration from the config file. See `config_loader.py` for more information."""
+        """Initialize an LLM instance with the given name. The name is used to load the
+        corresponding configuration from the config file. See `config_loader.py` for
+        more information."""
         self.name = name
-        self.config = self.get_config(name)
+        # Models without a config entry still load, and report the missing settings when
+        # queried
+        self.config = self.get_config(name) or {}
+        # `max_concurrency` and `max_queue_wait` (seconds, null for no limit) may be set
+        # per model in the config
+        self.limiter = FairLimiter(
+            max_concurrency=self.config.get("max_concurrency", 4),
+            max_wait=self.config.get("max_queue_wait", 120),
+        )
 
     def get_config(self, name):
         return get_config(name)
 
-    async def query(self, query_str: str) -> AsyncIterator[LLMReturnChunk]:
+    async def query(
+        self, query_str: str, history: Optional[List[dict]] = None
+    ) -> AsyncIterator[LLMReturnChunk]:
         """Query an LLM about given query string.
 
-        By default, only streaming LLMs are supported. A typical use case is to use this method in an async context:
+        By default, only streaming LLMs are supported. A typical use case is to use this
+        method in an async context:
 
         ```python
         async for chunk in llm.query("Hello! Who are you?"):
@@ -44,7 +65,14 @@ class LLM:
             print(chunk.content)
         ```
 
-        Each chunk is an instance of `LLMReturnChunk`. The `should_stop` field indicates whether the LLM has finished processing the query and the `content` field contains the actual content of the chunk. If `has_error` is `True`, the `error_info` field contains the error message.
+        Each chunk is an instance of `LLMReturnChunk`. The `should_stop` field indicates
+        whether the LLM has finished processing the query and the `content` field
+        contains the actual content of the chunk. If `has_error` is `True`, the
+        `error_info` field contains the error message.
+
+        `history` holds the earlier messages of the conversation (`{"role": ...,
+        "content": ...}`, oldest first), see `conversation.py`. LLMs without multi-turn
+        support may ignore it.
         """
         if self.name == "NoModel":
             for i in range(3):
@@ -67,6 +95,277 @@ class LLM:
                 "Please implement your own LLM class from the LLM base class."
             )
 
+    async def limited_query(
+        self,
+        query_str: str,
+        user_id=None,
+        guild_id=None,
+        on_queued: Optional[Callable[[int, float], None]] = None,
+        history: Optional[List[dict]] = None,
+    ) -> AsyncIterator[LLMReturnChunk]:
+        """`query` within the concurrency limit of this model, queueing fairly per guild
+        and user.
+
+        `on_queued(position, estimated_wait)` is called whenever the position of the
+        waiting query changes. Raises `LLMQueueFull` if the estimated wait is too long.
+        """
+        async with self.limiter.slot(user_id, guild_id, on_queued):
+            async for chunk in self.query(query_str, history):
+                yield chunk
+
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent.parent.parent / "data" / "llm_cache"
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+class _SharedQuery:
+    """One upstream stream, replayed to any number of consumers from the first chunk."""
+
+    def __init__(self, stream: AsyncIterator[LLMReturnChunk]):
+        self.chunks = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Condition()
+        self.task = asyncio.create_task(self._pump(stream))
+
+    async def _pump(self, stream):
+        try:
+            async for chunk in stream:
+                async with self._changed:
+                    self.chunks.append(chunk)
+                    self._changed.notify_all()
+                if chunk.should_stop or chunk.has_error:
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            # Breaking out of `async for` leaves the stream suspended; closing it runs
+            # its cleanup (releasing the HTTP response) now rather than whenever it is
+            # garbage collected
+            try:
+                await stream.aclose()
+            except Exception as e:
+                logger.warning("Failed to close an LLM stream: {}", e)
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    @property
+    def cacheable(self) -> bool:
+        return (
+            self.error is None
+            and bool(self.chunks)
+            and not any(chunk.has_error for chunk in self.chunks)
+        )
+
+    async def replay(self) -> AsyncIterator[LLMReturnChunk]:
+        i = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: i < len(self.chunks) or self.done)
+                chunks = self.chunks[i:]
+                done = self.done
+            for chunk in chunks:
+                yield chunk
+            i += len(chunks)
+            if done and i == len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class CachingLLM(LLM):
+    """Wraps an LLM with a response cache and in-flight deduplication.
+
+    Queries are keyed on the model, the whitespace-normalized prompt, the conversation
+    history and `params`. Identical queries running at the same time share one upstream
+    stream; completed answers are kept for `ttl` seconds, at most `max_entries` in
+    memory and, if `cache_dir` is set (e.g. to `DEFAULT_CACHE_DIR`), at most
+    `max_disk_entries` on disk, and replayed as a stream, so callers cannot tell a cache
+    hit from a fresh answer. Answers with an error are never cached. Answers on disk are
+    stored in clear, conversation included.
+    """
+
+    def __init__(
+        self,
+        llm: LLM,
+        ttl: float = 3600,
+        max_entries: int = 256,
+        cache_dir: Optional[Union[str, Path]] = None,
+        max_disk_entries: int = 4096,
+        params: Optional[dict] = None,
+    ):
+        # Not calling `LLM.__init__`: the configuration is the wrapped LLM's
+        self.llm = llm
+        self.name = llm.name
+        self.config = llm.config
+        self.limiter = llm.limiter
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.max_disk_entries = max_disk_entries
+        self.params = params or {}
+        self.entries = collections.OrderedDict()  # key -> (expires_at, chunks)
+        self.in_flight = {}  # key -> _SharedQuery
+        self.hits = self.misses = self.shared = 0
+
+    def cache_key(self, query_str: str, history: Optional[List[dict]] = None) -> str:
+        material = orjson.dumps(
+            [
+                self.llm.name,
+                self.config.get("model_name"),
+                normalize_prompt(query_str),
+                self.params,
+                history or [],
+            ],
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(material).hexdigest()
+
+    async def query(
+        self, query_str: str, history: Optional[List[dict]] = None
+    ) -> AsyncIterator[LLMReturnChunk]:
+        upstream = lambda: self.llm.query(query_str, history)
+        async for chunk in self._cached(self.cache_key(query_str, history), upstream):
+            yield chunk
+
+    async def limited_query(
+        self,
+        query_str: str,
+        user_id=None,
+        guild_id=None,
+        on_queued: Optional[Callable[[int, float], None]] = None,
+        history: Optional[List[dict]] = None,
+    ) -> AsyncIterator[LLMReturnChunk]:
+        # Only a query that actually reaches the model takes a slot, cache hits and
+        # shared streams do not
+        upstream = lambda: self.llm.limited_query(
+            query_str, user_id, guild_id, on_queued, history
+        )
+        async for chunk in self._cached(self.cache_key(query_str, history), upstream):
+            yield chunk
+
+    async def _cached(
+        self, key: str, upstream: Callable
+    ) -> AsyncIterator[LLMReturnChunk]:
+        chunks = self._get_memory(key)
+        if chunks is None and key not in self.in_flight:
+            chunks = await self._get_disk(key)
+        if chunks is not None:
+            self.hits += 1
+            for chunk in chunks:
+                yield chunk
+            return
+        # Checked after the disk lookup, an identical query may have started meanwhile.
+        # A failed stream stays in `in_flight` until its done callback runs, a retry
+        # must not replay its error
+        shared = self.in_flight.get(key)
+        if shared is not None and (shared.cacheable or not shared.done):
+            self.shared += 1
+            async for chunk in shared.replay():
+                yield chunk
+            return
+
+        self.misses += 1
+        shared = self.in_flight[key] = _SharedQuery(upstream())
+        shared.task.add_done_callback(lambda _: self._finish(key, shared))
+        async for chunk in shared.replay():
+            yield chunk
+
+    def _finish(self, key: str, shared: _SharedQuery):
+        if self.in_flight.get(key) is shared:
+            del self.in_flight[key]
+        if not shared.cacheable:
+            return
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, expires_at, shared.chunks)
+        if self.cache_dir is not None:
+            task = asyncio.create_task(
+                asyncio.to_thread(self._write_disk, key, expires_at, shared.chunks)
+            )
+            task.add_done_callback(self._log_disk_error)
+
+    def _get_memory(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, chunks = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return chunks
+
+    def _put_memory(self, key: str, expires_at: float, chunks: list):
+        self.entries[key] = (expires_at, chunks)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def _get_disk(self, key: str):
+        if self.cache_dir is None:
+            return None
+        try:
+            entry = await asyncio.to_thread(self._read_disk, key)
+        except Exception as e:
+            logger.warning("Ignoring unreadable LLM cache entry {}: {}", key, e)
+            return None
+        if entry is None:
+            return None
+        expires_at, chunks = entry
+        # Promote it, the next hit is served from memory
+        self._put_memory(key, expires_at, chunks)
+        return chunks
+
+    def _read_disk(self, key: str):
+        path = self.cache_dir / f"{key}.json"
+        try:
+            entry = orjson.loads(path.read_bytes())
+        except FileNotFoundError:
+            return None
+        if entry["expires_at"] <= time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry["expires_at"], [
+            LLMReturnChunk(**chunk) for chunk in entry["chunks"]
+        ]
+
+    def _write_disk(self, key: str, expires_at: float, chunks: list):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir / f"{key}.json"
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(
+            orjson.dumps(
+                {
+                    "expires_at": expires_at,
+                    "chunks": [asdict(chunk) for chunk in chunks],
+                }
+            )
+        )
+        os.replace(tmp_path, path)
+        entries = list(self.cache_dir.glob("*.json"))
+        if len(entries) > self.max_disk_entries:
+            entries.sort(key=lambda p: p.stat().st_mtime)
+            for old in entries[: len(entries) - self.max_disk_entries]:
+                old.unlink(missing_ok=True)
+
+    @staticmethod
+    def _log_disk_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to write LLM cache entry: {}", task.exception())
+
+    def cache_stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "entries": len(self.entries),
+            "in_flight": len(self.in_flight),
+        }
+
 
 async def __test():
     llm = LLM("NoModel")
@@ -11,24 +11,30 @@ except ImportError:
     )
 
 import asyncio
-from typing import AsyncIterator
+from typing import AsyncIterator, List, Optional
 
-from httpx import AsyncClient
 from loguru import logger
 
+from .http_pool import get_http_client
 from .llm_base import LLM, LLMReturnChunk
 
 
 class GPT4o(LLM):
-    def __init__(self):
+    def __init__(self, name: str = "gpt-4o"):
+        # Other OpenAI-compatible models use the same class under their own config entry
+        # (see `base_url`)
         super().__init__(
-            "gpt-4o"
+            name
         )  # self.config should be populated with the corresponding configuration
         self.build_client()
 
     def build_client(self):
-        """Build httpx client for OpenAI API. If a proxy is provided (e.g. http://127.0.0.1:25501), it will be used."""
+        """Build the OpenAI client on the shared, pooled httpx client of its endpoint.
+        If a proxy is provided (e.g. http://127.0.0.1:25501), it will be used.
+        `base_url` may point to any OpenAI-compatible server.
+        """
         proxy = self.config.get("proxy", None)
+        base_url = self.config.get("base_url", None)
         api_key = self.config.get("api_key", None)
         if api_key is None:
             logger.warning(
@@ -36,14 +42,17 @@ class GPT4o(LLM):
             )
             self.client = None
             return
-        if proxy:
-            httpx_client = AsyncClient(proxies=proxy)
-            self.client = AsyncOpenAI(api_key=api_key, http_client=httpx_client)
-        else:
-            self.client = AsyncOpenAI(api_key=self.config["api_key"])
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=get_http_client(base_url, proxy),
+        )
 
-    async def query(self, query_str: str) -> AsyncIterator[LLMReturnChunk]:
-        """Query GPT-4o with the given query string, streaming the response back in chunks."""
+    async def query(
+        self, query_str: str, history: Optional[List[dict]] = None
+    ) -> AsyncIterator[LLMReturnChunk]:
+        """Query GPT-4o with the given query string after the `history` messages,
+        streaming the response back in chunks."""
         if self.client is None:
             yield LLMReturnChunk(
                 has_error=True,
@@ -54,14 +63,15 @@ class GPT4o(LLM):
         # Simulating sending a query to GPT-4o and receiving streamed responses
         response = await self.client.chat.completions.create(
             model=self.config.get("model_name", "gpt-4o"),
-            messages=[{"role": "user", "content": query_str}],
+            messages=[*(history or []), {"role": "user", "content": query_str}],
             temperature=0.3,
             stream=True,
         )
 
         async for chunk in response:
             try:
-                # Assuming chunk structure has 'choices' with 'finish_reason' and 'delta' with 'content'
+                # Assuming chunk structure has 'choices' with 'finish_reason' and
+                # 'delta' with 'content'
                 should_finish = chunk.choices[0].finish_reason
                 try:
                     delta_content = chunk.choices[0].delta.content
@@ -0,0 +1,255 @@
+import asyncio
+import collections
+import statistics
+import time
+from typing import AsyncIterator, List, Optional
+
+from loguru import logger
+
+from .llm_base import LLM, LLMReturnChunk
+
+
+class BackendStats:
+    """Rolling time-to-first-token and error rate of one backend."""
+
+    def __init__(self, window: int = 50):
+        self.ttfts = collections.deque(maxlen=window)
+        self.outcomes = collections.deque(maxlen=window)  # True for success
+        self.cancelled = 0
+        self.cooldown_until = 0.0
+
+    def record_first_token(self, ttft: float):
+        self.ttfts.append(ttft)
+
+    def record_success(self):
+        self.outcomes.append(True)
+
+    def record_failure(self):
+        self.outcomes.append(False)
+
+    def record_cancelled(self, elapsed: float):
+        # A stream cancelled before its first token took at least `elapsed`: a lower
+        # bound of its time-to-first-token that keeps a backend that always loses the
+        # race ranked behind the winner. It is neither a success nor a failure, so it
+        # does not count in the error rate.
+        self.ttfts.append(elapsed)
+        self.cancelled += 1
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def percentile(self, q: int) -> Optional[float]:
+        if len(self.ttfts) < 2:
+            return self.ttfts[0] if self.ttfts else None
+        return statistics.quantiles(self.ttfts, n=100)[q - 1]
+
+    def to_dict(self) -> dict:
+        return {
+            "p50_ttft": self.percentile(50),
+            "p95_ttft": self.percentile(95),
+            "error_rate": self.error_rate,
+            "samples": len(self.outcomes),
+            "ttft_samples": len(self.ttfts),
+            "cancelled": self.cancelled,
+            "cooling_down": self.cooldown_until > time.monotonic(),
+        }
+
+
+class BackendFailed(Exception):
+    pass
+
+
+class RouterLLM(LLM):
+    """Spreads queries over several backends, preferring the one with the lowest recent
+    time-to-first-token.
+
+    A backend whose error rate over the last `window` queries exceeds `max_error_rate`
+    (with at least `min_samples` queries) is skipped for `cooldown` seconds. A backend
+    that fails before its first token is failed over to the next one; failing later,
+    it only counts as an error. With `hedge=True`,
+    when the first token has not arrived within the backend's p95 time-to-first-token
+    (`hedge_delay` seconds until enough samples exist), the next backend is queried as
+    well; the first one to produce a token wins and the other stream is cancelled.
+
+    Backends are any `LLM`, so fake backends can stand in for real providers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        backends: List[LLM],
+        hedge: bool = True,
+        hedge_delay: float = 5.0,
+        window: int = 50,
+        max_error_rate: float = 0.5,
+        min_samples: int = 4,
+        cooldown: float = 30.0,
+    ):
+        super().__init__(name)
+        if not backends:
+            raise ValueError("RouterLLM needs at least one backend")
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.stats = {backend.name: BackendStats(window) for backend in backends}
+        self.hedged = 0
+
+    def healthy(self, backend: LLM) -> bool:
+        return self.stats[backend.name].cooldown_until <= time.monotonic()
+
+    def ranked_backends(self) -> List[LLM]:
+        """Healthy backends fastest first (backends without samples first, to learn
+        about them), then the others."""
+
+        def speed(backend):
+            stats = self.stats[backend.name]
+            if not stats.ttfts and not stats.outcomes:
+                return -1.0
+            p50 = stats.percentile(50)
+            # Unreliable backends rank as if they were slower
+            return (self.hedge_delay if p50 is None else p50) / max(
+                0.05, 1 - stats.error_rate
+            )
+
+        healthy = sorted((b for b in self.backends if self.healthy(b)), key=speed)
+        cooling = sorted(
+            (b for b in self.backends if not self.healthy(b)),
+            key=lambda b: self.stats[b.name].cooldown_until,
+        )
+        return healthy + cooling
+
+    def _hedge_delay(self, backend: LLM) -> float:
+        stats = self.stats[backend.name]
+        p95 = stats.percentile(95) if len(stats.ttfts) >= self.min_samples else None
+        return self.hedge_delay if p95 is None else p95
+
+    def _record_failure(self, backend: LLM, error):
+        stats = self.stats[backend.name]
+        stats.record_failure()
+        logger.warning("LLM backend {} failed: {}", backend.name, error)
+        if (
+            len(stats.outcomes) >= self.min_samples
+            and stats.error_rate > self.max_error_rate
+        ):
+            stats.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(
+                "LLM backend {} is cooling down for {}s (error rate {:.0%})",
+                backend.name,
+                self.cooldown,
+                stats.error_rate,
+            )
+
+    @staticmethod
+    async def _first_token(stream: AsyncIterator[LLMReturnChunk]) -> list:
+        """Read `stream` up to its first chunk with content (or its end), returning the
+        chunks read."""
+        chunks = []
+        async for chunk in stream:
+            if chunk.has_error:
+                raise BackendFailed(chunk.error_info)
+            chunks.append(chunk)
+            if chunk.content or chunk.should_stop:
+                return chunks
+        if not chunks:
+            raise BackendFailed("stream ended without any chunk")
+        return chunks
+
+    async def query(
+        self, query_str: str, history: Optional[List[dict]] = None
+    ) -> AsyncIterator[LLMReturnChunk]:
+        candidates = collections.deque(self.ranked_backends())
+        racing = {}  # first-token task -> (backend, stream, started)
+        winner = None
+        last_error = None
+        try:
+            while winner is None:
+                if not racing:
+                    if not candidates:
+                        break
+                    self._start(candidates.popleft(), query_str, history, racing)
+                timeout = None
+                if self.hedge and candidates and len(racing) == 1:
+                    backend, _, started = next(iter(racing.values()))
+                    timeout = max(
+                        0.0, started + self._hedge_delay(backend) - time.monotonic()
+                    )
+                done, _ = await asyncio.wait(
+                    racing, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    self.hedged += 1
+                    logger.debug("Hedging LLM query to {}", candidates[0].name)
+                    self._start(candidates.popleft(), query_str, history, racing)
+                    continue
+                for task in done:
+                    backend, stream, started = racing.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        self._record_failure(backend, last_error)
+                        await stream.aclose()
+                        continue
+                    stats = self.stats[backend.name]
+                    stats.record_first_token(time.monotonic() - started)
+                    if winner is None:
+                        winner = (backend, stream, task.result())
+                    else:
+                        # Both produced their first token at once
+                        stats.record_success()
+                        await stream.aclose()
+        finally:
+            # Cancel the streams that lost the race (or all of them if the consumer went
+            # away)
+            for task, (backend, stream, started) in racing.items():
+                task.cancel()
+                self.stats[backend.name].record_cancelled(time.monotonic() - started)
+            for task, (backend, stream, started) in racing.items():
+                await asyncio.gather(task, return_exceptions=True)
+                await stream.aclose()
+
+        if winner is None:
+            yield LLMReturnChunk(
+                should_stop=True,
+                has_error=True,
+                error_info=f"All backends of {self.name} failed, last error: {last_error}",
+                content="An error occurred.",
+            )
+            return
+        backend, stream, first_chunks = winner
+        # The outcome is known once the stream ends: it may still fail after its first
+        # token
+        error = None
+        try:
+            for chunk in first_chunks:
+                yield chunk
+            if first_chunks[-1].should_stop:
+                return
+            async for chunk in stream:
+                if chunk.has_error and error is None:
+                    error = chunk.error_info
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if error is None:
+                self.stats[backend.name].record_success()
+            else:
+                self._record_failure(backend, error)
+            await stream.aclose()
+
+    def _start(
+        self, backend: LLM, query_str: str, history: Optional[List[dict]], racing: dict
+    ):
+        stream = backend.query(query_str, history)
+        task = asyncio.ensure_future(self._first_token(stream))
+        racing[task] = (backend, stream, time.monotonic())
+
+    def router_stats(self) -> dict:
+        return {
+            "hedged": self.hedged,
+            "backends": {name: stats.to_dict() for name, stats in self.stats.items()},
+        }
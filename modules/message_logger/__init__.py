@@ -1,6 +1,12 @@
 """message_logger
 
-Message logger does a simple job: log incoming messages to the console. Many fields of khl.py instances are used in this module (e.g. Guild, GuildUser), so it's a good example of how to use khl.py classes.
+Message logger does a simple job: log incoming messages to the console. Many fields of
+khl.py instances are used in this module (e.g. Guild, GuildUser), so it's a good example
+of how to use khl.py classes.
+
+With `KOOKBOTX_MESSAGE_ARCHIVE=1`, messages are also kept in a searchable archive under
+`data/message_archive`, which other modules can query through `message_logger.archive`
+(see `archive.py`).
 """
 
 import os
@@ -8,30 +14,70 @@ import os
 from khl import Bot, Event, EventTypes, Message
 from loguru import logger
 
+from .archive import MessageArchive, message_to_archived
+
+DEBUG_FLAG = os.environ.get("KOOKBOTX_DEBUG") == "1"
+ARCHIVE_ENABLED = os.environ.get("KOOKBOTX_MESSAGE_ARCHIVE") == "1"
+archive = MessageArchive() if ARCHIVE_ENABLED else None
+
+
+def log_message(m: Message):
+    # Runs for every inbound message. The line is not colorized, parsing color markup
+    # would double its cost.
+    if DEBUG_FLAG:
+        logger.debug(
+            "Message #{mid} inbounds | from user {nickname} = {username} (#{uid}) {is_bot} | from channel {channel_name} (#{cid}), guild #{gid} | Content: {content}",
+            mid=m.id,
+            nickname=m.author.nickname,
+            username=m.author.username,
+            uid=m.author.id,
+            is_bot=(
+                "[BOT]"
+                if m.author.bot
+                else "[ONLINE]" if m.author.online else "[OFFLINE]"
+            ),
+            channel_name=m.channel.name,
+            cid=m.channel.id,
+            gid=m.guild.id,
+            content=m.content,
+        )
+    logger.info(
+        "<- [{nick}] {content}",
+        nick=m.author.nickname,
+        content=m.content,
+    )
+
 
 def init(bot_):
 
     @bot_.on_message()
     async def message_logger(m: Message):
-        if os.environ.get("KOOKBOTX_DEBUG") == "1":
-            logger.debug(
-                "Message #{mid} inbounds | from user {nickname} = {username} (#{uid}) {is_bot} | from channel {channel_name} (#{cid}), guild #{gid} | Content: {content}",
-                mid=m.id,
-                nickname=m.author.nickname,
-                username=m.author.username,
-                uid=m.author.id,
-                is_bot=(
-                    "[BOT]"
-                    if m.author.bot
-                    else "[ONLINE]" if m.author.online else "[OFFLINE]"
-                ),
-                channel_name=m.channel.name,
-                cid=m.channel.id,
-                gid=m.guild.id,
-                content=m.content,
-            )
-        logger.opt(colors=True).info(
-            "<- [<cyan>{nick}</cyan>] {content}",
-            nick=m.author.nickname,
-            content=m.content,
-        )
+        log_message(m)
+        if archive is not None:
+            archive.add(message_to_archived(m))
+
+
+async def teardown():
+    if archive is not None:
+        await archive.aclose()
+
+
+def dump_state():
+    # On hot reload, the new version keeps writing to the open archive, which it owns
+    # from then on: teardown() leaves it open
+    global archive
+    state = {"archive": archive}
+    archive = None
+    return state
+
+
+async def load_state(state):
+    global archive
+    handed_over = state.get("archive")
+    if not ARCHIVE_ENABLED or handed_over is None or handed_over is archive:
+        return
+    # The archive this version opened on import read the directory before the running
+    # one flushed it, only the running one knows its active segment
+    fresh, archive = archive, handed_over
+    if fresh is not None:
+        await fresh.aclose()
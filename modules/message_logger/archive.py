@@ -0,0 +1,424 @@
+"""Searchable on-disk archive of inbound messages.
+
+Messages are appended to segments (`seg-000001.jsonl`, one JSON object per line), a new
+segment every `segment_records` messages. Each sealed segment has an index
+(`seg-000001.idx`) mapping guild, channel, author and content tokens to the messages
+containing them, and `manifest.json` lists the time range, guilds and channels of every
+segment. A search first rules out segments by the manifest, then reads the index of the
+remaining ones and finally reads only the matching lines, newest first, so it never
+scans the whole archive.
+
+```python
+from message_logger import archive  # None unless KOOKBOTX_MESSAGE_ARCHIVE=1
+
+messages = await archive.search(
+    channel_id="123", author_id="456", since=time.time() - 86400, text="gg"
+)
+```
+
+Content is indexed by lowercased words and by character bigrams of CJK text, so `text`
+matches whole words (and any CJK text of at least two characters); the matches are then
+checked to contain `text` itself, case-insensitively. Text the index cannot look up, such
+as a single CJK character, is found by checking the content of every message in the
+other filters' range.
+"""
+
+import asyncio
+import bisect
+import collections
+import os
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import orjson
+from loguru import logger
+
+DEFAULT_ARCHIVE_DIR = (
+    Path(__file__).resolve().parent.parent.parent / "data" / "message_archive"
+)
+
+_WORD = re.compile(r"[^\W　-鿿가-힯＀-￯]+")
+_CJK_RUN = re.compile(r"[　-鿿가-힯＀-￯]+")
+
+
+def tokenize(text: str) -> set:
+    """Lowercased words, and character bigrams of CJK text."""
+    text = text.lower()
+    tokens = set(_WORD.findall(text))
+    for run in _CJK_RUN.findall(text):
+        tokens.update(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+@dataclass
+class ArchivedMessage:
+    id: str
+    time: float
+    guild_id: Optional[str]
+    channel_id: Optional[str]
+    author_id: Optional[str]
+    author: str
+    content: str
+
+
+class SegmentIndex:
+    """Postings (record numbers, ascending) of one segment, with the byte offset and
+    time of every record."""
+
+    def __init__(self):
+        self.offsets: List[int] = []
+        # Message times, made non-decreasing so that time ranges can be bisected
+        self.times: List[float] = []
+        self.postings: Dict[str, Dict[str, List[int]]] = {
+            "guild": {},
+            "channel": {},
+            "author": {},
+            "token": {},
+        }
+
+    def add(self, offset: int, message: ArchivedMessage):
+        n = len(self.offsets)
+        self.offsets.append(offset)
+        self.times.append(
+            max(message.time, self.times[-1]) if self.times else message.time
+        )
+        for field, key in (
+            ("guild", message.guild_id),
+            ("channel", message.channel_id),
+            ("author", message.author_id),
+        ):
+            if key is not None:
+                self.postings[field].setdefault(key, []).append(n)
+        tokens = self.postings["token"]
+        for token in tokenize(message.content):
+            tokens.setdefault(token, []).append(n)
+
+    def candidates(
+        self,
+        since: Optional[float],
+        until: Optional[float],
+        filters: Dict[str, Iterable[str]],
+    ) -> List[int]:
+        """Record numbers within the time range that have every filter key, ascending."""
+        lo = 0 if since is None else bisect.bisect_left(self.times, since)
+        hi = (
+            len(self.times) if until is None else bisect.bisect_right(self.times, until)
+        )
+        lists = []
+        for field, keys in filters.items():
+            for key in keys:
+                posting = self.postings[field].get(key)
+                if not posting:
+                    return []
+                lists.append(posting)
+        if not lists:
+            return list(range(lo, hi))
+        lists.sort(key=len)
+        result = [n for n in lists[0] if lo <= n < hi]
+        for posting in lists[1:]:
+            present = set(posting)
+            result = [n for n in result if n in present]
+            if not result:
+                break
+        return result
+
+    def dumps(self) -> bytes:
+        return orjson.dumps(
+            {"offsets": self.offsets, "times": self.times, "postings": self.postings}
+        )
+
+    @classmethod
+    def loads(cls, data: bytes) -> "SegmentIndex":
+        raw = orjson.loads(data)
+        index = cls()
+        index.offsets = raw["offsets"]
+        index.times = raw["times"]
+        index.postings = raw["postings"]
+        return index
+
+
+class MessageArchive:
+    """Append-only message archive in `directory`, searched through its indexes.
+
+    `add` only buffers the message; a background task appends the buffer to the active
+    segment every `flush_interval` seconds. At most `max_pending` messages are buffered
+    (more are dropped and counted), and the index of the active segment is bounded by
+    `segment_records`, so memory stays bounded however many messages come in.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path] = DEFAULT_ARCHIVE_DIR,
+        segment_records: int = 50000,
+        flush_interval: float = 2.0,
+        max_pending: int = 10000,
+        index_cache_size: int = 8,
+    ):
+        self.directory = Path(directory)
+        self.segment_records = segment_records
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.index_cache_size = index_cache_size
+        self.pending: List[ArchivedMessage] = []
+        self.dropped = 0
+        self._lock = (
+            threading.Lock()
+        )  # guards the files, the manifest and the active index
+        self._index_cache: "collections.OrderedDict[int, SegmentIndex]" = (
+            collections.OrderedDict()
+        )
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flushing = asyncio.Lock()  # keeps batches in order
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    # ---- Files ----
+
+    def _segment_path(self, segment_id: int) -> Path:
+        return self.directory / f"seg-{segment_id:06d}.jsonl"
+
+    def _index_path(self, segment_id: int) -> Path:
+        return self.directory / f"seg-{segment_id:06d}.idx"
+
+    def _load(self):
+        manifest_path = self.directory / "manifest.json"
+        self.manifest = (
+            orjson.loads(manifest_path.read_bytes())
+            if manifest_path.exists()
+            else {"segments": []}
+        )
+        sealed = {entry["id"] for entry in self.manifest["segments"]}
+        self.active_id = max(sealed, default=0) + 1
+        self.active = SegmentIndex()
+        self.active_guilds = set()
+        self.active_channels = set()
+        # The active segment has no index on disk, rebuild it (it holds at most
+        # `segment_records` lines)
+        path = self._segment_path(self.active_id)
+        if path.exists():
+            with open(path, "rb") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete line")
+                        message = ArchivedMessage(**orjson.loads(line))
+                    except Exception:
+                        # A line cut short by a crash, truncated below
+                        break
+                    self._index_active(offset, message)
+                    offset += len(line)
+            if offset < path.stat().st_size:
+                os.truncate(path, offset)
+            logger.debug(
+                "Rebuilt the index of {} ({} messages)", path, len(self.active.offsets)
+            )
+
+    def _save_manifest(self):
+        path = self.directory / "manifest.json"
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_bytes(orjson.dumps(self.manifest))
+        os.replace(tmp_path, path)
+
+    def _index_active(self, offset: int, message: ArchivedMessage):
+        self.active.add(offset, message)
+        if message.guild_id is not None:
+            self.active_guilds.add(message.guild_id)
+        if message.channel_id is not None:
+            self.active_channels.add(message.channel_id)
+
+    def _append(self, messages: List[ArchivedMessage]):
+        with self._lock:
+            i = 0
+            while i < len(messages):
+                if len(self.active.offsets) >= self.segment_records:
+                    # A full segment is sealed once the next message arrives
+                    self._seal()
+                room = self.segment_records - len(self.active.offsets)
+                batch = messages[i : i + room]
+                path = self._segment_path(self.active_id)
+                lines = [orjson.dumps(asdict(message)) + b"\n" for message in batch]
+                with open(path, "ab") as f:
+                    offset = f.tell()
+                    f.write(b"".join(lines))
+                # Indexed once written, a failed write leaves the index as it was
+                for message, line in zip(batch, lines):
+                    self._index_active(offset, message)
+                    offset += len(line)
+                i += len(batch)
+
+    def _seal(self):
+        index_path = self._index_path(self.active_id)
+        tmp_path = index_path.with_name(f".{index_path.name}.tmp")
+        tmp_path.write_bytes(self.active.dumps())
+        os.replace(tmp_path, index_path)
+        self.manifest["segments"].append(
+            {
+                "id": self.active_id,
+                "records": len(self.active.offsets),
+                "start": self.active.times[0],
+                "end": self.active.times[-1],
+                "guilds": sorted(self.active_guilds),
+                "channels": sorted(self.active_channels),
+            }
+        )
+        self._save_manifest()
+        self._cache_index(self.active_id, self.active)
+        self.active_id += 1
+        self.active = SegmentIndex()
+        self.active_guilds = set()
+        self.active_channels = set()
+
+    def _cache_index(self, segment_id: int, index: SegmentIndex):
+        self._index_cache[segment_id] = index
+        self._index_cache.move_to_end(segment_id)
+        while len(self._index_cache) > self.index_cache_size:
+            self._index_cache.popitem(last=False)
+
+    def _segment_index(self, segment_id: int) -> SegmentIndex:
+        index = self._index_cache.get(segment_id)
+        if index is None:
+            index = SegmentIndex.loads(self._index_path(segment_id).read_bytes())
+            self._cache_index(segment_id, index)
+        else:
+            self._index_cache.move_to_end(segment_id)
+        return index
+
+    # ---- Ingest ----
+
+    def add(self, message: ArchivedMessage):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.append(message)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(
+                self._flush_later()
+            )
+
+    async def _flush_later(self):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flushing:
+            messages, self.pending = self.pending, []
+            if messages:
+                try:
+                    await asyncio.to_thread(self._append, messages)
+                except Exception as e:
+                    logger.warning(
+                        "Failed to archive {} messages: {}", len(messages), e
+                    )
+
+    async def aclose(self):
+        await self.flush()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+
+    # ---- Search ----
+
+    async def search(
+        self,
+        guild_id: Optional[str] = None,
+        channel_id: Optional[str] = None,
+        author_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        text: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[ArchivedMessage]:
+        """Archived messages matching every given filter, newest first. `since` and
+        `until` are Unix timestamps.
+
+        Messages added in the last `flush_interval` seconds are not searchable yet.
+        """
+        return await asyncio.to_thread(
+            self._search, guild_id, channel_id, author_id, since, until, text, limit
+        )
+
+    def _search(
+        self, guild_id, channel_id, author_id, since, until, text, limit
+    ) -> List[ArchivedMessage]:
+        filters = {}
+        for field, key in (
+            ("guild", guild_id),
+            ("channel", channel_id),
+            ("author", author_id),
+        ):
+            if key is not None:
+                filters[field] = [str(key)]
+        tokens = tokenize(text) if text else None
+        if tokens:
+            filters["token"] = sorted(tokens)
+        # Text without tokens (a single CJK character, punctuation) cannot narrow the
+        # search through the index: every message in range is checked for it below
+        needle = text.lower() if text else None
+        results = []
+        with self._lock:
+            segments = [(self.active_id, self.active)] + [
+                (entry["id"], None)
+                for entry in reversed(self.manifest["segments"])
+                if self._may_contain(entry, guild_id, channel_id, since, until)
+            ]
+            for segment_id, index in segments:
+                if index is None:
+                    index = self._segment_index(segment_id)
+                numbers = index.candidates(since, until, filters)
+                if not numbers:
+                    continue
+                with open(self._segment_path(segment_id), "rb") as f:
+                    for n in reversed(numbers):
+                        f.seek(index.offsets[n])
+                        message = ArchivedMessage(**orjson.loads(f.readline()))
+                        if since is not None and message.time < since:
+                            continue
+                        if until is not None and message.time > until:
+                            continue
+                        if needle is not None and needle not in message.content.lower():
+                            continue
+                        results.append(message)
+                        if len(results) >= limit:
+                            return results
+        return results
+
+    @staticmethod
+    def _may_contain(entry: dict, guild_id, channel_id, since, until) -> bool:
+        if since is not None and entry["end"] < since:
+            return False
+        if until is not None and entry["start"] > until:
+            return False
+        if guild_id is not None and str(guild_id) not in entry["guilds"]:
+            return False
+        if channel_id is not None and str(channel_id) not in entry["channels"]:
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "segments": len(self.manifest["segments"]) + 1,
+            "messages": sum(entry["records"] for entry in self.manifest["segments"])
+            + len(self.active.offsets),
+            "pending": len(self.pending),
+            "dropped": self.dropped,
+        }
+
+
+def message_to_archived(m) -> ArchivedMessage:
+    """An `ArchivedMessage` of a khl `Message`, public or private."""
+    guild = getattr(m, "guild", None)
+    channel = getattr(m, "channel", None)
+    return ArchivedMessage(
+        id=m.id,
+        time=(m.msg_timestamp / 1000) if m.msg_timestamp else time.time(),
+        guild_id=getattr(guild, "id", None),
+        channel_id=getattr(channel, "id", None),
+        author_id=m.author_id,
+        author=m.author.nickname or m.author.username or "",
+        content=m.content or "",
+    )
@@ -0,0 +1,125 @@
+"""stream_edit
+
+Stream progressive output (LLM answers, progress reports...) into one KOOK message by
+editing it. This is a library module (see `.nomodule.kbx`), import it from other
+modules:
+
+```python
+from stream_edit import MessageStreamer
+
+ret = await msg.reply("Working...")
+async with MessageStreamer(msg.gate, ret["msg_id"]) as streamer:
+    async for piece in produce():
+        text += piece
+        streamer.update(text)
+# Leaving the block waits until the final text is shown
+```
+
+`update` never waits for KOOK. A background task sends the latest text at most
+`max_edits_per_second` times per second and drops the states in between, so a slow API
+never slows down the producer and a fast producer never floods the API.
+"""
+
+import asyncio
+import time
+from typing import Callable, Optional
+
+from khl import Gateway
+from khl.api import Message as MessageAPI
+from loguru import logger
+
+
+class MessageStreamer:
+    def __init__(
+        self,
+        gate: Gateway,
+        msg_id: str,
+        max_edits_per_second: float = 1.0,
+        transform: Optional[Callable[[str], str]] = str.strip,
+    ):
+        """`transform` is applied to every snapshot before sending it; snapshots that
+        end up empty are never sent, since KOOK rejects empty messages."""
+        self.gate = gate
+        self.msg_id = msg_id
+        self.min_interval = 1.0 / max_edits_per_second
+        self.transform = transform
+        self.latest = ""
+        self.sent = None
+        self.edits = 0
+        self._last_edit = 0.0
+        self._changed = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def text(self) -> str:
+        return self.latest
+
+    def update(self, text: str):
+        """Make `text` the content to show, replacing any snapshot that was not sent
+        yet."""
+        if self._closing:
+            raise RuntimeError("MessageStreamer is closed")
+        self.latest = text
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def append(self, text: str):
+        self.update(self.latest + text)
+
+    def _content(self) -> str:
+        return self.transform(self.latest) if self.transform else self.latest
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            delay = self._last_edit + self.min_interval - time.monotonic()
+            if delay > 0:
+                # Snapshots arriving meanwhile replace each other, only the last one is
+                # sent
+                await asyncio.sleep(delay)
+            content = self._content()
+            if content and content != self.sent:
+                self._last_edit = time.monotonic()
+                try:
+                    await self.gate.exec_req(
+                        MessageAPI.update(msg_id=self.msg_id, content=content)
+                    )
+                    self.sent = content
+                    self.edits += 1
+                except Exception as e:
+                    if self._closing and not self._changed.is_set():
+                        raise
+                    # The next snapshot is a full replacement, so a failed edit needs no
+                    # retry of its own
+                    logger.warning("Failed to edit message {}: {}", self.msg_id, e)
+            if self._closing and not self._changed.is_set():
+                return
+
+    async def close(self):
+        """Send the final text (respecting the edit rate) and stop. Raises if that final
+        edit fails."""
+        if self._closing:
+            if self._task is not None:
+                await self._task
+            return
+        self._closing = True
+        if self._task is None:
+            return
+        self._changed.set()
+        await self._task
+
+    async def __aenter__(self) -> "MessageStreamer":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+            return
+        # Still show what was produced before the error, but never mask the error itself
+        try:
+            await self.close()
+        except Exception as e:
+            logger.warning("Failed to edit message {}: {}", self.msg_id, e)
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules import each other by name, as main.py sets them up
+for path in (ROOT, ROOT / "modules"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+
+import orjson
+
+from await_sel_manager import AwaitingUserSelection
+
+
+def click(msg_id: str, value: str):
+    return SimpleNamespace(body={"msg_id": msg_id, "value": value})
+
+
+def test_selections_expire_after_their_ttl():
+    async def main():
+        manager = AwaitingUserSelection(ttl=0.05)
+        clicked, expired = [], []
+        manager.add("a", {"yes": clicked.append}, on_expire=expired.append)
+        manager.add("b", {"yes": clicked.append}, ttl=10)
+        # The timer expires `a` without anything touching the manager
+        await asyncio.sleep(0.1)
+        during = (expired[:], len(manager))
+        assert manager.callback(click("a", "yes")) is None
+        manager.callback(click("b", "yes"))
+        await manager.aclose()
+        return during, clicked, manager.stats()
+
+    (expired, pending), clicked, stats = asyncio.run(main())
+    assert expired == ["a"] and pending == 1
+    assert [event.body["msg_id"] for event in clicked] == ["b"]
+    assert stats["expired"] == 1 and stats["pending"] == 0
+
+
+def test_selections_expire_on_access_without_a_loop():
+    manager = AwaitingUserSelection(ttl=-1)
+    manager.add("a", {"yes": print})
+    assert not manager.contains("a")
+    assert manager.stats()["expired"] == 1
+
+
+def test_capacity_evicts_the_selection_closest_to_expiring():
+    async def main():
+        manager = AwaitingUserSelection(capacity=3)
+        evicted = []
+        for msg_id, ttl in [("a", 30), ("b", 10), ("c", 20)]:
+            manager.add(msg_id, {}, ttl=ttl, on_expire=evicted.append)
+        # Replacing a pending selection does not make room
+        manager.add("a", {}, ttl=40, on_expire=evicted.append)
+        assert evicted == [] and len(manager) == 3
+        manager.add("d", {}, ttl=50, on_expire=evicted.append)
+        manager.add("e", {}, ttl=60, on_expire=evicted.append)
+        pending = sorted(manager.awaiting_user_selection)
+        await manager.aclose()
+        return evicted, pending, manager.stats()
+
+    evicted, pending, stats = asyncio.run(main())
+    assert evicted == ["b", "c"]
+    assert pending == ["a", "d", "e"]
+    assert stats["evicted"] == 2 and stats["expired"] == 0
+
+
+def test_async_callbacks_run_as_tasks():
+    async def main():
+        manager = AwaitingUserSelection()
+        done = asyncio.Event()
+
+        async def on_click(event):
+            done.set()
+
+        manager.add("a", {"yes": on_click})
+        task = manager.callback(click("a", "yes"))
+        await asyncio.wait_for(done.wait(), 1)
+        await task
+        return manager.stats()
+
+    assert asyncio.run(main())["running_callbacks"] == 0
+
+
+def test_named_callbacks_are_reloaded_after_a_restart(tmp_path):
+    store_path = tmp_path / "await_selection.json"
+
+    async def before_restart():
+        manager = AwaitingUserSelection(store_path=store_path)
+        manager.add("poll", {"yes": "vote", "no": "vote"}, data={"poll": 1})
+        manager.add("lapsed", {"yes": "vote"}, ttl=0.05, on_expire="gone")
+        # Callables cannot be saved
+        manager.add("local", {"yes": print})
+        await manager.aclose()
+
+    async def after_restart():
+        await asyncio.sleep(0.1)
+        manager = AwaitingUserSelection(store_path=store_path)
+        votes, gone = [], []
+
+        @manager.handler("vote")
+        def vote(event, data):
+            votes.append((event.body["value"], data))
+
+        @manager.handler("gone")
+        def on_gone(msg_id):
+            gone.append(msg_id)
+
+        restored = sorted(manager.awaiting_user_selection)
+        manager.callback(click("poll", "no"))
+        await manager.aclose()
+        return restored, votes, gone
+
+    asyncio.run(before_restart())
+    saved = orjson.loads(store_path.read_bytes())
+    assert sorted(entry["msg_id"] for entry in saved) == ["lapsed", "poll"]
+    restored, votes, gone = asyncio.run(after_restart())
+    assert restored == ["lapsed", "poll"]
+    assert votes == [("no", {"poll": 1})]
+    # Selections that lapsed while the bot was down expire once the hooks are back
+    assert gone == ["lapsed"]
+    # The click is saved too
+    assert orjson.loads(store_path.read_bytes()) == []
+
+
+def test_unknown_handlers_are_skipped(tmp_path):
+    store_path = tmp_path / "await_selection.json"
+    store_path.write_bytes(
+        orjson.dumps(
+            [
+                {
+                    "msg_id": "poll",
+                    "callbacks": {"yes": "missing"},
+                    "expires_at": 2**40,
+                    "on_expire": None,
+                    "data": None,
+                }
+            ]
+        )
+    )
+    manager = AwaitingUserSelection(store_path=store_path)
+    assert manager.callback(click("poll", "yes")) is None
+    assert len(manager) == 0
@@ -0,0 +1,186 @@
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+from khl import Message
+
+from kbx.dispatch import CommandTrie
+from kbx.metrics import LatencyStats, Metrics, MetricsServer
+from main import KookBotX
+
+
+def package(content: str) -> dict:
+    author = {
+        "id": "42",
+        "username": "alice",
+        "nickname": "alice",
+        "identify_num": "0001",
+        "online": True,
+        "bot": False,
+        "avatar": "",
+    }
+    return {
+        "channel_type": "GROUP",
+        "type": 1,
+        "target_id": "channel",
+        "author_id": "42",
+        "content": content,
+        "msg_id": "msg",
+        "msg_timestamp": 0,
+        "nonce": "",
+        "extra": {
+            "type": 1,
+            "guild_id": "guild",
+            "channel_name": "general",
+            "mention": [],
+            "mention_all": False,
+            "mention_roles": [],
+            "mention_here": False,
+            "author": author,
+        },
+    }
+
+
+def test_trie_matches_whole_triggers_only():
+    trie = CommandTrie()
+    trie.add("/ping", "ping")
+    trie.add("/pingpong", "pingpong")
+    trie.add("/shout", "shout", case_sensitive=False)
+    assert trie.match("/ping") == ["ping"]
+    assert trie.match("/ping 1 2") == ["ping"]
+    assert trie.match("/pingpong") == ["pingpong"]
+    assert trie.match("/pingp") == []
+    assert trie.match("/SHOUT loud") == ["shout"]
+    assert trie.match("/PING") == []
+
+
+def make_bot():
+    kbx = KookBotX("fake", fake_api=True)
+    bot = kbx.kookbot
+    calls = []
+
+    @bot.command("ping", aliases=["p"])
+    async def ping(msg: Message, *args):
+        calls.append(("ping", args))
+
+    @bot.command("pingpong")
+    async def pingpong(msg: Message):
+        calls.append(("pingpong", ()))
+
+    @bot.command("shout", case_sensitive=False)
+    async def shout(msg: Message, *args):
+        calls.append(("shout", args))
+
+    @bot.command(regex=r"(?:hi|hey) bot")
+    async def greet(msg: Message):
+        calls.append(("greet", ()))
+
+    return kbx, bot, calls
+
+
+def test_messages_start_only_the_commands_they_trigger():
+    async def main():
+        kbx, bot, calls = make_bot()
+        triggered = {}
+        for content in ["/ping 1 2", "/p", "/pingpong", "/SHOUT x", "hey bot", "hello"]:
+            calls.clear()
+            await bot.client._consume_pkg(package(content))
+            await asyncio.sleep(0.05)
+            triggered[content] = sorted(calls)
+        # Only the regex command is started for a message that matches no trigger
+        candidates = [c.name for c in bot.command.candidates("hello")]
+        return triggered, candidates
+
+    triggered, candidates = asyncio.run(main())
+    assert triggered == {
+        "/ping 1 2": [("ping", ("1", "2"))],
+        "/p": [("ping", ())],
+        "/pingpong": [("pingpong", ())],
+        "/SHOUT x": [("shout", ("x",))],
+        "hey bot": [("greet", ())],
+        "hello": [],
+    }
+    assert candidates == ["greet"]
+
+
+def test_unregistered_commands_leave_the_trie():
+    async def main():
+        kbx, bot, calls = make_bot()
+        bot.command.pop("ping")
+        await bot.client._consume_pkg(package("/ping"))
+        await asyncio.sleep(0.05)
+        return calls
+
+    assert asyncio.run(main()) == []
+
+
+def test_quantiles_over_the_window():
+    stats = LatencyStats(window=100)
+    for duration in range(1, 201):
+        stats.record(duration, failed=duration % 50 == 0)
+    # Only the last 100 durations count
+    quantiles = stats.quantiles()
+    assert quantiles[0.5] == pytest.approx(150.5)
+    assert quantiles[0.95] == pytest.approx(195.05)
+    assert quantiles[0.99] == pytest.approx(199.01)
+    assert stats.calls == 200 and stats.errors == 4
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_metrics_endpoint_reports_handlers_in_flight_and_errors():
+    async def main():
+        kbx = KookBotX("fake", fake_api=True)
+        bot = kbx.kookbot
+        release = asyncio.Event()
+
+        @bot.command("slow")
+        async def slow(msg: Message):
+            await release.wait()
+
+        @bot.command("broken")
+        async def broken(msg: Message):
+            raise RuntimeError("boom")
+
+        kbx.metrics.add_source("queue", lambda: {"depth": 3, "buckets": {"a": 1}})
+        server = MetricsServer(kbx.metrics, port=free_port())
+        await server.start()
+        url = f"http://127.0.0.1:{server.port}/metrics"
+        try:
+            async with aiohttp.ClientSession() as session:
+                await bot.client._consume_pkg(package("/slow"))
+                await bot.client._consume_pkg(package("/broken"))
+                await asyncio.sleep(0.05)
+                async with session.get(url) as response:
+                    during = await response.text()
+                release.set()
+                await asyncio.sleep(0.05)
+                async with session.get(url) as response:
+                    after = await response.text()
+        finally:
+            await server.stop()
+        return during, after
+
+    during, after = asyncio.run(main())
+    assert 'kbx_handler_in_flight{handler="command:slow"} 1' in during
+    assert 'kbx_handler_in_flight{handler="command:slow"} 0' in after
+    assert 'kbx_handler_seconds_count{handler="command:slow"} 1' in after
+    assert 'kbx_handler_seconds{handler="command:slow",quantile="0.99"}' in after
+    assert 'kbx_handler_errors_total{handler="command:broken"} 1' in after
+    assert "kbx_queue_depth 3" in after
+    assert "kbx_queue_buckets_a 1" in after
+
+
+def test_snapshot_flattens_sources():
+    metrics = Metrics()
+    metrics.add_source("gum", lambda: {"hits": 2, "enabled": True, "dirty": [1, 2]})
+    with metrics.track("job"):
+        pass
+    snapshot = metrics.snapshot()
+    assert snapshot["gauges"] == {"gum_hits": 2, "gum_enabled": 1, "gum_dirty": 2}
+    assert snapshot["handlers"]["job"]["calls"] == 1
@@ -0,0 +1,192 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from gum import (
+    DuplicateRegistrationError,
+    GameDataNotFoundError,
+    JSONUserManager,
+    SQLiteUserManager,
+    UserNotFoundError,
+)
+from gum import sqlite_manager
+
+
+def open_manager(backend: str, tmp_path, **kwargs):
+    if backend == "json":
+        return JSONUserManager(data_dir=tmp_path, durable_writes=False, **kwargs)
+    return SQLiteUserManager(db_path=tmp_path / "gum.sqlite3", **kwargs)
+
+
+BACKENDS = ["json", "sqlite"]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_data_survives_a_restart(backend, tmp_path):
+    async def main():
+        gum = open_manager(backend, tmp_path)
+        await gum.register("alice", "bingo")
+        await gum.set_data_for_game("alice", "bingo", b"card")
+        await gum.meta_set("alice", "nickname", "Al")
+        await gum.close()
+        gum = open_manager(backend, tmp_path)
+        result = (
+            await gum.has_user("alice"),
+            await gum.get_data_for_game("alice", "bingo"),
+            (await gum.meta_get("alice"))["nickname"],
+        )
+        await gum.close()
+        return result
+
+    assert asyncio.run(main()) == (True, b"card", "Al")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_errors(backend, tmp_path):
+    async def main():
+        gum = open_manager(backend, tmp_path)
+        await gum.register("alice")
+        with pytest.raises(DuplicateRegistrationError):
+            await gum.register("alice")
+        with pytest.raises(UserNotFoundError):
+            await gum.get_data_for_game("bob", "bingo")
+        with pytest.raises(GameDataNotFoundError):
+            await gum.get_data_for_game("alice", "bingo")
+        with pytest.raises(GameDataNotFoundError):
+            await gum.delete_data_for_game("alice", "bingo")
+        assert not await gum.has_data_for_game("alice", "bingo")
+        await gum.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_missing_meta_raises_the_same_error(backend, tmp_path):
+    async def main():
+        gum = open_manager(backend, tmp_path)
+        with pytest.raises(FileNotFoundError):
+            await gum._read_meta("no-such-rsid")
+        [missing] = await gum._read_meta_many(["no-such-rsid"])
+        await gum.close()
+        return missing
+
+    assert isinstance(asyncio.run(main()), FileNotFoundError)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_unregistered_data_is_not_handed_to_a_new_registration(backend, tmp_path):
+    async def main():
+        gum = open_manager(backend, tmp_path)
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"old")
+        await gum.unregister("alice")
+        await gum.register("alice")
+        has_data = await gum.has_data_for_game("alice", "bingo")
+        await gum.close()
+        return has_data
+
+    assert asyncio.run(main()) is False
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_delete_keeps_a_backup(backend, tmp_path):
+    async def main():
+        gum = open_manager(backend, tmp_path)
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"v1")
+        await gum.set_data_for_game("alice", "bingo", b"v2", backup=True)
+        await gum.delete_data_for_game("alice", "bingo")
+        backups = await gum.list_backups("alice")
+        contents = [await gum.get_backup("alice", b.name, b.ts) for b in backups]
+        await gum.close()
+        return [(b.name, b.kind) for b in backups], contents
+
+    backups, contents = asyncio.run(main())
+    assert sorted(backups) == [("bingo.dat", "bak"), ("bingo.dat", "del")]
+    assert sorted(contents) == [b"v1", b"v2"]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_batch_apis(backend, tmp_path):
+    async def main():
+        gum = open_manager(backend, tmp_path)
+        for user_id in ("alice", "bob", "carol"):
+            await gum.register(user_id)
+        written = await gum.set_many(
+            {"alice": b"a", "bob": b"b", "dave": b"d"}, "bingo"
+        )
+        read = await gum.get_many(["alice", "bob", "carol", "dave"], "bingo")
+        metas = await gum.meta_get_many(["alice", "dave"])
+        iterated = dict(
+            [item async for item in gum.iter_game_data("bingo", batch_size=2)]
+        )
+        await gum.close()
+        return written, read, metas, iterated
+
+    written, read, metas, iterated = asyncio.run(main())
+    assert written["alice"] is None and written["bob"] is None
+    assert isinstance(written["dave"], UserNotFoundError)
+    assert read["alice"] == b"a" and read["bob"] == b"b"
+    assert isinstance(read["carol"], GameDataNotFoundError)
+    assert isinstance(read["dave"], UserNotFoundError)
+    assert metas["alice"]["kook_id"] == "alice"
+    assert isinstance(metas["dave"], UserNotFoundError)
+    assert iterated == {"alice": b"a", "bob": b"b"}
+
+
+def test_sqlite_close_closes_reader_connections(tmp_path):
+    async def main():
+        gum = open_manager("sqlite", tmp_path, cache_max_bytes=0)
+        await gum.register("alice")
+        await asyncio.gather(*(gum.meta_get("alice") for _ in range(8)))
+        conns = list(gum._reader_conns)
+        await gum.close()
+        return conns, gum._reader_conns
+
+    conns, remaining = asyncio.run(main())
+    assert conns and not remaining
+    for conn in conns:
+        with pytest.raises(Exception, match="closed"):
+            conn.execute("SELECT 1")
+
+
+class LockedOnce:
+    """A connection whose first `BEGIN IMMEDIATE` fails as if another process held the
+    database past busy_timeout."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.locked = True
+
+    def execute(self, sql, *args):
+        if sql == "BEGIN IMMEDIATE" and self.locked:
+            self.locked = False
+            raise sqlite3.OperationalError("database is locked")
+        return self.conn.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def test_sqlite_writer_survives_a_failed_batch(tmp_path, monkeypatch):
+    connect = sqlite_manager.connect
+    monkeypatch.setattr(
+        sqlite_manager, "connect", lambda *args: LockedOnce(connect(*args))
+    )
+
+    async def main():
+        writer = sqlite_manager.SQLiteWriter(tmp_path / "gum.sqlite3")
+        writer.start()
+
+        def select(conn):
+            return conn.execute("SELECT 1").fetchone()[0]
+
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            await asyncio.wait_for(writer.submit(select), 5)
+        result = await asyncio.wait_for(writer.submit(select), 5)
+        writer.stop()
+        await asyncio.to_thread(writer.join, 5)
+        return result
+
+    assert asyncio.run(main()) == 1
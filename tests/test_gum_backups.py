@@ -0,0 +1,176 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from gum import BackupNotFoundError, JSONUserManager, RetentionPolicy, SQLiteUserManager
+from gum.backup_store import INDEX_NAME, BackupStore
+from gum.retention import BackupInfo
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+def test_retention_keeps_the_last_backups_then_thins_them_out():
+    # The last second of a day, and of an hour
+    now = 100 * DAY - 1
+    policy = RetentionPolicy(keep_last=3, hourly=2, daily=2)
+    # Every 10 minutes over the last three days
+    timestamps = [now - i * 600 for i in range(3 * 24 * 6)]
+    assert policy.select(timestamps, now) == {
+        # keep_last
+        now,
+        now - 600,
+        now - 1200,
+        # Newest of the previous hour, and of the previous day
+        now - HOUR,
+        now - DAY,
+    }
+
+
+def make_store(tmp_path, versions) -> BackupStore:
+    store = BackupStore(tmp_path / "backups", fsync=False)
+    store.backups_dir.mkdir()
+    live = tmp_path / "game.dat"
+    for ts, data in versions:
+        live.write_bytes(data)
+        store.add(live, BackupInfo("game.dat", ts, "bak"))
+        # Backups are hard links of the live file, which is then replaced
+        os.replace(live, tmp_path / f"old.{ts}")
+    return store
+
+
+def test_compaction_archives_and_restores_every_kept_version(tmp_path):
+    now = time.time()
+    base = bytes(range(256)) * 64
+    versions = [
+        (now - i * HOUR, base[: 1000 * i] + bytes([i]) + base[1000 * i + 1 :])
+        for i in range(12)
+    ]
+    store = make_store(tmp_path, versions)
+    dropped, archived = store.compact(
+        RetentionPolicy(keep_last=2, hourly=24, daily=0), now
+    )
+    assert (dropped, archived) == (0, 10)
+    listed = {b.ts: b for b in store.list_backups()}
+    assert sorted(listed) == sorted(ts for ts, _ in versions)
+    assert sum(b.archived for b in listed.values()) == 10
+    for ts, data in versions:
+        assert store.read("game.dat", ts) == data
+    # Mostly identical versions are stored as deltas
+    assert store.archive_path.stat().st_size < len(base) * 2
+    loose = [p for p in store.backups_dir.iterdir() if p.name.startswith("game.dat.")]
+    assert len(loose) == 2
+
+
+def test_compaction_drops_expired_backups(tmp_path):
+    now = time.time()
+    versions = [(now - i * DAY, f"v{i}".encode()) for i in range(5)]
+    store = make_store(tmp_path, versions)
+    dropped, _ = store.compact(RetentionPolicy(keep_last=1, hourly=0, daily=2), now)
+    assert dropped == 3
+    assert sorted(b.ts for b in store.list_backups()) == [now - DAY, now]
+    assert store.read("game.dat", now - 4 * DAY) is None
+    # Compacting again changes nothing
+    assert store.compact(RetentionPolicy(keep_last=1, hourly=0, daily=2), now) == (0, 0)
+
+
+def test_lost_index_is_rebuilt_from_the_folder(tmp_path):
+    now = time.time()
+    store = make_store(tmp_path, [(now - 1, b"a"), (now, b"b")])
+    (store.backups_dir / INDEX_NAME).unlink()
+    assert sorted(b.ts for b in store.list_backups()) == [now - 1, now]
+    assert (store.backups_dir / INDEX_NAME).exists()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_restore_backup(backend, tmp_path):
+    async def main():
+        if backend == "json":
+            gum = JSONUserManager(data_dir=tmp_path, durable_writes=False)
+        else:
+            gum = SQLiteUserManager(db_path=tmp_path / "gum.sqlite3")
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"v1")
+        await gum.set_data_for_game("alice", "bingo", b"v2", backup=True)
+        [v1] = await gum.list_backups("alice")
+        await gum.restore_backup("alice", "bingo", v1.ts)
+        restored = await gum.get_data_for_game("alice", "bingo")
+        contents = sorted(
+            [
+                await gum.get_backup("alice", b.name, b.ts)
+                for b in await gum.list_backups("alice")
+            ]
+        )
+        with pytest.raises(BackupNotFoundError):
+            await gum.restore_backup("alice", "bingo", 0)
+        await gum.close()
+        return restored, contents
+
+    restored, contents = asyncio.run(main())
+    assert restored == b"v1"
+    # The data that the restore replaced was backed up first
+    assert contents == [b"v1", b"v2"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_restore_backup_keeps_unflushed_writes(backend, tmp_path):
+    async def main():
+        kwargs = {"write_behind": True, "flush_interval": 3600}
+        if backend == "json":
+            gum = JSONUserManager(data_dir=tmp_path, durable_writes=False, **kwargs)
+        else:
+            gum = SQLiteUserManager(db_path=tmp_path / "gum.sqlite3", **kwargs)
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"v1")
+        await gum.flush()
+        await gum.set_data_for_game("alice", "bingo", b"v2", backup=True)
+        await gum.flush()
+        [v1] = await gum.list_backups("alice")
+        # Not written yet when the restore replaces it
+        await gum.set_data_for_game("alice", "bingo", b"v3")
+        await gum.restore_backup("alice", "bingo", v1.ts)
+        restored = await gum.get_data_for_game("alice", "bingo")
+        await gum.close()
+        if backend == "json":
+            gum = JSONUserManager(data_dir=tmp_path, durable_writes=False)
+        else:
+            gum = SQLiteUserManager(db_path=tmp_path / "gum.sqlite3")
+        stored = await gum.get_data_for_game("alice", "bingo")
+        contents = sorted(
+            [
+                await gum.get_backup("alice", b.name, b.ts)
+                for b in await gum.list_backups("alice")
+            ]
+        )
+        await gum.close()
+        return restored, stored, contents
+
+    restored, stored, contents = asyncio.run(main())
+    assert restored == stored == b"v1"
+    assert contents == [b"v1", b"v3"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_compact_backups_applies_the_retention_policy(backend, tmp_path):
+    async def main():
+        policy = RetentionPolicy(keep_last=2, hourly=0, daily=0)
+        if backend == "json":
+            gum = JSONUserManager(
+                data_dir=tmp_path, durable_writes=False, backup_retention=policy
+            )
+        else:
+            gum = SQLiteUserManager(
+                db_path=tmp_path / "gum.sqlite3", backup_retention=policy
+            )
+        await gum.register("alice")
+        for i in range(6):
+            await gum.set_data_for_game("alice", "bingo", f"v{i}".encode(), backup=True)
+        await gum.compact_backups("alice")
+        backups = await gum.list_backups("alice")
+        contents = [await gum.get_backup("alice", b.name, b.ts) for b in backups]
+        await gum.close()
+        return contents
+
+    assert asyncio.run(main()) == [b"v3", b"v4"]
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from gum.journal import UserTableJournal
+
+
+class SlowJournal(UserTableJournal):
+    # Widens the windows in which appends and compactions overlap
+    write_delay = 0.002
+    snapshot_delay = 0.005
+
+    def _write(self, segment, data):
+        time.sleep(self.write_delay)
+        super()._write(segment, data)
+
+    def _write_snapshot(self, snapshot, segment):
+        time.sleep(self.snapshot_delay)
+        super()._write_snapshot(snapshot, segment)
+
+
+def test_replay_restores_appended_records(tmp_path):
+    async def main():
+        journal = UserTableJournal(tmp_path)
+        journal.replay()
+        await journal.append("register", "a", "rsid-a")
+        await journal.append("register", "b", "rsid-b")
+        await journal.append("unregister", "a")
+        await journal.close()
+
+    asyncio.run(main())
+    assert UserTableJournal(tmp_path).replay() == {"b": "rsid-b"}
+
+
+def test_automatic_compaction_keeps_every_record(tmp_path):
+    async def main():
+        journal = UserTableJournal(tmp_path, fsync_delay=0, compact_every=10)
+        journal.replay()
+        for i in range(95):
+            await journal.append("register", f"user{i}", f"rsid{i}")
+        await journal.close()
+
+    asyncio.run(main())
+    assert len(list(tmp_path.glob("user_table.*.journal"))) <= 2
+    assert UserTableJournal(tmp_path).replay() == {
+        f"user{i}": f"rsid{i}" for i in range(95)
+    }
+
+
+def test_compact_concurrent_with_appends_loses_nothing(tmp_path):
+    async def main():
+        journal = SlowJournal(tmp_path, fsync_delay=0)
+        journal.replay()
+        appends = []
+        compactions = []
+        for i in range(200):
+            appends.append(
+                asyncio.create_task(journal.append("register", f"user{i}", f"rsid{i}"))
+            )
+            if i % 7 == 0:
+                compactions.append(asyncio.create_task(journal.compact()))
+            # Let the flusher pick up batches in between
+            await asyncio.sleep(0.001)
+        await asyncio.gather(*appends, *compactions)
+        # Crash here: every acknowledged record must be on disk without a further
+        # compaction or close()
+        return UserTableJournal(tmp_path).replay()
+
+    assert asyncio.run(main()) == {f"user{i}": f"rsid{i}" for i in range(200)}
+
+
+def test_compact_waiting_for_a_compaction_keeps_records_written_meanwhile(tmp_path):
+    async def main():
+        journal = SlowJournal(tmp_path, fsync_delay=0)
+        journal.write_delay = 0.05
+        journal.snapshot_delay = 0.03
+        journal.replay()
+        await journal.append("register", "a", "rsid-a")
+        first = asyncio.create_task(journal.compact())
+        await asyncio.sleep(0.005)
+        # Waits for the first compaction, while "b" is being written to the current
+        # segment
+        second = asyncio.create_task(journal.compact())
+        await asyncio.sleep(0.005)
+        await journal.append("register", "b", "rsid-b")
+        await asyncio.gather(first, second)
+        return UserTableJournal(tmp_path).replay()
+
+    assert asyncio.run(main()) == {"a": "rsid-a", "b": "rsid-b"}
+
+
+def test_compact_covers_records_appended_before_it(tmp_path):
+    async def main():
+        journal = UserTableJournal(tmp_path, fsync_delay=0.01)
+        journal.replay()
+        append = asyncio.create_task(journal.append("register", "a", "rsid-a"))
+        await asyncio.sleep(0)
+        await journal.compact()
+        assert append.done()
+        await journal.close()
+
+    asyncio.run(main())
+    assert (tmp_path / "user_table.json").read_text() == '{"a": "rsid-a"}'
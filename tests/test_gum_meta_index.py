@@ -0,0 +1,133 @@
+import asyncio
+
+from gum import JSONUserManager
+from gum.meta_index import DIRTY_MARKER_NAME, load_index
+
+INDEXED = ("registration.from_game",)
+
+
+def manager(tmp_path, **kwargs) -> JSONUserManager:
+    return JSONUserManager(
+        data_dir=tmp_path,
+        durable_writes=False,
+        meta_index_save_interval=3600,
+        meta_indexes=INDEXED,
+        **kwargs,
+    )
+
+
+class BlockingMetaWrites(JSONUserManager):
+    """Holds meta writes until `release` is set."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writing = asyncio.Event()
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def _write_meta(self, rsid, meta):
+        self.writing.set()
+        await self.release.wait()
+        await super()._write_meta(rsid, meta)
+
+
+def test_find_users_follows_registrations_and_meta_changes(tmp_path):
+    async def main():
+        gum = manager(tmp_path)
+        await gum.register("alice", "bingo")
+        await gum.register("bob", "bingo")
+        await gum.register("carol", "poker")
+        assert sorted(await gum.find_users("registration.from_game", "bingo")) == [
+            "alice",
+            "bob",
+        ]
+        await gum.meta_set("bob", "registration", {"from_game": "poker"})
+        await gum.unregister("carol")
+        assert await gum.find_users("registration.from_game", "poker") == ["bob"]
+        assert await gum.count_users_by("registration.from_game") == {
+            "bingo": 1,
+            "poker": 1,
+        }
+        await gum.close()
+
+    asyncio.run(main())
+
+
+def test_saved_index_is_reused_after_a_clean_shutdown(tmp_path):
+    async def main():
+        gum = manager(tmp_path)
+        # A new data directory has no saved index yet, the first query builds it
+        assert await gum.find_users("registration.from_game", "bingo") == []
+        await gum.register("alice", "bingo")
+        await gum.close()
+        gum = manager(tmp_path)
+        assert not gum._meta_index_stale
+        assert await gum.find_users("registration.from_game", "bingo") == ["alice"]
+        await gum.close()
+
+    asyncio.run(main())
+
+
+def test_dirty_index_is_rebuilt_after_a_crash(tmp_path):
+    async def main():
+        gum = manager(tmp_path)
+        await gum.register("alice", "bingo")
+        await gum.rebuild_meta_indexes()
+        await gum.close()
+        gum = manager(tmp_path)
+        await gum.register("bob", "bingo")
+        # Crash: no close(), the index on disk misses bob but is marked dirty
+        assert (tmp_path / "indexes" / DIRTY_MARKER_NAME).exists()
+        await gum.journal.close()
+        gum = manager(tmp_path)
+        assert gum._meta_index_stale
+        assert sorted(await gum.find_users("registration.from_game", "bingo")) == [
+            "alice",
+            "bob",
+        ]
+        await gum.close()
+
+    asyncio.run(main())
+
+
+def test_save_does_not_clear_the_marker_of_a_change_in_flight(tmp_path):
+    async def main():
+        gum = BlockingMetaWrites(
+            data_dir=tmp_path,
+            durable_writes=False,
+            meta_index_save_interval=3600,
+            meta_indexes=INDEXED,
+        )
+        await gum.register("alice", "bingo")
+        await gum.rebuild_meta_indexes()
+        gum.writing.clear()
+        gum.release.clear()
+        change = asyncio.create_task(
+            gum.meta_set("alice", "registration", {"from_game": "poker"})
+        )
+        # The marker is on disk and the meta write is under way
+        await gum.writing.wait()
+        save = asyncio.create_task(gum._save_meta_index())
+        await asyncio.sleep(0.05)
+        gum.release.set()
+        await asyncio.gather(change, save)
+        # Crash: whatever is on disk now must not be a clean index without the change
+        index = load_index(tmp_path / "indexes", INDEXED)
+        await gum.close()
+        return index
+
+    index = asyncio.run(main())
+    assert index is None or index.find("registration.from_game", "poker") == {"alice"}
+
+
+def test_declare_meta_index_indexes_existing_users(tmp_path):
+    async def main():
+        gum = manager(tmp_path)
+        await gum.register("alice", "bingo")
+        await gum.meta_set("alice", "team", "red")
+        await gum.declare_meta_index("team")
+        found = await gum.find_users("team", "red")
+        await gum.close()
+        return found
+
+    assert asyncio.run(main()) == ["alice"]
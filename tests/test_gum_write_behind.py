@@ -0,0 +1,116 @@
+import asyncio
+
+from gum import JSONUserManager
+
+
+class CountingWrites(JSONUserManager):
+    def __init__(self, *args, fail_writes: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes = []
+        self.fail_writes = fail_writes
+
+    async def _write_data(self, rsid, game_id, data):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise OSError("disk full")
+        self.writes.append(data)
+        await super()._write_data(rsid, game_id, data)
+
+
+def open_manager(tmp_path, **kwargs) -> CountingWrites:
+    kwargs.setdefault("flush_interval", 3600)
+    return CountingWrites(
+        data_dir=tmp_path, durable_writes=False, write_behind=True, **kwargs
+    )
+
+
+def test_writes_are_coalesced_and_reads_see_them(tmp_path):
+    async def main():
+        gum = open_manager(tmp_path)
+        await gum.register("alice")
+        for i in range(100):
+            await gum.set_data_for_game("alice", "bingo", f"{i}".encode())
+        seen = (
+            await gum.get_data_for_game("alice", "bingo"),
+            (await gum.get_many(["alice"], "bingo"))["alice"],
+            await gum.has_data_for_game("alice", "bingo"),
+        )
+        written_before_flush = list(gum.writes)
+        await gum.flush()
+        await gum.close()
+        return seen, written_before_flush, gum.writes
+
+    seen, written_before_flush, writes = asyncio.run(main())
+    assert seen == (b"99", b"99", True)
+    assert written_before_flush == []
+    assert writes == [b"99"]
+
+
+def test_close_flushes_dirty_data(tmp_path):
+    async def main():
+        gum = open_manager(tmp_path)
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"latest")
+        await gum.close()
+        gum = JSONUserManager(data_dir=tmp_path, durable_writes=False)
+        data = await gum.get_data_for_game("alice", "bingo")
+        await gum.close()
+        return data
+
+    assert asyncio.run(main()) == b"latest"
+
+
+def test_flushes_on_interval_and_threshold(tmp_path):
+    async def main():
+        gum = open_manager(tmp_path, flush_interval=0.05)
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"a")
+        await asyncio.sleep(0.2)
+        after_interval = list(gum.writes)
+        await gum.close()
+
+        gum = open_manager(tmp_path, flush_max_dirty=2)
+        for user_id in ("bob", "carol"):
+            await gum.register(user_id)
+            await gum.set_data_for_game(user_id, "bingo", user_id.encode())
+        await asyncio.sleep(0.1)
+        after_threshold = sorted(gum.writes)
+        await gum.close()
+        return after_interval, after_threshold
+
+    after_interval, after_threshold = asyncio.run(main())
+    assert after_interval == [b"a"]
+    assert after_threshold == [b"bob", b"carol"]
+
+
+def test_failed_flushes_are_retried(tmp_path):
+    async def main():
+        gum = open_manager(tmp_path, fail_writes=1)
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"data")
+        await gum.flush()
+        still_dirty = bool(gum._dirty)
+        served = await gum.get_data_for_game("alice", "bingo")
+        await gum.flush()
+        await gum.close()
+        return still_dirty, served, gum.writes
+
+    still_dirty, served, writes = asyncio.run(main())
+    assert still_dirty
+    assert served == b"data"
+    assert writes == [b"data"]
+
+
+def test_deleting_dirty_data_keeps_it_as_a_backup(tmp_path):
+    async def main():
+        gum = open_manager(tmp_path)
+        await gum.register("alice")
+        await gum.set_data_for_game("alice", "bingo", b"dirty")
+        await gum.delete_data_for_game("alice", "bingo")
+        backups = await gum.list_backups("alice")
+        content = await gum.get_backup("alice", backups[0].name, backups[0].ts)
+        exists = await gum.has_data_for_game("alice", "bingo")
+        await gum.close()
+        return [b.kind for b in backups], content, exists
+
+    assert asyncio.run(main()) == (["del"], b"dirty", False)
@@ -0,0 +1,115 @@
+import asyncio
+from typing import AsyncIterator, List, Optional
+
+from llm_api.llm_base import CachingLLM, LLM, LLMReturnChunk
+
+
+class CountingLLM(LLM):
+    def __init__(self, fail: bool = False):
+        super().__init__("NoModel")
+        self.queries = 0
+        self.fail = fail
+
+    async def query(
+        self, query_str: str, history: Optional[List[dict]] = None
+    ) -> AsyncIterator[LLMReturnChunk]:
+        self.queries += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            yield LLMReturnChunk(should_stop=True, has_error=True, error_info="boom")
+            return
+        yield LLMReturnChunk(should_stop=False, content=f"answer to {query_str}")
+        yield LLMReturnChunk(should_stop=True, stop_reason="stop")
+
+
+async def answer(llm: LLM, prompt: str, history=None) -> str:
+    return "".join([chunk.content async for chunk in llm.query(prompt, history)])
+
+
+def test_identical_prompts_share_one_upstream_query():
+    async def main():
+        upstream = CountingLLM()
+        llm = CachingLLM(upstream)
+        answers = await asyncio.gather(*(answer(llm, "hi") for _ in range(5)))
+        answers.append(await answer(llm, "  hi "))
+        return answers, upstream.queries, llm.cache_stats()
+
+    answers, queries, stats = asyncio.run(main())
+    assert answers == ["answer to hi"] * 6
+    assert queries == 1
+    assert stats["misses"] == 1 and stats["shared"] == 4 and stats["hits"] == 1
+
+
+def test_history_is_part_of_the_key():
+    async def main():
+        upstream = CountingLLM()
+        llm = CachingLLM(upstream)
+        await answer(llm, "hi", [{"role": "user", "content": "I am Alice"}])
+        await answer(llm, "hi", [{"role": "user", "content": "I am Bob"}])
+        return upstream.queries
+
+    assert asyncio.run(main()) == 2
+
+
+def test_errors_are_not_cached():
+    async def main():
+        upstream = CountingLLM(fail=True)
+        llm = CachingLLM(upstream)
+        await answer(llm, "hi")
+        await answer(llm, "hi")
+        return upstream.queries
+
+    assert asyncio.run(main()) == 2
+
+
+def test_answers_stay_in_memory_unless_a_cache_dir_is_given(tmp_path):
+    async def main():
+        in_memory = CachingLLM(CountingLLM())
+        await answer(in_memory, "hi")
+        on_disk = CachingLLM(CountingLLM(), cache_dir=tmp_path)
+        await answer(on_disk, "hi")
+        await asyncio.sleep(0.1)
+        # A new process finds the answer on disk
+        upstream = CountingLLM()
+        restarted = CachingLLM(upstream, cache_dir=tmp_path)
+        return in_memory.cache_dir, await answer(restarted, "hi"), upstream.queries
+
+    cache_dir, restored, queries = asyncio.run(main())
+    assert cache_dir is None
+    assert len(list(tmp_path.glob("*.json"))) == 1
+    assert restored == "answer to hi"
+    assert queries == 0
+
+
+class StoppingLLM(LLM):
+    """Says more after its stop chunk, so the consumer stops before it is exhausted."""
+
+    def __init__(self):
+        super().__init__("NoModel")
+        self.streams = []  # kept alive, so that nothing but aclose() finalizes them
+        self.closed = 0
+
+    def query(self, query_str: str, history: Optional[List[dict]] = None):
+        stream = self._query(query_str)
+        self.streams.append(stream)
+        return stream
+
+    async def _query(self, query_str: str) -> AsyncIterator[LLMReturnChunk]:
+        try:
+            yield LLMReturnChunk(should_stop=False, content=f"answer to {query_str}")
+            yield LLMReturnChunk(should_stop=True, stop_reason="stop")
+            yield LLMReturnChunk(should_stop=True, content=" (ignored)")
+        finally:
+            self.closed += 1
+
+
+def test_upstream_streams_are_closed_once_the_answer_is_complete():
+    async def main():
+        upstream = StoppingLLM()
+        llm = CachingLLM(upstream)
+        answers = await asyncio.gather(answer(llm, "hi"), answer(llm, "hi"))
+        return answers, upstream.closed, len(upstream.streams)
+
+    answers, closed, streams = asyncio.run(main())
+    assert answers == ["answer to hi"] * 2
+    assert closed == streams == 1
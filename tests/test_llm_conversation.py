@@ -0,0 +1,153 @@
+import asyncio
+from typing import List
+
+from llm_api.conversation import (
+    MESSAGE_OVERHEAD,
+    ConversationStore,
+    JSONConversationBackend,
+    Turn,
+    count_tokens,
+)
+
+
+class GatedSummarizer:
+    """Summarizes `turns` once `gate` is set."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.started = asyncio.Event()
+        self.calls = 0
+
+    async def __call__(self, summary: str, turns: List[Turn]) -> str:
+        self.calls += 1
+        self.started.set()
+        await self.gate.wait()
+        return f"{summary} [{len(turns)} turns]".strip()
+
+
+def test_history_keeps_the_newest_turns_within_budget():
+    async def main():
+        store = ConversationStore()
+        conversation = await store.get("channel:user")
+        conversation.turns = [
+            Turn("user", f"question {i}", tokens=10) for i in range(5)
+        ]
+        newest = await store.history("channel:user", max_tokens=25)
+        conversation.summary = "earlier"
+        summary_tokens = (
+            count_tokens("Summary of the earlier conversation: earlier")
+            + MESSAGE_OVERHEAD
+        )
+        with_summary = await store.history(
+            "channel:user", max_tokens=summary_tokens + 30
+        )
+        return newest, with_summary
+
+    newest, with_summary = asyncio.run(main())
+    assert [m["content"] for m in newest] == ["question 3", "question 4"]
+    assert with_summary[0] == {
+        "role": "system",
+        "content": "Summary of the earlier conversation: earlier",
+    }
+    assert [m["content"] for m in with_summary[1:]] == [
+        "question 2",
+        "question 3",
+        "question 4",
+    ]
+
+
+def test_oldest_turns_are_summarized_in_the_background():
+    async def main():
+        summarizer = GatedSummarizer()
+        store = ConversationStore(max_tokens=100, summarizer=summarizer)
+        n = 0
+        while store.stats()["compacting"] == 0:
+            # Replies are not held up by the summarizer
+            await asyncio.wait_for(
+                store.record("channel:user", f"question {n} " * 5, f"answer {n} " * 5),
+                1,
+            )
+            n += 1
+        await summarizer.started.wait()
+        # Recorded while summarizing, kept after it
+        await store.record("channel:user", "late question", "late answer")
+        summarizer.gate.set()
+        await store.aclose()
+        conversation = await store.get("channel:user")
+        return n, conversation, await store.history("channel:user"), store.stats()
+
+    recorded, conversation, history, stats = asyncio.run(main())
+    folded = 2 * (recorded + 1) - len(conversation.turns)
+    assert conversation.summary == f"[{folded} turns]"
+    assert conversation.turns[-1].content == "late answer"
+    # Compacted down to compact_to * max_tokens, late turns aside
+    assert sum(turn.tokens for turn in conversation.turns[:-2]) <= 50
+    assert history[0]["role"] == "system"
+    assert stats["summaries"] == 1 and stats["compacting"] == 0
+
+
+def test_reset_while_summarizing_drops_the_summary(tmp_path):
+    async def main():
+        summarizer = GatedSummarizer()
+        backend = JSONConversationBackend(tmp_path)
+        store = ConversationStore(backend, max_tokens=50, summarizer=summarizer)
+        while store.stats()["compacting"] == 0:
+            await store.record("channel:user", "question " * 10, "answer " * 10)
+        await summarizer.started.wait()
+        await store.reset("channel:user")
+        summarizer.gate.set()
+        await store.aclose()
+        return (
+            await store.history("channel:user"),
+            await backend.load("channel:user"),
+            store.stats(),
+        )
+
+    history, saved, stats = asyncio.run(main())
+    assert history == [] and saved is None
+    assert stats["summaries"] == 0
+
+
+def test_failed_summaries_keep_the_turns_within_bounds():
+    async def main():
+        async def failing(summary: str, turns: List[Turn]) -> str:
+            raise RuntimeError("upstream down")
+
+        store = ConversationStore(max_tokens=100, summarizer=failing)
+        conversation = await store.get("channel:user")
+        recorded = 0
+        while conversation.turn_tokens <= 100:
+            await store.record("channel:user", "question " * 10, "answer " * 10)
+            recorded += 2
+        await store.aclose()
+        kept = len(conversation.turns)
+        # Past twice the budget, the oldest turns are dropped without a summary
+        while conversation.turn_tokens <= 200:
+            await store.record("channel:user", "question " * 10, "answer " * 10)
+        await store.aclose()
+        return recorded, kept, conversation
+
+    recorded, kept, conversation = asyncio.run(main())
+    assert kept == recorded
+    assert conversation.turn_tokens <= 50 and conversation.summary == ""
+
+
+def test_evicted_conversations_are_reloaded_from_the_backend(tmp_path):
+    async def main():
+        backend = JSONConversationBackend(tmp_path)
+        store = ConversationStore(backend, max_conversations=2)
+        for key in ["a", "b", "c"]:
+            await store.record(key, f"hello from {key}", f"hi {key}")
+        in_memory = list(store.conversations)
+        history = await store.history("a")
+        return in_memory, history, list(store.conversations), store.stats()
+
+    in_memory, history, after, stats = asyncio.run(main())
+    assert in_memory == ["b", "c"]
+    assert history == [
+        {"role": "user", "content": "hello from a"},
+        {"role": "assistant", "content": "hi a"},
+    ]
+    # Reloading `a` evicts the least recently used one
+    assert after == ["c", "a"]
+    assert stats["evictions"] == 2
@@ -0,0 +1,81 @@
+import asyncio
+
+from aiohttp import web
+
+from llm_api import http_pool
+from llm_api.http_pool import HTTPClientRegistry
+
+
+def test_clients_are_shared_per_endpoint_and_proxy():
+    async def main():
+        registry = HTTPClientRegistry()
+        a = registry.get("https://a.example/v1")
+        same = registry.get("https://a.example/v1", proxy="")
+        proxied = registry.get("https://a.example/v1", proxy="http://127.0.0.1:3128")
+        b = registry.get("https://b.example/v1")
+        await registry.aclose()
+        return a, same, proxied, b, registry.clients
+
+    a, same, proxied, b, left = asyncio.run(main())
+    assert a is same
+    assert len({id(a), id(proxied), id(b)}) == 3
+    assert left == {} and a.is_closed and proxied.is_closed and b.is_closed
+
+
+def test_closed_clients_are_replaced():
+    async def main():
+        registry = HTTPClientRegistry()
+        first = registry.get("https://a.example/v1")
+        await first.aclose()
+        second = registry.get("https://a.example/v1")
+        await registry.aclose()
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert second is not first
+
+
+def test_http2_falls_back_without_h2(monkeypatch):
+    monkeypatch.setattr(http_pool, "HTTP2_AVAILABLE", False)
+
+    async def main():
+        registry = HTTPClientRegistry({"http2": True, "max_connections": 3})
+        client = registry.get("https://a.example/v1")
+        await registry.aclose()
+        return client
+
+    client = asyncio.run(main())
+    pool = client._transport._pool
+    assert not pool._http2 and pool._max_connections == 3
+
+
+def test_queries_reuse_kept_alive_connections():
+    async def main():
+        peers = []
+
+        async def handle(request: web.Request) -> web.Response:
+            peers.append(request.transport.get_extra_info("peername"))
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        base_url = f"http://127.0.0.1:{port}/v1"
+        registry = HTTPClientRegistry()
+        try:
+            for _ in range(3):
+                # As two providers (or queries) sharing an endpoint would
+                client = registry.get(base_url)
+                response = await client.post(f"{base_url}/chat/completions", json={})
+                assert response.json() == {"ok": True}
+        finally:
+            await registry.aclose()
+            await runner.cleanup()
+        return peers
+
+    peers = asyncio.run(main())
+    assert len(peers) == 3 and len(set(peers)) == 1
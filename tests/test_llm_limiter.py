@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from llm_api.limiter import FairLimiter, LLMQueueFull
+
+
+def test_concurrency_is_capped():
+    async def main():
+        limiter = FairLimiter(max_concurrency=2)
+        running, peak = 0, 0
+
+        async def query():
+            nonlocal running, peak
+            async with limiter.slot():
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.02)
+                running -= 1
+
+        await asyncio.gather(*(query() for _ in range(6)))
+        return peak, limiter.stats()
+
+    peak, stats = asyncio.run(main())
+    assert peak == 2
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+
+def test_waiters_are_served_round_robin_across_guilds_and_users():
+    async def main():
+        limiter = FairLimiter(max_concurrency=1)
+        release = asyncio.Event()
+        served, positions = [], {}
+
+        async def query(name: str, guild_id: str, user_id: str):
+            def on_queued(position, wait):
+                positions.setdefault(name, []).append(position)
+
+            async with limiter.slot(user_id, guild_id, on_queued):
+                served.append(name)
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        tasks = []
+        for name, guild_id, user_id in [
+            ("a1", "A", "1"),
+            ("a2", "A", "1"),
+            ("a3", "A", "1"),
+            ("b1", "A", "2"),
+            ("c1", "B", "3"),
+        ]:
+            tasks.append(asyncio.create_task(query(name, guild_id, user_id)))
+            await asyncio.sleep(0)
+        queued = limiter.queued
+        release.set()
+        await asyncio.gather(holder, *tasks)
+        return queued, served, positions
+
+    queued, served, positions = asyncio.run(main())
+    assert queued == 5
+    # A burst of one user does not hold up the other user or the other guild
+    assert served == ["a1", "c1", "b1", "a2", "a3"]
+    # Told their position as others joined ahead of them, and as the queue moved
+    assert positions["a3"] == [3, 4, 5, 4, 3, 2, 1]
+    assert positions["c1"][-1] == 1
+
+
+def test_queries_over_max_wait_are_rejected():
+    async def main():
+        limiter = FairLimiter(max_concurrency=1, max_wait=15, initial_duration=10)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        async def query():
+            async with limiter.slot("user", "guild"):
+                pass
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        first = asyncio.create_task(query())
+        await asyncio.sleep(0)
+        with pytest.raises(LLMQueueFull) as rejected:
+            await query()
+        stats = limiter.stats()
+        release.set()
+        await asyncio.gather(holder, first)
+        return rejected.value, stats
+
+    error, stats = asyncio.run(main())
+    assert error.estimated_wait == 20
+    assert stats["rejected"] == 1 and stats["queued"] == 1
+
+
+def test_cancelled_waiters_leave_the_queue():
+    async def main():
+        limiter = FairLimiter(max_concurrency=1)
+        release = asyncio.Event()
+        positions = []
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        async def query(user_id, on_queued=None):
+            async with limiter.slot(user_id, "guild", on_queued):
+                pass
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(query("1"))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(
+            query("2", lambda position, wait: positions.append(position))
+        )
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        queued = limiter.queued
+        release.set()
+        await asyncio.gather(holder, waiting)
+        return queued, positions, limiter.stats()
+
+    queued, positions, stats = asyncio.run(main())
+    assert queued == 1
+    assert positions == [2, 1]
+    assert stats["active"] == 0 and stats["queued"] == 0
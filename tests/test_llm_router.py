@@ -0,0 +1,226 @@
+import asyncio
+from typing import AsyncIterator, List, Optional
+
+import pytest
+
+from llm_api.llm_base import LLM, LLMReturnChunk
+from llm_api.router import RouterLLM
+
+
+class FakeBackend(LLM):
+    def __init__(self, name, ttft: float, fail: bool = False):
+        super().__init__(name)
+        self.ttft = ttft
+        self.fail = fail
+        self.queries = 0
+        self.cancelled = 0
+
+    async def query(
+        self, query_str: str, history: Optional[List[dict]] = None
+    ) -> AsyncIterator[LLMReturnChunk]:
+        self.queries += 1
+        try:
+            await asyncio.sleep(self.ttft)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.fail:
+            yield LLMReturnChunk(should_stop=True, has_error=True, error_info="boom")
+            return
+        yield LLMReturnChunk(should_stop=False, content=f"{self.name} says hi.")
+        yield LLMReturnChunk(should_stop=True, stop_reason="stop")
+
+
+class MidStreamFailure(FakeBackend):
+    """Fails after its first token, with an error chunk or by raising."""
+
+    def __init__(self, name, raises: bool = False):
+        super().__init__(name, 0)
+        self.raises = raises
+
+    async def query(
+        self, query_str: str, history: Optional[List[dict]] = None
+    ) -> AsyncIterator[LLMReturnChunk]:
+        self.queries += 1
+        yield LLMReturnChunk(should_stop=False, content=f"{self.name} says")
+        if self.raises:
+            raise ConnectionError("connection reset")
+        yield LLMReturnChunk(should_stop=True, has_error=True, error_info="overloaded")
+
+
+async def ask(router: RouterLLM) -> str:
+    chunks = [chunk async for chunk in router.query("Hello!")]
+    assert chunks[-1].should_stop
+    if chunks[-1].has_error:
+        return "error"
+    return "".join(chunk.content for chunk in chunks)
+
+
+def test_routes_to_the_only_backend():
+    async def main():
+        router = RouterLLM("router", [FakeBackend("a", 0)], hedge=False)
+        return await ask(router), router.router_stats()
+
+    answer, stats = asyncio.run(main())
+    assert answer == "a says hi."
+    assert stats["backends"]["a"]["samples"] == 1
+    assert stats["backends"]["a"]["error_rate"] == 0
+
+
+def test_fails_over_to_the_next_backend():
+    async def main():
+        broken, working = FakeBackend("broken", 0, fail=True), FakeBackend("working", 0)
+        router = RouterLLM("router", [broken, working], hedge=False)
+        answer = await ask(router)
+        return answer, broken, working, router.router_stats()
+
+    answer, broken, working, stats = asyncio.run(main())
+    assert answer == "working says hi."
+    assert broken.queries == working.queries == 1
+    assert stats["backends"]["broken"]["error_rate"] == 1
+    assert stats["backends"]["broken"]["samples"] == 1
+    assert stats["backends"]["working"]["samples"] == 1
+
+
+def test_reports_an_error_when_every_backend_fails():
+    async def main():
+        router = RouterLLM(
+            "router", [FakeBackend("a", 0, fail=True), FakeBackend("b", 0, fail=True)]
+        )
+        return [chunk async for chunk in router.query("Hello!")]
+
+    chunks = asyncio.run(main())
+    assert len(chunks) == 1
+    assert chunks[0].has_error
+    assert "boom" in chunks[0].error_info
+
+
+def test_cools_down_failing_backends():
+    async def main():
+        broken, working = FakeBackend("broken", 0, fail=True), FakeBackend("working", 0)
+        router = RouterLLM(
+            "router", [broken, working], hedge=False, min_samples=2, cooldown=60
+        )
+        assert await ask(router) == "working says hi."
+        # One failure is not enough evidence yet
+        assert not router.router_stats()["backends"]["broken"]["cooling_down"]
+        router.stats["working"].cooldown_until = float("inf")
+        assert await ask(router) == "working says hi."
+        assert router.router_stats()["backends"]["broken"]["cooling_down"]
+        router.stats["working"].cooldown_until = 0
+        broken.queries = 0
+        for _ in range(5):
+            assert await ask(router) == "working says hi."
+        return broken, router
+
+    broken, router = asyncio.run(main())
+    assert broken.queries == 0
+    assert router.ranked_backends()[-1] is broken
+
+
+def test_cooling_backends_are_still_tried_last():
+    async def main():
+        broken = FakeBackend("broken", 0, fail=True)
+        router = RouterLLM("router", [broken], min_samples=1, cooldown=60)
+        await ask(router)
+        assert router.router_stats()["backends"]["broken"]["cooling_down"]
+        broken.fail = False
+        return await ask(router)
+
+    assert asyncio.run(main()) == "broken says hi."
+
+
+def test_hedges_slow_backends():
+    async def main():
+        slow, fast = FakeBackend("slow", 1.0), FakeBackend("fast", 0.01)
+        router = RouterLLM("router", [slow, fast], hedge_delay=0.05)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        answer = await ask(router)
+        return answer, loop.time() - started, slow, router.router_stats()
+
+    answer, elapsed, slow, stats = asyncio.run(main())
+    assert answer == "fast says hi."
+    assert elapsed < 0.5
+    assert slow.cancelled == 1
+    assert stats["hedged"] == 1
+    slow_stats = stats["backends"]["slow"]
+    # The cancelled stream is a lower bound of its time-to-first-token, not an outcome
+    assert slow_stats["samples"] == 0
+    assert slow_stats["ttft_samples"] == slow_stats["cancelled"] == 1
+    assert slow_stats["error_rate"] == 0
+    assert slow_stats["p50_ttft"] == pytest.approx(0.06, abs=0.05)
+    assert stats["backends"]["fast"]["samples"] == 1
+
+
+def test_learns_to_prefer_the_fast_backend():
+    async def main():
+        slow, fast = FakeBackend("slow", 0.5), FakeBackend("fast", 0.01)
+        router = RouterLLM("router", [slow, fast], hedge_delay=0.05)
+        answers = [await ask(router) for _ in range(4)]
+        return answers, slow, router
+
+    answers, slow, router = asyncio.run(main())
+    assert answers == ["fast says hi."] * 4
+    # Only the first query waited on the slow backend
+    assert slow.queries == 1
+    assert router.hedged == 1
+    assert [b.name for b in router.ranked_backends()] == ["fast", "slow"]
+
+
+def test_without_hedging_waits_for_the_first_backend():
+    async def main():
+        slow, fast = FakeBackend("slow", 0.1), FakeBackend("fast", 0.01)
+        router = RouterLLM("router", [slow, fast], hedge=False)
+        return await ask(router), fast, router
+
+    answer, fast, router = asyncio.run(main())
+    assert answer == "slow says hi."
+    assert fast.queries == 0
+    assert router.hedged == 0
+
+
+def test_consumer_leaving_cancels_racing_streams():
+    async def main():
+        slow, slower = FakeBackend("slow", 1.0), FakeBackend("slower", 1.0)
+        router = RouterLLM("router", [slow, slower], hedge_delay=0.01)
+        task = asyncio.create_task(ask(router))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return slow, slower, router.router_stats()
+
+    slow, slower, stats = asyncio.run(main())
+    assert slow.cancelled == slower.cancelled == 1
+    for name in ("slow", "slower"):
+        assert stats["backends"][name]["cancelled"] == 1
+        assert stats["backends"][name]["samples"] == 0
+
+
+def test_failures_after_the_first_token_count():
+    async def main():
+        flaky = MidStreamFailure("flaky")
+        router = RouterLLM("router", [flaky], min_samples=2, cooldown=60)
+        answers = [await ask(router) for _ in range(2)]
+        return answers, router.router_stats()["backends"]["flaky"]
+
+    answers, stats = asyncio.run(main())
+    assert answers == ["error", "error"]
+    assert stats["samples"] == stats["ttft_samples"] == 2
+    assert stats["error_rate"] == 1
+    assert stats["cooling_down"]
+
+
+def test_streams_raising_after_the_first_token_count():
+    async def main():
+        flaky = MidStreamFailure("flaky", raises=True)
+        router = RouterLLM("router", [flaky, FakeBackend("working", 0)])
+        with pytest.raises(ConnectionError):
+            await ask(router)
+        assert await ask(router) == "working says hi."
+        return router.router_stats()["backends"]
+
+    stats = asyncio.run(main())
+    assert stats["flaky"]["samples"] == 1 and stats["flaky"]["error_rate"] == 1
+    assert stats["working"]["samples"] == 1 and stats["working"]["error_rate"] == 0
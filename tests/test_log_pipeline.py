@@ -0,0 +1,117 @@
+import gzip
+import json
+
+from loguru import logger
+
+from kbx.log_pipeline import BatchingSink
+
+
+def log_through(sink: BatchingSink, log):
+    handler_id = logger.add(sink, format=sink.format, level="DEBUG")
+    try:
+        log()
+    finally:
+        logger.remove(handler_id)
+        sink.stop()
+
+
+def read_lines(directory, pattern="*.log*"):
+    lines = []
+    for path in sorted(directory.glob(pattern)):
+        data = path.read_bytes()
+        if path.suffix == ".gz":
+            data = gzip.decompress(data)
+        lines.extend(data.decode().splitlines())
+    return lines
+
+
+def failing():
+    raise ValueError("boom")
+
+
+def test_text_records_keep_tracebacks(tmp_path):
+    sink = BatchingSink(tmp_path)
+
+    def log():
+        logger.info("hello {}", "world")
+        try:
+            failing()
+        except ValueError:
+            logger.exception("it failed")
+
+    log_through(sink, log)
+    text = "\n".join(read_lines(tmp_path))
+    assert "hello world" in text
+    assert "it failed" in text
+    assert "Traceback" in text and "in failing" in text
+    assert sink.stats()["written"] == 2
+
+
+def test_jsonl_records_keep_tracebacks(tmp_path):
+    sink = BatchingSink(tmp_path, fmt="jsonl")
+
+    def log():
+        logger.bind(guild="g1").info("hello")
+        try:
+            failing()
+        except ValueError:
+            logger.exception("it failed")
+
+    log_through(sink, log)
+    hello, failed = [json.loads(line) for line in read_lines(tmp_path, "*.jsonl")]
+    assert hello["message"] == "hello"
+    assert hello["extra"] == {"guild": "g1"}
+    assert "exception" not in hello
+    exception = failed["exception"]
+    assert exception["type"] == "ValueError"
+    assert exception["value"] == "ValueError('boom')"
+    assert "Traceback" in exception["traceback"]
+    assert "in failing" in exception["traceback"]
+
+
+def test_full_buffer_drops_oldest_records_and_reports_them(tmp_path):
+    sink = BatchingSink(tmp_path, capacity=4, batch_size=1000, flush_interval=3600)
+
+    def log():
+        for i in range(10):
+            logger.info("record {}", i)
+
+    log_through(sink, log)
+    lines = read_lines(tmp_path)
+    assert "6 log records dropped" in lines[0]
+    assert [line.rsplit(" ", 1)[-1] for line in lines[1:]] == ["6", "7", "8", "9"]
+    assert sink.stats()["dropped"] == 6
+
+
+def test_segments_rotate_and_are_compressed(tmp_path):
+    sink = BatchingSink(tmp_path, compress=True, segment_bytes=200, batch_size=1)
+
+    def log():
+        for i in range(20):
+            logger.info("record {}", i)
+            sink._wakeup.set()
+
+    log_through(sink, log)
+    assert list(tmp_path.glob("*.log.gz"))
+    assert [line.rsplit(" ", 1)[-1] for line in read_lines(tmp_path)] == [
+        str(i) for i in range(20)
+    ]
+
+
+def test_writer_failures_are_counted_and_reported_once(tmp_path, capsys):
+    sink = BatchingSink(tmp_path, flush_interval=0.01)
+
+    def broken_segment_for(size):
+        raise OSError("disk full")
+
+    sink._segment_for = broken_segment_for
+
+    def log():
+        for i in range(3):
+            logger.info("record {}", i)
+            sink._wakeup.set()
+            sink._thread.join(0.05)
+
+    log_through(sink, log)
+    assert sink.stats()["failures"] >= 2
+    assert capsys.readouterr().err.count("KookBotX log writer failed") == 1
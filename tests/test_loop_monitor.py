@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+from loguru import logger
+
+from kbx.loop_monitor import LoopMonitor
+
+
+def monitored(coro_func):
+    """Run `coro_func(monitor)` under a started monitor, with the warnings it logged."""
+
+    async def main():
+        monitor = LoopMonitor(interval=0.02, slow_threshold=0.1)
+        monitor.start()
+        try:
+            result = await coro_func(monitor)
+            # Lets the tick after the stall report it
+            await asyncio.sleep(0.1)
+        finally:
+            monitor.stop()
+        return monitor, result
+
+    warnings = []
+    sink = logger.add(lambda m: warnings.append(str(m)), level="WARNING")
+    try:
+        monitor, result = asyncio.run(main())
+    finally:
+        logger.remove(sink)
+    return monitor, result, warnings
+
+
+def blocking_handler():
+    time.sleep(0.3)  # a blocking call, as in a careless module
+
+
+def test_blocked_loop_is_reported_with_its_task_and_stack():
+    async def block(monitor):
+        async def handler():
+            await asyncio.sleep(0.05)
+            blocking_handler()
+
+        await asyncio.create_task(handler(), name="careless")
+
+    monitor, _, warnings = monitored(block)
+    stats = monitor.stats()
+    assert stats["slow_callbacks"] == 1
+    assert stats["lag_max_seconds"] >= 0.25
+    assert stats["lag_p50_seconds"] < 0.05
+    during, after = warnings
+    assert "Event loop blocked for" in during
+    assert "in task careless (test_blocked_loop" in during
+    assert "blocking_handler (test_loop_monitor.py:" in during
+    assert "time.sleep(0.3)" in during
+    lag = int(after.split("Event loop was blocked for ")[1].split("ms")[0])
+    assert 250 <= lag < 1000
+
+
+def test_callbacks_outside_of_tasks_are_reported_too():
+    async def block(monitor):
+        asyncio.get_running_loop().call_soon(blocking_handler)
+        await asyncio.sleep(0.05)
+
+    monitor, _, warnings = monitored(block)
+    assert monitor.stats()["slow_callbacks"] == 1
+    assert "in a callback outside of any task" in warnings[0]
+
+
+def test_profile_samples_the_loop_thread(tmp_path):
+    async def block(monitor):
+        profile = asyncio.create_task(
+            monitor.profile(0.5, 0.005, path=tmp_path / "loop.folded")
+        )
+        await asyncio.sleep(0.05)
+        blocking_handler()
+        return await profile
+
+    _, path, _ = monitored(block)
+    samples = {}
+    for line in path.read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        samples[stack] = int(count)
+    blocked = sum(
+        count
+        for stack, count in samples.items()
+        if stack.endswith("blocking_handler (test_loop_monitor.py)")
+    )
+    # About 0.3s out of 0.5s, sampled every 5ms
+    assert blocked >= 20
@@ -0,0 +1,103 @@
+import asyncio
+
+from message_logger.archive import ArchivedMessage, MessageArchive, tokenize
+
+START = 1_700_000_000.0
+CONTENTS = ["gg well played", "今天打游戏吗", "hello there", "好 see you tomorrow!"]
+
+
+def message(i: int) -> ArchivedMessage:
+    return ArchivedMessage(
+        id=f"m{i}",
+        time=START + i,
+        guild_id=f"g{i % 2}",
+        channel_id=f"c{i % 5}",
+        author_id=f"u{i % 3}",
+        author="someone",
+        content=CONTENTS[i % 4],
+    )
+
+
+def fill(directory, count: int = 100, **kwargs) -> MessageArchive:
+    async def main():
+        archive = MessageArchive(
+            directory, segment_records=30, flush_interval=0.01, **kwargs
+        )
+        for i in range(count):
+            archive.add(message(i))
+        await archive.aclose()
+        return archive
+
+    return asyncio.run(main())
+
+
+def expected(predicate, count: int = 100) -> list:
+    return [f"m{i}" for i in reversed(range(count)) if predicate(message(i))]
+
+
+def search(archive: MessageArchive, **filters) -> list:
+    return [m.id for m in asyncio.run(archive.search(limit=1000, **filters))]
+
+
+def test_tokens_are_words_and_cjk_bigrams():
+    assert tokenize("GG well-played") == {"gg", "well", "played"}
+    assert tokenize("今天打游戏") == {"今天", "天打", "打游", "游戏"}
+    assert tokenize("好") == set()
+
+
+def test_filters_across_sealed_and_active_segments(tmp_path):
+    archive = fill(tmp_path)
+    assert archive.stats() == {
+        "segments": 4,
+        "messages": 100,
+        "pending": 0,
+        "dropped": 0,
+    }
+    assert search(archive, channel_id="c3") == expected(lambda m: m.channel_id == "c3")
+    assert search(archive, guild_id="g1", author_id="u2") == expected(
+        lambda m: m.guild_id == "g1" and m.author_id == "u2"
+    )
+    assert search(archive, since=START + 25, until=START + 64) == expected(
+        lambda m: START + 25 <= m.time <= START + 64
+    )
+    assert search(archive, text="Well Played", channel_id="c1") == expected(
+        lambda m: "well played" in m.content and m.channel_id == "c1"
+    )
+    assert search(archive, text="游戏") == expected(lambda m: "游戏" in m.content)
+    assert search(archive, text="well tomorrow") == []
+    # Newest first, up to `limit`
+    found = asyncio.run(archive.search(text="hello", limit=3))
+    assert [m.id for m in found] == expected(lambda m: "hello" in m.content)[:3]
+
+
+def test_text_without_tokens_is_matched_on_the_content(tmp_path):
+    archive = fill(tmp_path)
+    assert search(archive, text="好") == expected(lambda m: "好" in m.content)
+    assert search(archive, text="游") == expected(lambda m: "游" in m.content)
+    assert search(archive, text="!", channel_id="c3") == expected(
+        lambda m: "!" in m.content and m.channel_id == "c3"
+    )
+    assert search(archive, text="饭") == []
+
+
+def test_reopened_archive_rebuilds_the_active_index(tmp_path):
+    fill(tmp_path)
+    # A line cut short by a crash is dropped
+    with open(tmp_path / "seg-000004.jsonl", "ab") as f:
+        f.write(b'{"id": "m100", "ti')
+    archive = MessageArchive(tmp_path, segment_records=30)
+    assert archive.stats()["messages"] == 100
+    assert search(archive, author_id="u0") == expected(lambda m: m.author_id == "u0")
+
+    async def main():
+        archive.add(message(100))
+        await archive.aclose()
+
+    asyncio.run(main())
+    assert search(archive, since=START + 99) == ["m100", "m99"]
+
+
+def test_messages_beyond_max_pending_are_dropped(tmp_path):
+    archive = fill(tmp_path, count=20, max_pending=5)
+    stats = archive.stats()
+    assert stats["messages"] == 5 and stats["dropped"] == 15
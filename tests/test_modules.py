@@ -0,0 +1,185 @@
+import asyncio
+import sys
+import types
+
+import pytest
+
+from kbx.modules import ModuleManifest, dependency_cycle, read_manifest
+from main import KookBotX
+
+LAZY_MODULE = """
+from khl import Bot, Message
+
+from kbx_test_events import events
+
+events.append("lazy_probe imported")
+
+
+def init(bot: Bot):
+    @bot.command("hey")
+    async def hey(msg: Message, *args):
+        events.append(("hey", args))
+
+    @bot.command("hey-reset")
+    async def hey_reset(msg: Message):
+        events.append(("hey-reset", ()))
+"""
+
+ASYNC_INIT_MODULE = """
+import asyncio
+
+from kbx_test_events import events
+
+
+def init(bot):
+    async def later():
+        events.append("{name} started")
+        await asyncio.sleep({delay})
+        events.append("{name} done")
+
+    return later()
+"""
+
+
+def package(content: str) -> dict:
+    author = {
+        "id": "42",
+        "username": "alice",
+        "nickname": "alice",
+        "identify_num": "0001",
+        "online": True,
+        "bot": False,
+        "avatar": "",
+    }
+    return {
+        "channel_type": "GROUP",
+        "type": 1,
+        "target_id": "channel",
+        "author_id": "42",
+        "content": content,
+        "msg_id": "msg",
+        "msg_timestamp": 0,
+        "nonce": "",
+        "extra": {
+            "type": 1,
+            "guild_id": "guild",
+            "channel_name": "general",
+            "mention": [],
+            "mention_all": False,
+            "mention_roles": [],
+            "mention_here": False,
+            "author": author,
+        },
+    }
+
+
+TEST_MODULES = ["lazy_probe", "slow_base", "dependent", "independent"]
+
+
+@pytest.fixture
+def events(monkeypatch):
+    """Shared with the test modules, which are cleaned out of `sys.modules` after the
+    test."""
+    shared = types.ModuleType("kbx_test_events")
+    shared.events = []
+    monkeypatch.setitem(sys.modules, "kbx_test_events", shared)
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    yield shared.events
+    for name in TEST_MODULES:
+        sys.modules.pop(name, None)
+
+
+def write_module(modules, name: str, source: str, manifest: str = None):
+    (modules / name).mkdir(parents=True)
+    (modules / name / "__init__.py").write_text(source)
+    if manifest is not None:
+        (modules / name / "manifest.kbx.json").write_text(manifest)
+
+
+def test_manifests_are_parsed(tmp_path):
+    write_module(
+        tmp_path,
+        "full",
+        "",
+        '{"lazy": true, "commands": ["a", 1], "requires": ["gum"], "extra": 0}',
+    )
+    write_module(tmp_path, "no_commands", "", '{"lazy": true}')
+    write_module(tmp_path, "broken", "", '{"lazy": true,')
+    write_module(tmp_path, "plain", "")
+    (tmp_path / "single.py").write_text("")
+    assert read_manifest(tmp_path / "full") == ModuleManifest(
+        lazy=True, commands=["a", "1"], requires=["gum"]
+    )
+    # Without commands, nothing would ever load a lazy module
+    assert read_manifest(tmp_path / "no_commands") == ModuleManifest()
+    assert read_manifest(tmp_path / "broken") == ModuleManifest()
+    assert read_manifest(tmp_path / "plain") == ModuleManifest()
+    assert read_manifest(tmp_path / "single.py") == ModuleManifest()
+
+
+def test_dependency_cycles_are_found():
+    assert dependency_cycle({"a": ["b"], "b": ["c"], "c": []}) is None
+    assert dependency_cycle({"a": ["b"], "b": ["gum"]}) is None
+    assert dependency_cycle({"a": ["b"], "b": ["c"], "c": ["b"]}) == ["b", "c", "b"]
+
+
+def test_lazy_module_is_imported_by_its_first_command(tmp_path, events):
+    write_module(
+        tmp_path,
+        "lazy_probe",
+        LAZY_MODULE,
+        '{"lazy": true, "commands": ["hey", "hey-reset"]}',
+    )
+
+    async def main():
+        kbx = KookBotX("fake", fake_api=True)
+        kbx.load_modules(tmp_path)
+        await kbx.initialize_modules()
+        at_startup = ("lazy_probe" in sys.modules, sorted(kbx.kookbot.command))
+        for content in ["/hey there", "/hey again", "/hey-reset"]:
+            await kbx.kookbot.client._consume_pkg(package(content))
+            await asyncio.sleep(0.2)
+        return kbx, at_startup
+
+    kbx, (imported_at_startup, commands) = asyncio.run(main())
+    assert not imported_at_startup
+    assert {"hey", "hey-reset"} <= set(commands)
+    # Imported once, then every message went to the module's own commands, including
+    # the one that triggered the import
+    assert events == [
+        "lazy_probe imported",
+        ("hey", ("there",)),
+        ("hey", ("again",)),
+        ("hey-reset", ()),
+    ]
+    report = next(r for r in kbx.startup_report if r.name == "lazy_probe")
+    assert report.mode == "lazy" and report.import_seconds is not None
+    assert sorted(cmd.name for cmd in kbx.lazy_commands["lazy_probe"]) == [
+        "hey",
+        "hey-reset",
+    ]
+
+
+def test_async_inits_wait_for_their_requirements_only(tmp_path, events):
+    for name, delay, manifest in [
+        ("slow_base", 0.1, None),
+        ("dependent", 0, '{"requires": ["slow_base"]}'),
+        ("independent", 0.05, None),
+    ]:
+        write_module(
+            tmp_path,
+            name,
+            ASYNC_INIT_MODULE.format(name=name, delay=delay),
+            manifest,
+        )
+
+    async def main():
+        kbx = KookBotX("fake", fake_api=True)
+        kbx.load_modules(tmp_path)
+        await kbx.initialize_modules()
+
+    asyncio.run(main())
+    assert events.index("dependent started") > events.index("slow_base done")
+    # Modules without requirements start together
+    assert events.index("independent started") < events.index("slow_base done")
+    assert len(events) == 6
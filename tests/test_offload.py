@@ -0,0 +1,121 @@
+import asyncio
+import os
+import time
+
+import numpy
+import pytest
+from PIL import Image
+
+from kbx.offload import OffloadError, OffloadPool, OffloadTimeout, SharedBuffer
+
+# Offloaded functions are imported by name in the workers
+
+
+def add(a: int, b: int) -> int:
+    return a + b
+
+
+def fail():
+    raise ValueError("bad input")
+
+
+def sleep_then_pid(seconds: float) -> int:
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def die():
+    os._exit(3)
+
+
+def invert(buffer: SharedBuffer) -> SharedBuffer:
+    image = buffer.to_image().point(lambda v: 255 - v)
+    return SharedBuffer.from_image(image)
+
+
+def double(buffer: SharedBuffer) -> SharedBuffer:
+    return SharedBuffer.from_array(buffer.to_array() * 2)
+
+
+def run(coro_func):
+    async def main():
+        pool = OffloadPool(workers=1, preload=(), timeout=5)
+        try:
+            return await coro_func(pool)
+        finally:
+            await pool.close()
+
+    return asyncio.run(main())
+
+
+def test_results_and_exceptions_come_back():
+    async def main(pool):
+        result = await pool.run(add, 1, b=2)
+        with pytest.raises(ValueError, match="bad input"):
+            await pool.run(fail)
+        return result, pool.stats()
+
+    result, stats = run(main)
+    assert result == 3
+    assert stats["completed"] == 1 and stats["failed"] == 1
+    assert stats["restarts"] == 0
+
+
+def test_timed_out_worker_is_killed_and_replaced():
+    async def main(pool):
+        first = await pool.run(sleep_then_pid, 0)
+        worker = pool.workers[0]
+        with pytest.raises(OffloadTimeout):
+            await pool.run(sleep_then_pid, 10, timeout=0.3)
+        # The replacement picks up the next call
+        second = await pool.run(sleep_then_pid, 0)
+        return first, second, worker, pool.stats()
+
+    first, second, worker, stats = run(main)
+    assert first != second
+    assert not worker.process.is_alive()
+    # The thread waiting for the killed worker let go before its connection closed
+    assert worker.reading.done() and isinstance(
+        worker.reading.exception(), (EOFError, OSError)
+    )
+    assert worker.conn.closed
+    assert stats["timeouts"] == 1 and stats["restarts"] == 1
+    assert stats["workers"] == 1
+
+
+def test_dead_worker_is_replaced():
+    async def main(pool):
+        with pytest.raises(OffloadError, match="died"):
+            await pool.run(die)
+        return await pool.run(add, 2, 2), pool.stats()
+
+    result, stats = run(main)
+    assert result == 4
+    assert stats["failed"] == 1 and stats["restarts"] == 1
+
+
+@pytest.mark.parametrize("mode", ["1", "L", "RGB", "RGBA", "I;16", "F"])
+def test_image_buffer_round_trip(mode):
+    image = Image.effect_noise((301, 97), 60).convert(mode)
+    with SharedBuffer.from_image(image) as buffer:
+        assert buffer.size == len(image.tobytes())
+        assert buffer.to_bytes() == image.tobytes()
+        assert buffer.to_image().tobytes() == image.tobytes()
+
+
+def test_buffers_travel_through_workers_by_name():
+    image = Image.effect_noise((640, 480), 60).convert("RGB")
+    array = numpy.arange(12, dtype=numpy.int32).reshape(3, 4)
+
+    async def main(pool):
+        with SharedBuffer.from_image(image) as sent:
+            with await pool.run(invert, sent) as received:
+                inverted = received.to_image().copy()
+        with SharedBuffer.from_array(array) as sent:
+            with await pool.run(double, sent) as received:
+                doubled = received.to_array().copy()
+        return inverted, doubled
+
+    inverted, doubled = run(main)
+    assert inverted.tobytes() == image.point(lambda v: 255 - v).tobytes()
+    assert (doubled == array * 2).all()
@@ -0,0 +1,46 @@
+import asyncio
+import importlib
+
+from llm_api.conversation import MemoryConversationBackend
+from llm_api.llm_base import LLMReturnChunk
+from main import KookBotX
+
+
+def answering(calls: list, name: str):
+    async def limited_query(prompt: str, **kwargs):
+        calls.append(name)
+        yield LLMReturnChunk(should_stop=True, content=f"summary by {name}")
+
+    return limited_query
+
+
+def test_reloaded_llm_api_keeps_summarizing_handed_over_conversations():
+    async def main():
+        kbx = KookBotX("fake", fake_api=True)
+        old = importlib.import_module("llm_api")
+        kbx.modules["llm_api"] = old
+        kbx._init_module(old)
+        calls = []
+        old.llm_GPT4o.limited_query = answering(calls, "old")
+        store = old.conversations
+        store.backend = MemoryConversationBackend()
+        await store.record("channel:user", "hello", "hi")
+
+        assert await kbx.reload_module("llm_api")
+        new = kbx.modules["llm_api"]
+        assert new is not old
+        new.llm_GPT4o.limited_query = answering(calls, "new")
+        # The store is handed over open, the old version's pooled clients are closed
+        assert new.conversations is store
+        assert old.conversations is None
+        assert old.http_clients.clients == {}
+
+        prompt = "word " * store.max_tokens
+        await store.record("channel:user", prompt, "answer")
+        await store.aclose()
+        return calls, store
+
+    calls, store = asyncio.run(main())
+    assert calls == ["new"]
+    assert store.summaries == 1
+    assert store.conversations["channel:user"].summary == "summary by new"
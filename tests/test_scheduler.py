@@ -0,0 +1,173 @@
+import asyncio
+import time
+
+import pytest
+
+from kbx.scheduler import OutboundScheduler, RateLimited, TokenBucket
+
+
+class FakeRequester:
+    """Send function of the scheduler, recording what was sent. Requests wait for
+    `gate` when it is set, and the first `rate_limited` of them answer 429."""
+
+    def __init__(self, rate_limited: int = 0, retry_after: float = 0.2):
+        self.sent = []
+        self.gate = None
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.started = time.monotonic()
+
+    async def send(self, method: str, route: str, params: dict):
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.rate_limited:
+            self.rate_limited -= 1
+            raise RateLimited(self.retry_after)
+        self.sent.append((time.monotonic() - self.started, route, params))
+        return {"route": route, **params.get("json", {})}
+
+
+def edit(msg_id: str, content: str) -> dict:
+    return {"json": {"msg_id": msg_id, "content": content}}
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+    bucket.pause(3, now)
+    assert bucket.delay(now + 1) == pytest.approx(2)
+
+
+def test_each_rate_limit_bucket_has_its_own_budget():
+    async def main():
+        scheduler = OutboundScheduler(rate=10, burst=2)
+        requester = FakeRequester()
+        await asyncio.gather(
+            *(scheduler.submit("POST", "a", {}, requester.send) for _ in range(4)),
+            scheduler.submit("POST", "b", {}, requester.send),
+        )
+        return requester.sent
+
+    sent = asyncio.run(main())
+    times = {route: [t for t, r, _ in sent if r == route] for route in ("a", "b")}
+    # The burst of `a` goes out at once, then one request every 1/rate seconds
+    assert times["a"][1] < 0.05
+    assert times["a"][2] == pytest.approx(0.1, abs=0.05)
+    assert times["a"][3] == pytest.approx(0.2, abs=0.05)
+    # `b` does not wait for `a`
+    assert times["b"][0] < 0.05
+
+
+def test_rate_limit_headers_share_and_pause_buckets():
+    scheduler = OutboundScheduler()
+    headers = {
+        "X-Rate-Limit-Bucket": "Message/Create",
+        "X-Rate-Limit-Remaining": "0",
+        "X-Rate-Limit-Reset": "2",
+    }
+    scheduler.observe("message/create", headers)
+    scheduler.observe("direct-message/create", headers)
+    bucket = scheduler.bucket_of("message/create")
+    assert scheduler.bucket_of("direct-message/create") is bucket
+    assert bucket.delay(time.monotonic()) == pytest.approx(2, abs=0.1)
+
+
+def test_429_is_waited_out_and_retried():
+    async def main():
+        scheduler = OutboundScheduler()
+        requester = FakeRequester(rate_limited=1, retry_after=0.2)
+        result = await scheduler.submit(
+            "POST", "message/create", {"json": {"content": "hi"}}, requester.send
+        )
+        return result, requester.sent, scheduler.stats()
+
+    result, sent, stats = asyncio.run(main())
+    assert result == {"route": "message/create", "content": "hi"}
+    assert len(sent) == 1 and sent[0][0] >= 0.2
+    assert stats["rate_limited"] == 1 and stats["sent"] == 1
+
+
+def test_429_fails_after_max_retries():
+    async def main():
+        scheduler = OutboundScheduler(max_retries=2)
+        requester = FakeRequester(rate_limited=3, retry_after=0.01)
+        with pytest.raises(RateLimited):
+            await scheduler.submit("POST", "message/create", {}, requester.send)
+        return scheduler.stats()
+
+    assert asyncio.run(main())["rate_limited"] == 3
+
+
+def test_replies_go_before_edits_and_reactions():
+    async def main():
+        scheduler = OutboundScheduler(max_in_flight=1)
+        requester = FakeRequester()
+        requester.gate = asyncio.Event()
+        # Occupies the only slot while the others queue up
+        tasks = [
+            asyncio.ensure_future(
+                scheduler.submit("POST", "guild/list", {}, requester.send)
+            )
+        ]
+        await asyncio.sleep(0.01)
+        for route, params in [
+            ("message/add-reaction", {}),
+            ("message/update", edit("m1", "edited")),
+            ("channel/list", {}),
+            ("message/create", {}),
+        ]:
+            tasks.append(
+                asyncio.ensure_future(
+                    scheduler.submit("POST", route, params, requester.send)
+                )
+            )
+        await asyncio.sleep(0.01)
+        requester.gate.set()
+        await asyncio.gather(*tasks)
+        return [route for _, route, _ in requester.sent]
+
+    assert asyncio.run(main()) == [
+        "guild/list",
+        "message/create",
+        "channel/list",
+        "message/update",
+        "message/add-reaction",
+    ]
+
+
+def test_queued_edits_of_a_message_are_coalesced():
+    async def main():
+        scheduler = OutboundScheduler(max_in_flight=1)
+        requester = FakeRequester()
+        requester.gate = asyncio.Event()
+        first = asyncio.ensure_future(
+            scheduler.submit("POST", "message/create", {}, requester.send)
+        )
+        await asyncio.sleep(0.01)
+        edits = [
+            asyncio.ensure_future(
+                scheduler.submit(
+                    "POST", "message/update", edit(msg_id, text), requester.send
+                )
+            )
+            for msg_id, text in [("m1", "a"), ("m2", "x"), ("m1", "ab"), ("m1", "abc")]
+        ]
+        await asyncio.sleep(0.01)
+        requester.gate.set()
+        await first
+        results = await asyncio.gather(*edits)
+        return results, requester.sent, scheduler.stats()
+
+    results, sent, stats = asyncio.run(main())
+    updates = [params["json"] for _, route, params in sent if route == "message/update"]
+    assert updates == [
+        {"msg_id": "m1", "content": "abc"},
+        {"msg_id": "m2", "content": "x"},
+    ]
+    # Every caller gets the result of the edit that was sent
+    assert [r["content"] for r in results] == ["abc", "x", "abc", "abc"]
+    assert stats["coalesced"] == 2
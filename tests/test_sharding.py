@@ -0,0 +1,114 @@
+import json
+import re
+import time
+
+import gum as gum_package
+from gum import json_manager
+from gum.json_manager import JSONUserManager
+from kbx.sharding import shard_of
+from main import run_sharded
+
+# Replies with the shard's pid, and whether the gateway's gum knew the author before
+PROBE_MODULE = """
+import os
+
+from khl import Bot, Message
+
+from gum import gum
+
+
+def init(bot: Bot):
+    @bot.command("probe")
+    async def probe(msg: Message, *args):
+        known = await gum.has_user(msg.author_id)
+        if not known:
+            await gum.register(msg.author_id, "probe")
+        await msg.reply(f"probe {msg.ctx.guild.id} {msg.author_id} {os.getpid()} {known}")
+"""
+
+
+def message(guild_id: str, author_id: str, n: int) -> dict:
+    return {
+        "channel_type": "GROUP",
+        "type": 1,
+        "target_id": f"channel-{guild_id}",
+        "author_id": author_id,
+        "content": "/probe",
+        "msg_id": f"msg-{n}",
+        "msg_timestamp": int(time.time() * 1000),
+        "nonce": "",
+        "extra": {
+            "type": 1,
+            "guild_id": guild_id,
+            "channel_name": "general",
+            "mention": [],
+            "mention_all": False,
+            "mention_roles": [],
+            "mention_here": False,
+            "author": {
+                "id": author_id,
+                "username": f"user{author_id}",
+                "nickname": f"user{author_id}",
+                "identify_num": "0001",
+                "online": True,
+                "bot": False,
+                "avatar": "",
+            },
+        },
+    }
+
+
+def test_replay_through_two_shards(tmp_path, monkeypatch):
+    # Two guilds hashed to different shards
+    guilds = {}
+    for n in range(100):
+        guilds.setdefault(shard_of(f"guild-{n}", 2), f"guild-{n}")
+        if len(guilds) == 2:
+            break
+    events = [
+        message(guilds[0], "1", 0),
+        message(guilds[1], "2", 1),
+        message(guilds[0], "3", 2),
+        message(guilds[1], "4", 3),
+    ]
+    recording = tmp_path / "events.jsonl"
+    recording.write_text(
+        "".join(json.dumps({"t": time.time(), "d": pkg}) + "\n" for pkg in events)
+    )
+    modules = tmp_path / "modules"
+    (modules / "probe").mkdir(parents=True)
+    (modules / "probe" / "__init__.py").write_text(PROBE_MODULE)
+    # The gateway process (this one) owns the data
+    monkeypatch.setattr(json_manager, "DEFAULT_DATA_DIR", tmp_path / "data")
+    vars(gum_package).pop("gum", None)
+    try:
+        run_sharded("fake", 2, str(recording), modules, tmp_path / "logs")
+    finally:
+        vars(gum_package).pop("gum", None)
+
+    replies = {}
+    for shard_id in range(2):
+        for log in (tmp_path / "logs").glob(f"kookbotx-shard{shard_id}*"):
+            for line in log.read_text().splitlines():
+                if "Fake KOOK API POST message/create" not in line:
+                    continue
+                guild, author, pid, known = re.search(
+                    r"probe (\S+) (\S+) (\d+) (True|False)", line
+                ).groups()
+                replies[guild, author] = (shard_id, pid, known == "True")
+    assert set(replies) == {
+        (pkg["extra"]["guild_id"], pkg["author_id"]) for pkg in events
+    }
+    for (guild, author), (shard_id, _, _) in replies.items():
+        assert shard_id == shard_of(guild, 2)
+    # Each guild went to one worker process, and the two are different
+    pids = {
+        guild: {pid for (g, _), (_, pid, _) in replies.items() if g == guild}
+        for guild in guilds.values()
+    }
+    assert all(len(p) == 1 for p in pids.values())
+    assert pids[guilds[0]] != pids[guilds[1]]
+    # Every shard registered its users through the gum of the gateway
+    assert not any(known for _, _, known in replies.values())
+    stored = JSONUserManager(data_dir=tmp_path / "data")
+    assert set(stored.user_table) == {"1", "2", "3", "4"}
@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import pytest
+
+from stream_edit import MessageStreamer
+
+
+class FakeGate:
+    """Records the content of every edit; the edits in `fail` raise instead."""
+
+    def __init__(self, latency: float = 0.0, fail=()):
+        self.latency = latency
+        self.fail = set(fail)
+        self.edits = []
+        self.started = time.monotonic()
+
+    async def exec_req(self, req):
+        assert req.route == "message/update"
+        await asyncio.sleep(self.latency)
+        n = len(self.edits)
+        self.edits.append((time.monotonic() - self.started, req.params["json"]))
+        if n in self.fail:
+            raise RuntimeError("KOOK said no")
+        return {}
+
+
+def test_edits_are_throttled_and_end_on_the_final_text():
+    async def main():
+        gate = FakeGate()
+        async with MessageStreamer(gate, "msg", max_edits_per_second=10) as streamer:
+            for i in range(50):
+                streamer.append(f"{i} ")
+                await asyncio.sleep(0.01)
+        return gate.edits, streamer.edits
+
+    edits, count = asyncio.run(main())
+    times = [t for t, _ in edits]
+    assert all(b - a >= 0.095 for a, b in zip(times, times[1:]))
+    # About 0.5s of updates at 10 edits per second
+    assert 4 <= count <= 8 and count == len(edits)
+    assert edits[0][1] == {"msg_id": "msg", "content": "0"}
+    assert edits[-1][1]["content"] == " ".join(str(i) for i in range(50))
+
+
+def test_slow_api_drops_intermediate_snapshots():
+    async def main():
+        gate = FakeGate(latency=0.2)
+        streamer = MessageStreamer(gate, "msg", max_edits_per_second=100)
+        started = time.monotonic()
+        for text in ["a", "ab", "abc", "abcd"]:
+            streamer.update(text)
+            await asyncio.sleep(0.01)
+        producing = time.monotonic() - started
+        await streamer.close()
+        return producing, [params["content"] for _, params in gate.edits]
+
+    producing, contents = asyncio.run(main())
+    assert producing < 0.1
+    assert contents == ["a", "abcd"]
+
+
+def test_empty_and_unchanged_snapshots_are_not_sent():
+    async def main():
+        gate = FakeGate()
+        streamer = MessageStreamer(gate, "msg", max_edits_per_second=100)
+        streamer.update("  ")
+        await asyncio.sleep(0.05)
+        streamer.update("done\n")
+        await asyncio.sleep(0.05)
+        streamer.update("done")
+        await streamer.close()
+        with pytest.raises(RuntimeError):
+            streamer.update("more")
+        return [params["content"] for _, params in gate.edits]
+
+    assert asyncio.run(main()) == ["done"]
+
+
+def test_close_without_updates_sends_nothing():
+    async def main():
+        gate = FakeGate()
+        await MessageStreamer(gate, "msg").close()
+        return gate.edits
+
+    assert asyncio.run(main()) == []
+
+
+def test_failed_edits_are_replaced_by_the_next_one():
+    async def main():
+        gate = FakeGate(fail={0})
+        async with MessageStreamer(gate, "msg", max_edits_per_second=100) as streamer:
+            streamer.update("first")
+            await asyncio.sleep(0.05)
+            streamer.update("second")
+        return [params["content"] for _, params in gate.edits], streamer.sent
+
+    contents, sent = asyncio.run(main())
+    assert contents == ["first", "second"] and sent == "second"
+
+
+def test_failed_final_edit_raises_from_close():
+    async def main():
+        gate = FakeGate(fail={0})
+        streamer = MessageStreamer(gate, "msg")
+        streamer.update("final")
+        with pytest.raises(RuntimeError, match="KOOK said no"):
+            await streamer.close()
+
+    asyncio.run(main())
+
+
+def test_errors_of_the_producer_are_not_masked():
+    async def main():
+        gate = FakeGate(fail={0})
+        with pytest.raises(ValueError, match="producer failed"):
+            async with MessageStreamer(gate, "msg") as streamer:
+                streamer.update("partial")
+                raise ValueError("producer failed")
+        # What was produced before the error was still sent
+        return [params["content"] for _, params in gate.edits]
+
+    assert asyncio.run(main()) == ["partial"]